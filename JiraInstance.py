@@ -1,8 +1,60 @@
 #!/usr/bin/env python3
 
-from jira import JIRA
+from jira import JIRA, JIRAError
+import requests
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import datetime
+import json
+import os
+import random
 import re
+import threading
+import time
+
+watermark_lock = threading.Lock()
+clients = {}
+clients_lock = threading.Lock()
+
+
+def get_shared_client(server, user, password, pool_size, refresh=False):
+    """
+    Return JIRA client shared by the whole process, created on first use.
+    With refresh set, the current client is dropped and a new session is opened.
+    """
+    key = (server, user)
+    with clients_lock:
+        client = clients.get(key)
+        if client is None or refresh:
+            print("Logging in to Jira {} as {}".format(server, user))
+            client = JIRA({'server': server}, basic_auth=(user, password))
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            client._session.mount('https://', adapter)
+            client._session.mount('http://', adapter)
+            clients[key] = client
+        return client
+
+
+class RateLimiter:
+    """
+    Class which spaces requests, so at most requests_per_second are started.
+    """
+    def __init__(self, requests_per_second):
+        self.interval = 1.0 / requests_per_second
+        self.next_request = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            delay = self.next_request - now
+            self.next_request = max(now, self.next_request) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def parse_jira_time(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f%z')
 
 
 class JiraInstance:
@@ -10,7 +62,14 @@ class JiraInstance:
     Class which is response for creataing FixVersion, marking it as RELEASED and for annote tasks which where
     done within lastday.
     """
-    def __init__(self, config):
+    MAX_WORKERS = 8
+    REQUESTS_PER_SECOND = 10
+    MAX_RETRIES = 5
+    SEARCH_CHUNK_SIZE = 100
+    COMMENTS_PAGE_SIZE = 50
+    DEFAULT_WATERMARK_FILE = os.path.join('~', '.upgrader', 'changelog_watermark.json')
+
+    def __init__(self, config, watermark_key=None):
         self.SERVER_ADDRESS = config["SERVER_ADDRESS"]
         self.USER = config["USER"]
         self.PASSWORD = config["PASSWORD"]
@@ -18,28 +77,109 @@ class JiraInstance:
         self.CHANGELOG_TAG = config["CHANGELOG_TAG"]
         self.tasks = []
         self.fixedVersion = None
+        self.rate_limiter = RateLimiter(config.get("REQUESTS_PER_SECOND", self.REQUESTS_PER_SECOND))
+        self.task_pattern = re.compile("{}-[1-9][0-9]*".format(re.escape(self.PROJECT)))
+        self.watermark_file = os.path.expanduser(config.get("WATERMARK_FILE", self.DEFAULT_WATERMARK_FILE))
+        self.watermark_key = watermark_key or self.CHANGELOG_TAG
+        self.new_watermark = None
 
-        options = {
-            'server': self.SERVER_ADDRESS
-        }
-
-        self.jira = JIRA(options, basic_auth=(self.USER, self.PASSWORD))
+    @property
+    def jira(self):
+        return get_shared_client(self.SERVER_ADDRESS, self.USER, self.PASSWORD, self.MAX_WORKERS)
 
     def is_any_new_changeset_in_changelog(self) -> bool:
         """
         Check if there is any new changeset in changelog in Jira task
         """
-        changelog_issue = self.jira.issue(self.CHANGELOG_TAG, fields='comment')
-        changelog = self.jira.comments(changelog_issue)[-1]
-        regexp = "{}-([1-9]+[0-9]*)".format(self.PROJECT)
-        for line in changelog.body.splitlines():
-            issueTag = re.search(regexp, line)
-            if issueTag is None or issueTag is "":
-                continue
-            self.tasks.append(issueTag.group())
-
+        self.tasks = sorted(self.scan_changelog())
         return True if len(self.tasks) > 0 else False
 
+    def scan_changelog(self):
+        """
+        Collect tasks from changelog comments added since the watermark.
+        Without watermark only the last comment is scanned.
+        Watermark is stored only after commit_changelog_watermark() is called.
+        """
+        watermark = self.load_watermark()
+        comments, total = self.fetch_comments_since(watermark)
+        if comments:
+            self.new_watermark = {'ID': comments[-1]['id'], 'CREATED': comments[-1]['created'], 'START_AT': total}
+        print("{} new comment(s) in changelog {}".format(len(comments), self.CHANGELOG_TAG))
+
+        tasks = set()
+        for comment in comments:
+            tasks.update(self.task_pattern.findall(comment['body']))
+        return tasks
+
+    def fetch_comments_page(self, start_at, max_results):
+        return self.call_with_retry(JIRA._get_json, 'issue/{}/comment'.format(self.CHANGELOG_TAG),
+                                    params={'startAt': start_at, 'maxResults': max_results, 'orderBy': 'created'})
+
+    def fetch_comments_since(self, watermark):
+        """
+        Fetch comments newer than watermark in pages ordered by creation time
+
+        Returns:
+        tuple: list of new comments and total number of comments
+        """
+        if watermark is None:
+            page = self.fetch_comments_page(0, 1)
+            if page['total'] > 1:
+                page = self.fetch_comments_page(page['total'] - 1, 1)
+            return page['comments'], page['total']
+
+        start_at = max(watermark['START_AT'] - 1, 0)
+        comments = []
+        while True:
+            page = self.fetch_comments_page(start_at + len(comments), self.COMMENTS_PAGE_SIZE)
+            comments.extend(page['comments'])
+            if not page['comments'] or start_at + len(comments) >= page['total']:
+                break
+
+        if comments and comments[0]['id'] == watermark['ID']:
+            return comments[1:], page['total']
+
+        print("Changelog comments were removed since last scan, rescanning")
+        if start_at > 0:
+            comments = self.fetch_all_comments()
+        created = parse_jira_time(watermark['CREATED'])
+        return [comment for comment in comments if parse_jira_time(comment['created']) > created], page['total']
+
+    def fetch_all_comments(self):
+        comments = []
+        while True:
+            page = self.fetch_comments_page(len(comments), self.COMMENTS_PAGE_SIZE)
+            comments.extend(page['comments'])
+            if not page['comments'] or len(comments) >= page['total']:
+                return comments
+
+    def load_watermark(self):
+        with watermark_lock:
+            if not os.path.exists(self.watermark_file):
+                return None
+            with open(self.watermark_file) as f:
+                return json.load(f).get(self.watermark_key)
+
+    def commit_changelog_watermark(self):
+        """
+        Store position of the last scanned changelog comment, so next scan starts after it
+        """
+        if self.new_watermark is None:
+            return
+
+        with watermark_lock:
+            watermarks = {}
+            if os.path.exists(self.watermark_file):
+                with open(self.watermark_file) as f:
+                    watermarks = json.load(f)
+            watermarks[self.watermark_key] = self.new_watermark
+            os.makedirs(os.path.dirname(self.watermark_file), exist_ok=True)
+            tmp_file = '{}.tmp'.format(self.watermark_file)
+            with open(tmp_file, 'w') as f:
+                json.dump(watermarks, f, indent=2)
+            os.replace(tmp_file, self.watermark_file)
+        self.new_watermark = None
+
     def add_fixed_version_to_tasks(self, fixed_version):
         """
         Create and add fixed version to tasks from chagnelog task pointed in conf.json
@@ -50,10 +190,71 @@ class JiraInstance:
 
         today = datetime.date.today()
         today_str = today.strftime('%Y-%m-%d')
-        self.jira.create_version(name=(fixed_version), project=self.PROJECT, released=True, startDate=today_str,
-                                 releaseDate=today_str)
+        self.call_with_retry(JIRA.create_version, name=(fixed_version), project=self.PROJECT, released=True,
+                             startDate=today_str, releaseDate=today_str)
+
+        tasks = list(OrderedDict.fromkeys(self.tasks))
+        issues = self.search_issues(tasks, 'fixVersions')
+        pending = [issue for issue in issues
+                   if fixed_version not in [version.name for version in issue.fields.fixVersions]]
+        print("{} tasks in changelog, {} found, {} already have {}".format(len(tasks), len(issues),
+                                                                         len(issues) - len(pending), fixed_version))
+
+        def add_fixed_version(issue):
+            def update(jira):
+                issue._session = jira._session
+                issue.add_field_value('fixVersions', {'name': fixed_version})
+
+            print("Add fixed version to {}".format(issue.key))
+            try:
+                self.call_with_retry(update)
+                return True
+            except JIRAError as error:
+                print("Adding fixed version to {} failed: {}".format(issue.key, error.text))
+                return False
+
+        with ThreadPoolExecutor(max_workers=self.MAX_WORKERS) as executor:
+            updated = sum(executor.map(add_fixed_version, pending))
+        print("Fixed version {} added to {} of {} tasks".format(fixed_version, updated, len(pending)))
 
-        for task in self.tasks:
-            print("Add fixed version to {}".format(task))
-            issue = self.jira.issue(task, fields='fixVersions')
-            issue.add_field_value('fixVersions', {'name': fixed_version})
\ No newline at end of file
+    def call_with_retry(self, function, *args, **kwargs):
+        """
+        Call function(jira, *args, **kwargs) with rate limiting, retry with exponential backoff
+        on 429 and 5xx responses, log in again once when session expired (401)
+        """
+        relogged = False
+        last_error = None
+        for attempt in range(self.MAX_RETRIES):
+            self.rate_limiter.wait()
+            jira = self.jira
+            try:
+                return function(jira, *args, **kwargs)
+            except JIRAError as error:
+                last_error = error
+                status = error.status_code or 0
+                if status == 401 and not relogged:
+                    print("Jira session expired, logging in again")
+                    with clients_lock:
+                        expired = clients.get((self.SERVER_ADDRESS, self.USER)) is jira
+                    if expired:
+                        get_shared_client(self.SERVER_ADDRESS, self.USER, self.PASSWORD, self.MAX_WORKERS, True)
+                    relogged = True
+                    continue
+                if (status != 429 and status < 500) or attempt == self.MAX_RETRIES - 1:
+                    raise
+                retry_after = error.response.headers.get('Retry-After') if error.response is not None else None
+                delay = float(retry_after) if retry_after and retry_after.isdigit() else 2 ** attempt
+                print("Jira responded with {}, retrying in {:.1f}s".format(status, delay))
+                time.sleep(delay + random.uniform(0, 0.5))
+        raise last_error
+
+    def search_issues(self, keys, fields):
+        """
+        Fetch issues with given keys using bulk JQL search, unknown keys are skipped
+        """
+        issues = []
+        for i in range(0, len(keys), self.SEARCH_CHUNK_SIZE):
+            jql = 'key in ({})'.format(', '.join(keys[i:i + self.SEARCH_CHUNK_SIZE]))
+            issues.extend(self.call_with_retry(JIRA.search_issues, jql, fields=fields, maxResults=False,
+                                               validate_query=False))
+        return issues
\ No newline at end of file
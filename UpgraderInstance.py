@@ -28,21 +28,37 @@ Script which builds projects, copies them to remote location, upgrades boxes and
 
 import json
 import os
-import glob
 import subprocess
 import datetime
 import argparse
 import textwrap
-import pysftp
 import time
-from typing import List, Dict
-from smtplib import SMTP
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
+import box_readiness
+from build_cache import BuildCache
+from package_inspector import inspect_package
+import source_mirror
+from staging_store import StagingStore, get_store
+from execution_context import ExecutionContext, work_dir_lock
+from fleet_state import FAILED, REACHABLE, UNREACHABLE, UP_TO_DATE, UPGRADED, FleetState, get_fleet_state
+from incremental_build import BUILD_MODES, CLEAN, INCREMENTAL, get_revisions, needs_clean_build, record_build
+from sbuild_transfer import SbuildTransfer
+import ssh_pool
+from job_scheduler import report_progress, current_job_labels, output_subscriber
+from command_runner import CommandError, CommandRunner
+from notifier import NOTIFY_MODES, PER_BOX, DIGEST, Notifier, get_notifier
+from instrumentation import metrics
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+from typing import List, Dict, Tuple
 
 class Upgrader:
     """Class which is response for building projects based on config from conf.json."""
 
+    BUILD_FLAGS = 'SvDebug=yes SvDebugBuild=yes SvKeepStack=yes'
+    SV_VERSION_COMMAND = "/usr/local/bin/setnv | grep SV_VERSION | cut -d'=' -f2"
+    BOOT_ID_COMMAND = "cat /proc/sys/kernel/random/boot_id"
+    UPGRADE_OUTPUT_LINES = 20
+
     def __init__(self, upgrade_config:dict):
         """Constructor of Upgrader class.
 
@@ -54,6 +70,8 @@ class Upgrader:
         self.remote_location: int = upgrade_config['REMOTE_LOCATION']
         self.work_dir: str = upgrade_config['WORK_DIR']
         self.server: str = upgrade_config['SERVER']
+        self.server_port: int = int(upgrade_config.get('SERVER_PORT', 22))
+        self.box_ssh_port: int = int(upgrade_config.get('BOX_SSH_PORT', 22))
         self.username: str = upgrade_config['USERNAME']
         self.lab_key_path: str = upgrade_config['LAB_KEY_PATH']
         self.all_boxes: List[Dict[str, str]]= upgrade_config['BOXES_LIST']
@@ -61,9 +79,37 @@ class Upgrader:
         self.upgrade_base_url: str = upgrade_config['UPGRADE_BASE_URL']
         self.from_mail_address: str = upgrade_config['FROM_MAIL_ADDRESS']
         self.to_mail_address: str = upgrade_config['TO_MAIL_ADDRESS']
+        self.notifier: Notifier = get_notifier(upgrade_config)
+        self.staging_store: StagingStore = get_store(upgrade_config)
+        self.fleet_state: FleetState = get_fleet_state(upgrade_config)
+        self.context: ExecutionContext = ExecutionContext()
+        self.preflight_enabled: bool = upgrade_config.get('PREFLIGHT', True)
+        self.preflight_timeout: float = float(upgrade_config.get('PREFLIGHT_TIMEOUT', 5))
+        self.preflight_workers: int = int(upgrade_config.get('PREFLIGHT_WORKERS', 32))
+        self.fleet_state_max_age: float = float(upgrade_config.get('FLEET_STATE_MAX_AGE', 3600))
+        self.skip_up_to_date: bool = upgrade_config.get('SKIP_UP_TO_DATE', True)
+        self.notify_mode: str = upgrade_config.get('NOTIFY_MODE', PER_BOX)
+        if self.notify_mode not in NOTIFY_MODES:
+            raise ValueError('Unknown NOTIFY_MODE {}, expected one of {}'.format(self.notify_mode, NOTIFY_MODES))
+        self.max_parallel_upgrades: int = int(upgrade_config.get('MAX_PARALLEL_UPGRADES', 4))
+        self.upgrade_timeout: float = float(upgrade_config.get('UPGRADE_TIMEOUT', 600))
+        self.reboot_timeout: float = float(upgrade_config.get('REBOOT_TIMEOUT', 60))
+        self.boot_timeout: float = float(upgrade_config.get('BOOT_TIMEOUT', 300))
+        self.activation_timeout: float = float(upgrade_config.get('ACTIVATION_TIMEOUT', 180))
+        self.build_cache: BuildCache = None
+        if upgrade_config.get('BUILD_CACHE_DIR'):
+            self.build_cache = BuildCache(upgrade_config['BUILD_CACHE_DIR'],
+                                          float(upgrade_config.get('BUILD_CACHE_MAX_SIZE_GB', 50)))
+        self.default_build_mode: str = self.check_build_mode(upgrade_config.get('BUILD_MODE', CLEAN))
+        self.clean_build_patterns: List[str] = upgrade_config.get('CLEAN_BUILD_PATTERNS')
+        self.source_mirror: source_mirror.SourceMirror = source_mirror.get_mirror(upgrade_config)
+        self.command_runner: CommandRunner = CommandRunner(upgrade_config.get('FATAL_ERROR_PATTERNS'),
+                                                           int(upgrade_config.get('OUTPUT_TAIL_LINES', 200)))
+        self.command_runner.subscribe(output_subscriber())
 
         """Present upgrade params"""
         self.upgrade_type: str = 'single'
+        self.build_mode: str = self.default_build_mode
         self.version_md5_hash: str = None
         self.build_dir: str = None
         self.project: str = None
@@ -73,78 +119,173 @@ class Upgrader:
         self.upgrade_succeed: bool = None
         self.base_dir: str = None
         self.local_path: str = None
-        self.local_arch_path: str = None
+        self.staged_hash: str = None
+        self.upgrade_url: str = None
+        self.transfer_stats: Dict[str, int] = None
+        self.phase_durations: Dict[str, Dict[str, float]] = {}
+        self.job_labels: Dict[str, str] = current_job_labels()
+
+    def span(self, phase: str, ip: str = None):
+        """Measure phase of the current project, branch and box."""
 
-    def call_command(self, command: str):
+        return metrics.span(phase, project=self.project, branch=self.branch, ip=ip, **self.job_labels)
+
+    def call_command(self, command: str, cwd: str = None):
         """
-        Call specific command.
+        Call specific command, its output is streamed to the job and aborted after fatal error.
 
         Args:
         command (str): command which will be called
+        cwd (str): directory in which command will be called, work directory of the job if not given
+
+        Raises:
+        CommandError: command failed, last lines of its output are printed
         """
 
         try:
-            subprocess.check_call(command, shell=True, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as error:
+            self.command_runner.run(command, cwd=cwd or self.context.work_dir, env=self.context.environ())
+        except CommandError as error:
+            print(error)
+            print("Last {} line(s) of output:".format(len(error.tail)))
             print(error.output)
-            exit(0)
+            raise
+
+    def pull(self, name: str, fetch_command: str):
+        """
+        Update sources in base directory, from local mirror if MIRROR_DIR is configured.
+
+        Args:
+        name (str): branch or release name
+        fetch_command (str): nosilo command fetching sources from upstream
+        """
+
+        if self.source_mirror is not None:
+            self.source_mirror.checkout(name, fetch_command, self.base_dir)
+        else:
+            self.call_command(fetch_command)
+
+    def get_base_dir(self) -> str:
+        """Get directory with sources of current upgrade, the one from which Upgrader was started for local sbuild."""
+
+        if self.upgrade_type == 'rc':
+            return os.path.join(self.work_dir, 'RC')
+        if self.upgrade_type == 'local':
+            return self.context.work_dir
+        return os.path.join(self.work_dir, self.branch)
 
     def prepare(self):
         """Prepare directories, files"""
 
+        self.base_dir = self.get_base_dir()
+        self.context = ExecutionContext(self.base_dir, self.context.env)
         if self.upgrade_type == 'single' or self.upgrade_type == 'all':
-            self.base_dir = os.path.join(self.work_dir, self.branch)
             print("Preparing working directories in {}".format(self.base_dir))
             os.makedirs(self.base_dir, exist_ok=True)
-            os.chdir(self.base_dir)
             print("Done")
             
             print("Pulling branch {} ...".format(self.branch))
-            self.call_command('nosilo pull {} -ym'.format(self.branch))
+            self.pull(self.branch, 'nosilo pull {} -ym'.format(self.branch))
             print("Pulling done.")
         elif self.upgrade_type == 'rc':
-            self.base_dir = os.path.join(self.work_dir, 'RC')
             print("Preparing working directories in {}".format(self.base_dir))
             os.makedirs(self.base_dir, exist_ok=True)
-            os.chdir(self.base_dir)
             print("Done")
             
             print("Pulling RC {} ...".format(self.project))
-            self.call_command('nosilo fetch release {}'.format(self.project))
+            self.pull('release-{}'.format(self.project), 'nosilo fetch release {}'.format(self.project))
             print("Pulling done.")
         elif self.upgrade_type == 'local':
             pass
 
+    @staticmethod
+    def check_build_mode(build_mode: str) -> str:
+        if build_mode not in BUILD_MODES:
+            raise ValueError("Unknown BUILD_MODE {}, expected one of {}".format(build_mode, BUILD_MODES))
+        return build_mode
+
+    def run_pysilo(self):
+        """
+        Build project according to BUILD_MODE.
+
+        In incremental mode build products of the previous run are reused, unless files
+        changed since the last successful build require clean build. Failed incremental
+        build is repeated as clean one.
+        """
+
+        command = '{} pysilo {}--project {}'
+        if self.build_mode == CLEAN:
+            self.call_command(command.format(self.BUILD_FLAGS, '--clean ', self.project))
+            return
+
+        revisions = get_revisions(self.base_dir)
+        clean_build, reason = needs_clean_build(self.base_dir, self.project, self.BUILD_FLAGS, revisions,
+                                                self.clean_build_patterns)
+        print("{} build of {}: {}".format("Clean" if clean_build else "Incremental", self.project, reason))
+        if not clean_build:
+            try:
+                self.call_command(command.format(self.BUILD_FLAGS, '', self.project))
+                record_build(self.base_dir, self.project, self.BUILD_FLAGS, revisions, True)
+                return
+            except subprocess.CalledProcessError:
+                print("Incremental build of {} failed, falling back to clean build".format(self.project))
+
+        record_build(self.base_dir, self.project, self.BUILD_FLAGS, revisions, False)
+        self.call_command(command.format(self.BUILD_FLAGS, '--clean ', self.project))
+        record_build(self.base_dir, self.project, self.BUILD_FLAGS, revisions, True)
+
+    def get_source_revisions(self) -> str:
+        """Get revisions of all nosilo repositories in base directory."""
+
+        ps = subprocess.Popen('nosilo foreach "hg id -i"', stdin=subprocess.PIPE, stdout=subprocess.PIPE, shell=True,
+                              cwd=self.base_dir, env=self.context.environ())
+        revisions = str(ps.communicate()[0], "utf-8").rstrip("\n")
+        assert ps.returncode == 0 and len(revisions) > 0
+        return revisions
+
     def build(self):
         """Build single project. Software will be tagged by tag prepared in prepare() method."""
 
+        sbuild_dir = self.context.path("sbuild-{}".format(self.project))
+        if not self.upgrade_type == 'rc':
+            # Recorded before building, so clean() removes sbuild also when build fails or copy is skipped.
+            self.local_path = sbuild_dir
+        hardlink = self.build_mode == CLEAN
+        cache_key = None
+        if not self.upgrade_type == 'rc' and self.build_cache is not None:
+            cache_key = self.build_cache.make_key(self.project, self.get_source_revisions(), self.BUILD_FLAGS)
+            self.version_md5_hash = self.build_cache.restore(cache_key, sbuild_dir, hardlink)
+            if self.version_md5_hash is not None:
+                print("Reusing cached build of {} with hash {}".format(self.project, self.version_md5_hash))
+                return
+
         if not self.upgrade_type == 'rc':
             print("Build project {}".format(self.project))
-            self.call_command('SvDebug=yes SvDebugBuild=yes SvKeepStack=yes pysilo --clean --project {}'.format(self.project))
+            with self.span('pysilo'):
+                self.run_pysilo()
             print("Build done.")
 
-        upgrade_package = glob.glob(os.path.join("sbuild-{}".format(self.project), "*upgrade*.tgz"))[0]
+        upgrade_package = self.context.glob(os.path.join(sbuild_dir, "*upgrade*.tgz"))[0]
         assert len(upgrade_package) > 0
 
-        cmd = 'tar -ztf {} | grep "md5$"'.format(upgrade_package)
-        ps = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, shell=True)
-        upgrade_file = str(ps.communicate()[0], "utf-8").rstrip("\n")
-        assert len(upgrade_file) > 0
-
-        cmd = "tar -O -zxf {} {} | head -n 1 | awk '{{print $1}}'".format(upgrade_package,
-                                                                          upgrade_file)
-
-        ps = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, shell=True)
-        self.version_md5_hash = str(ps.communicate()[0], "utf-8").rstrip("\n")
+        self.version_md5_hash = inspect_package(upgrade_package).version_md5_hash
         assert len(self.version_md5_hash) > 0
 
+        if cache_key is not None:
+            print("Storing build of {} in cache ...".format(self.project))
+            self.build_cache.store(cache_key, self.project, sbuild_dir, self.version_md5_hash, hardlink)
+            print("Done")
+
         print("Cleaning before tagging ...")
-        self.call_command('nosilo foreach "hg revert --all && hg purge"')
+        if self.build_mode == INCREMENTAL:
+            self.call_command('nosilo foreach "hg revert --all"')
+        else:
+            self.call_command('nosilo foreach "hg revert --all && hg purge"')
         print("Done")
 
         print("Tagging new software ...")
-        self.call_command('nosilo tag {} --name=bluelab_{}'.format(self.branch,
-                                                                   self.version_md5_hash))
+        with self.span('tag'):
+            self.call_command('nosilo tag {} --name=bluelab_{}'.format(self.branch,
+                                                                       self.version_md5_hash))
 
     def copy(self):
         """Copy prepared packages to remote and local locations"""
@@ -152,109 +293,279 @@ class Upgrader:
         if self.upgrade_type == 'rc':
             return
 
-        self.local_path = os.path.join(self.base_dir, 'sbuild-{}'.format(self.project))
-        archName = 'sbuild.tar'
-        print("Create {} from {}\n".format(archName, self.local_path.split('/')[-1]))
-        self.local_arch_path = os.path.join(self.base_dir, archName)
-        self.call_command('cd {}'.format(self.base_dir))
-        self.call_command('tar -zcf {} {}'.format(archName, self.local_path.split('/')[-1]))
-
         remoteBasePath = os.path.join(self.remote_location, self.version_md5_hash)
-        remoteSbuildPath = os.path.join(remoteBasePath, 'sbuild-{}'.format(self.project))
-        print("Extract {} in remote {}\n".format(archName, remoteBasePath))
-        with pysftp.Connection(self.server, username=self.username, private_key=self.lab_key_path) as sftp:
-            if not sftp.exists(remoteSbuildPath):
-                sftp.makedirs(remoteBasePath)
-                remoteArchPath = os.path.join(remoteBasePath, archName)
-                sftp.put(self.local_arch_path, remoteArchPath)
-                sftp.execute('cd {path} && tar -xf {arch} && rm {arch}'.format(path=remoteBasePath, arch=archName))
-                sftp.execute('chmod -R 777 {}'.format(remoteBasePath))
-            sftp.close()
+        print("Send {} to remote {}\n".format(self.local_path.split('/')[-1], remoteBasePath))
+        with ssh_pool.pool.connection(self.server, self.username, self.lab_key_path, self.server_port) as client:
+            transfer = SbuildTransfer(client, self.remote_location)
+            self.transfer_stats = transfer.transfer(self.local_path, self.version_md5_hash)
+            transfer.close()
 
         packagePath = os.path.join(self.local_path, '{}-upgrade-CURRENT.tgz'.format(self.project))
-        upgradePath = os.path.join(self.upgrade_base_dir, self.project)
+        self.upgrade_url = self.staging_store.acquire(self.version_md5_hash, packagePath)
+        self.staged_hash = self.version_md5_hash
 
-        print("Extract {} in local {}\n".format(packagePath.split('/')[-1], upgradePath))
-        self.call_command('mkdir -p {}'.format(upgradePath))
-        self.call_command('tar -xf {} -C {}'.format(packagePath, upgradePath))
+    def connect_box(self, ip: str, key_path: str, timeout: float = None):
+        """
+        Borrow pooled ssh connection to the box.
 
+        Args:
+        ip (str): address of the box
+        key_path (str): ssh key of the box
+        timeout (float): timeout of connect, ssh banner and authentication, pool default if not given
+        """
+
+        return ssh_pool.pool.connection(ip, 'admin', key_path, self.box_ssh_port, timeout)
+
+    @staticmethod
+    def run_box_command(client, command: str, timeout: float = 30) -> str:
+        """Run command on the box and return its stripped output."""
+
+        stdin, stdout, stderr = client.exec_command(command, timeout=timeout)
+        return str(stdout.read(), "utf-8").strip()
+
+    def check_box(self, box: Dict[str, str]) -> Tuple[bool, str]:
+        """
+        Read SV_VERSION of the box with short timeouts and store it in fleet state.
 
-    def upgrade(self):
-        """Upgrade STB"""
+        Args:
+        box (dict): box params taken from BOXES_LIST
 
-        client = pysftp.paramiko.SSHClient()
-        known_host_path = os.path.join('~', '.ssh', 'known_hosts')
-        client.load_host_keys(os.path.expanduser(known_host_path))
+        Returns:
+        tuple: (reachable, version), version is None if it could not be read
+        """
 
-        upgradeUrl = os.path.join(self.upgrade_base_url, self.project)
-        print('Upgrade STB with package {}\n'.format(upgradeUrl))
-        client.connect(self.ip, username='admin', key_filename=self.key_path, timeout=10)
+        ip = box['IP']
+        reachable, version = False, None
+        if box_readiness.is_ssh_ready(ip, self.box_ssh_port, self.preflight_timeout):
+            try:
+                with self.connect_box(ip, self.get_key_path(box), self.preflight_timeout) as client:
+                    version = self.run_box_command(client, self.SV_VERSION_COMMAND, self.preflight_timeout) or None
+                reachable = True
+            except Exception as error:
+                print('[{}] Pre-flight check failed: {}'.format(ip, error))
+
+        self.fleet_state.record(ip, REACHABLE if reachable else UNREACHABLE, version,
+                                PROJECT=box['PROJECT'], BRANCH=box['BRANCH'])
+        return reachable, version
+
+    def recorded_check(self, ip: str) -> Tuple[bool, str]:
+        """
+        Return (reachable, version) of the box from fleet state.
 
-        time.sleep(5)
-        client.exec_command('upgrade --with-gui --upgrade-server {}'.format(upgradeUrl))
+        Returns:
+        tuple: None if state is older than FLEET_STATE_MAX_AGE, missing or left by failed check or upgrade
+        """
 
-        print('Wait for upgrade and reboot')
-        time.sleep(120)
-        client.exec_command('/sbin/reboot')
-        client.close()
+        state = self.fleet_state.get(ip)
+        if state.get('RESULT') not in (REACHABLE, UPGRADED):
+            return None
+        if time.time() - state.get('CHECKED_AT', 0) > self.fleet_state_max_age:
+            return None
+        return True, state.get('VERSION')
 
-        print('Wait for activation and check upgrade status')
-        time.sleep(120)
-        client.connect(self.ip, username='admin', key_filename=self.key_path)
-        stdin, stdout, stderr = client.exec_command("/usr/local/bin/setnv | grep SV_VERSION | cut -d'=' -f2")
-        self.upgrade_succeed = True if stdout.readlines()[0].rstrip() == self.version_md5_hash else False
-        client.close()
+    def preflight(self, boxes: List[Dict[str, str]], use_recorded: bool = False) -> Dict[str, Tuple[bool, str]]:
+        """
+        Check all boxes concurrently, at most PREFLIGHT_WORKERS at a time.
 
-    def notify(self):
-        """Send email with confirmations"""
+        Args:
+        boxes (list): boxes params taken from BOXES_LIST
+        use_recorded (bool): take fresh state from fleet state, only boxes without it are checked
 
-        msg = MIMEMultipart()
+        Returns:
+        dict: (reachable, version) by box address
+        """
 
-        if (self.upgrade_succeed):
-            message='Software {} from branch: {} was installed succesfully on STB: {}! Software hash: {}.'.format(self.project, self.branch, self.ip, self.version_md5_hash)
+        checks = {}
+        if use_recorded:
+            for box in boxes:
+                check = self.recorded_check(box['IP'])
+                if check is not None:
+                    checks[box['IP']] = check
+            print('Pre-flight: {}/{} boxes taken from fleet state'.format(len(checks), len(boxes)))
+
+        unchecked = [box for box in boxes if box['IP'] not in checks]
+        if unchecked:
+            report_progress('preflight {} box(es)'.format(len(unchecked)))
+            workers = max(1, min(self.preflight_workers, len(unchecked)))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                checks.update(zip((box['IP'] for box in unchecked), executor.map(self.check_box, unchecked)))
+        print('Pre-flight: {}/{} boxes reachable'.format(sum(1 for reachable, version in checks.values()
+                                                             if reachable), len(checks)))
+        return checks
+
+    def upgrade(self, ip: str = None, key_path: str = None) -> bool:
+        """
+        Upgrade STB.
+
+        Every phase finishes as soon as the box reaches the awaited state
+        and fails when it does not happen before the phase deadline.
+        Observed phase durations are stored in phase_durations.
+
+        Args:
+        ip (str): address of the box, current box is used if not given
+        key_path (str): ssh key of the box, current key is used if not given
+
+        Returns:
+        bool: True if the box runs expected software after upgrade
+        """
+
+        ip = ip or self.ip
+        key_path = key_path or self.key_path
+        phases = OrderedDict()
+        self.phase_durations[ip] = phases
+
+        upgradeUrl = self.upgrade_url or os.path.join(self.upgrade_base_url, self.project)
+        print('[{}] Upgrade STB with package {}\n'.format(ip, upgradeUrl))
+        with self.connect_box(ip, key_path) as client:
+            boot_id = self.run_box_command(client, self.BOOT_ID_COMMAND)
+            start = time.time()
+            stdin, stdout, stderr = client.exec_command('upgrade --with-gui --upgrade-server {}'.format(upgradeUrl))
+
+            print('[{}] Wait for upgrade'.format(ip))
+            output = deque(maxlen=self.UPGRADE_OUTPUT_LINES)
+            box_readiness.wait_for_command_exit(stdout.channel, self.upgrade_timeout, 'upgrade on {}'.format(ip),
+                                                output)
+            exit_status = stdout.channel.recv_exit_status()
+            if exit_status != 0:
+                print('[{}] Upgrade exited with status {}, last output:'.format(ip, exit_status))
+                for line in output:
+                    print('[{}] {}'.format(ip, line))
+            box_readiness.wait_until(lambda: not self.run_box_command(client, 'pidof upgrade'),
+                                     max(self.upgrade_timeout - (time.time() - start), 0),
+                                     'upgrade process on {} to finish'.format(ip))
+            phases['upgrade'] = time.time() - start
+
+            print('[{}] Reboot'.format(ip))
+            client.exec_command('/sbin/reboot')
+            ssh_pool.pool.invalidate(ip)
+            try:
+                phases['reboot'] = box_readiness.wait_for_disconnect(client.get_transport(), self.reboot_timeout,
+                                                                     'ssh connection to {} to close'.format(ip))
+            except box_readiness.ReadinessTimeout as error:
+                print('[{}] {}, checking status anyway'.format(ip, error))
+
+        print('[{}] Wait for activation and check upgrade status'.format(ip))
+        phases['boot'] = box_readiness.wait_for_ssh_up(ip, self.boot_timeout, self.box_ssh_port)
+
+        # Changed boot id proves that the box rebooted, boxes without boot id are only checked for SV_VERSION.
+        version = []
+        def read_version() -> bool:
+            with self.connect_box(ip, key_path) as client:
+                if boot_id and self.run_box_command(client, self.BOOT_ID_COMMAND) == boot_id:
+                    return False
+                version.append(self.run_box_command(client, self.SV_VERSION_COMMAND))
+            return len(version[-1]) > 0
+
+        phases['activation'] = box_readiness.wait_until(read_version, self.activation_timeout,
+                                                        'reboot and SV_VERSION on {}'.format(ip), initial_delay=2.0)
+        upgrade_succeed = True if version[-1] == self.version_md5_hash else False
+        self.fleet_state.record(ip, UPGRADED if upgrade_succeed else FAILED, version[-1],
+                                PROJECT=self.project, BRANCH=self.branch)
+
+        print('[{}] Phase durations: {}'.format(ip, ', '.join('{}={:.0f}s'.format(phase, duration)
+                                                             for phase, duration in phases.items())))
+        for phase, duration in phases.items():
+            metrics.record('box_{}'.format(phase), duration, project=self.project, branch=self.branch, ip=ip,
+                           **self.job_labels)
+
+        if ip == self.ip:
+            self.upgrade_succeed = upgrade_succeed
+        return upgrade_succeed
+
+    def notify(self, ip: str = None, upgrade_succeed: bool = None):
+        """
+        Queue email with confirmation, it is sent in background.
+
+        Args:
+        ip (str): address of the box, current box is used if not given
+        upgrade_succeed (bool): upgrade status of the box, current status is used if not given
+        """
+
+        ip = ip or self.ip
+        upgrade_succeed = self.upgrade_succeed if upgrade_succeed is None else upgrade_succeed
+
+        if (upgrade_succeed):
+            message='Software {} from branch: {} was installed succesfully on STB: {}! Software hash: {}.'.format(self.project, self.branch, ip, self.version_md5_hash)
             subject="Automatic software upgrade SUCCEED"
         else:
-            message='Software {} from branch: {} was not installed successfully on STB: {}! Currently installed version is different to expected: {}.'.format(self.project, self.branch, self.ip, self.version_md5_hash)
+            message='Software {} from branch: {} was not installed successfully on STB: {}! Currently installed version is different to expected: {}.'.format(self.project, self.branch, ip, self.version_md5_hash)
             subject="Automatic software upgrade FAILED"
 
-        msg = MIMEMultipart()
+        self.notifier.send(self.from_mail_address, self.to_mail_address, subject, message)
+        print(message)
 
-        msg['From'] = self.from_mail_address
-        msg['To'] = self.to_mail_address
-        msg['Subject'] = subject
-        msg.attach(MIMEText(message, 'plain'))
+    def notify_digest(self, results: List[Dict], wall_clock_time: float):
+        """
+        Queue one email summarizing upgrade of all boxes.
 
-        server = SMTP()
-        server.connect()
-        server.sendmail(from_addr=self.from_mail_address, to_addrs=self.to_mail_address, msg=msg.as_string())
-        server.quit()
+        Args:
+        results (list): per box results of upgrade_all_boxes
+        wall_clock_time (float): duration of the whole run
+        """
 
-        print(message)
+        succeeded = sum(1 for result in results if result['SUCCEED'])
+        lines = ['Upgraded {}/{} boxes in {:.0f}s.'.format(succeeded, len(results), wall_clock_time), '']
+        for result in results:
+            lines.append('{} {} ({}) -> {} in {:.0f}s, software hash: {}'.format(
+                result['IP'], result['PROJECT'], result['BRANCH'], self.result_status(result),
+                result['DURATION'], result['VERSION']))
+            if result['PHASES']:
+                lines.append('    phases: {}'.format(', '.join('{}={:.0f}s'.format(phase, duration)
+                                                           for phase, duration in result['PHASES'].items())))
+            if result['ERROR']:
+                lines.append('    error: {}'.format(result['ERROR']))
+
+        status = 'SUCCEED' if succeeded == len(results) else 'FAILED'
+        subject = 'Automatic software upgrade {}: {}/{} boxes'.format(status, succeeded, len(results))
+        self.notifier.send(self.from_mail_address, self.to_mail_address, subject, '\n'.join(lines))
 
     def clean(self):
-        """Remove unneeded files"""
+        """
+        Remove unneeded files, sbuild directory is kept warm in incremental mode.
+        Staged package is released, it is removed by the staging store when no longer used.
+        """
 
-        self.call_command('rm {}'.format(self.local_arch_path))
-        self.call_command('rm -rf {}'.format(self.local_path))
-        self.call_command('rm -rf {}/{}'.format(self.upgrade_base_dir, self.project))
+        staged_hash, self.staged_hash, self.upgrade_url = self.staged_hash, None, None
+        if staged_hash is not None:
+            self.staging_store.release(staged_hash)
+        elif self.upgrade_type == 'rc' and self.project is not None:
+            self.call_command('rm -rf {}/{}'.format(self.upgrade_base_dir, self.project))
+        local_path, self.local_path = self.local_path, None
+        if local_path is not None and self.build_mode == CLEAN:
+            self.call_command('rm -rf {}'.format(local_path))
 
-    def upgrade_box(self, upgrade_params: Dict[str, str]):
-        self.project = upgrade_params['PROJECT']
-        self.branch = upgrade_params['BRANCH']
-        self.ip = upgrade_params['IP']
-        #self.key_path = upgrade_params['KEY_PATH']
+    @staticmethod
+    def get_key_path(upgrade_params: Dict[str, str]) -> str:
+        """
+        Get path to ssh key of the box.
+
+        Args:
+        upgrade_params (dict): box params, KEY_PATH is used if present
+        """
+
+        if upgrade_params.get('KEY_PATH'):
+            return upgrade_params['KEY_PATH']
 
         '''
         temporary hack, should be fix soon
         map project name to path
         '''
 
-        if 'millicom_prod' in self.project:
-            self.key_path = '/home/bgaik/.ssh/stbkeys/id_rsa_millicom'
-        elif 'millicom' in self.project:
-            self.key_path = '/home/bgaik/.ssh/stbkeys/id_rsa_dta'
-        elif 'qb' in self.project:
-            self.key_path = '/home/bgaik/.ssh/stbkeys/id_rsa_generic'
+        project = upgrade_params['PROJECT']
+        if 'millicom_prod' in project:
+            return '/home/bgaik/.ssh/stbkeys/id_rsa_millicom'
+        elif 'millicom' in project:
+            return '/home/bgaik/.ssh/stbkeys/id_rsa_dta'
+        elif 'qb' in project:
+            return '/home/bgaik/.ssh/stbkeys/id_rsa_generic'
+        return None
+
+    def upgrade_box(self, upgrade_params: Dict[str, str]):
+        self.project = upgrade_params['PROJECT']
+        self.branch = upgrade_params['BRANCH']
+        self.ip = upgrade_params['IP']
+        self.key_path = self.get_key_path(upgrade_params)
+        self.build_mode = self.check_build_mode(upgrade_params.get('BUILD_MODE') or self.default_build_mode)
 
         print('#'*60)
         print('Upgrade params:')
@@ -262,22 +573,213 @@ class Upgrader:
             if k and v: print('{} = {}'.format(k, v))
         print('#'*60)
 
-        self.prepare()
-        self.build()
-        self.copy()
-        self.upgrade()
-        self.notify()
-        self.clean()
+        with work_dir_lock(self.get_base_dir()):
+            try:
+                for phase in (self.prepare, self.build, self.copy, self.upgrade, self.notify):
+                    report_progress(phase.__name__)
+                    with self.span(phase.__name__, self.ip):
+                        phase()
+            finally:
+                report_progress('clean')
+                with self.span('clean', self.ip):
+                    self.clean()
+
+    @staticmethod
+    def group_boxes(boxes: List[Dict[str, str]]) -> Dict[Tuple[str, str], List[Dict[str, str]]]:
+        """
+        Group boxes which can be upgraded with the same build.
+
+        Args:
+        boxes (list): boxes params taken from BOXES_LIST
+
+        Returns:
+        dict: boxes grouped by (PROJECT, BRANCH), in order of first appearance
+        """
+
+        groups = OrderedDict()
+        for box in boxes:
+            groups.setdefault((box['PROJECT'], box['BRANCH']), []).append(box)
+        return groups
+
+    def upgrade_group_box(self, box: Dict[str, str]) -> Dict:
+        """
+        Upgrade single box with software already built and staged for its group.
+
+        Args:
+        box (dict): box params taken from BOXES_LIST
+
+        Returns:
+        dict: upgrade result of the box
+        """
+
+        result = {'PROJECT': self.project, 'BRANCH': self.branch, 'IP': box['IP'],
+                  'VERSION': self.version_md5_hash, 'SUCCEED': False, 'SKIPPED': None, 'ERROR': None}
+        start = time.time()
+        try:
+            with self.span('upgrade', box['IP']):
+                result['SUCCEED'] = self.upgrade(box['IP'], self.get_key_path(box))
+            if self.notify_mode == PER_BOX:
+                with self.span('notify', box['IP']):
+                    self.notify(box['IP'], result['SUCCEED'])
+        except Exception as error:
+            print('[{}] Upgrade failed: {}'.format(box['IP'], error))
+            result['ERROR'] = str(error)
+            self.fleet_state.record(box['IP'], FAILED, PROJECT=self.project, BRANCH=self.branch)
+        result['DURATION'] = time.time() - start
+        result['PHASES'] = dict(self.phase_durations.get(box['IP'], {}))
+        return result
+
+    @staticmethod
+    def skipped_result(box: Dict[str, str], reason: str, succeed: bool, version: str = None,
+                       error: str = None) -> Dict:
+        return {'PROJECT': box['PROJECT'], 'BRANCH': box['BRANCH'], 'IP': box['IP'], 'VERSION': version,
+                'SUCCEED': succeed, 'SKIPPED': reason, 'ERROR': error, 'DURATION': 0.0, 'PHASES': {}}
+
+    @staticmethod
+    def result_status(result: Dict) -> str:
+        if result.get('SKIPPED'):
+            return 'SKIPPED ({})'.format(result['SKIPPED'])
+        return 'SUCCEED' if result['SUCCEED'] else 'FAILED'
+
+    def upgrade_group(self, project: str, branch: str, boxes: List[Dict[str, str]],
+                      checks: Dict[str, Tuple[bool, str]] = None) -> List[Dict]:
+        """
+        Build and stage project once, then upgrade all boxes of the group concurrently.
+
+        With pre-flight results unreachable boxes are skipped before building and boxes
+        already running the built version are skipped before staging.
+
+        Args:
+        project (str): project shared by the boxes
+        branch (str): branch shared by the boxes
+        boxes (list): boxes params taken from BOXES_LIST
+        checks (dict): pre-flight (reachable, version) by box address
+
+        Returns:
+        list: upgrade results of all boxes in the group
+        """
+
+        self.project = project
+        self.branch = branch
+        self.ip = None
+        self.version_md5_hash = None
+        build_modes = set(self.check_build_mode(box.get('BUILD_MODE') or self.default_build_mode) for box in boxes)
+        self.build_mode = INCREMENTAL if build_modes == {INCREMENTAL} else CLEAN
+
+        skipped = []
+        if checks is not None:
+            skipped = [self.skipped_result(box, UNREACHABLE, False, error='Box not reachable in pre-flight check')
+                       for box in boxes if not checks[box['IP']][0]]
+            boxes = [box for box in boxes if checks[box['IP']][0]]
+        if not boxes:
+            print('No reachable boxes with project {} from branch {}'.format(project, branch))
+            return skipped
+
+        print('#'*60)
+        print('Upgrade {} box(es) with project {} from branch {} ({} build):'.format(len(boxes), project, branch,
+                                                                                    self.build_mode))
+        for box in boxes:
+            print(box['IP'])
+        print('#'*60)
+
+        try:
+            for phase in (self.prepare, self.build):
+                report_progress('{} {}'.format(project, phase.__name__))
+                with self.span(phase.__name__):
+                    phase()
+
+            if checks is not None and self.skip_up_to_date:
+                skipped += [self.skipped_result(box, UP_TO_DATE, True, self.version_md5_hash)
+                            for box in boxes if checks[box['IP']][1] == self.version_md5_hash]
+                boxes = [box for box in boxes if checks[box['IP']][1] != self.version_md5_hash]
+
+            if boxes:
+                report_progress('{} copy'.format(project))
+                with self.span('copy'):
+                    self.copy()
+        except Exception as error:
+            print('Preparing software for {} failed: {}'.format(project, error))
+            self.clean()
+            return skipped + [{'PROJECT': project, 'BRANCH': branch, 'IP': box['IP'], 'VERSION': None,
+                               'SUCCEED': False, 'SKIPPED': None, 'ERROR': str(error), 'DURATION': 0.0,
+                               'PHASES': {}}
+                              for box in boxes]
+
+        results = []
+        try:
+            if boxes:
+                report_progress('{} upgrade {} box(es)'.format(project, len(boxes)))
+                workers = max(1, min(self.max_parallel_upgrades, len(boxes)))
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    results = list(executor.map(self.upgrade_group_box, boxes))
+            else:
+                print('All reachable boxes already run {} {}'.format(project, self.version_md5_hash))
+        finally:
+            with self.span('clean'):
+                self.clean()
+        return skipped + results
+
+    def upgrade_all_boxes(self) -> Dict:
+        """
+        Upgrade all boxes from BOXES_LIST.
+
+        All boxes are checked concurrently first, unreachable ones and those already
+        running the built software are skipped. With PREFLIGHT disabled state recorded in fleet state
+        is used instead, only boxes without fresh state are checked. Boxes are grouped by (PROJECT, BRANCH), every group
+        is built and staged once and its boxes are upgraded in parallel, at most MAX_PARALLEL_UPGRADES
+        at a time. With NOTIFY_MODE digest one summary email is sent instead of email per box.
+
+        Returns:
+        dict: per box results, pre-flight counts and wall-clock time of the whole run
+        """
 
-    def upgrade_all_boxes(self):
         self.upgrade_type = 'all'
-        for box in self.all_boxes:
-            self.upgrade_box(box)
+        start = time.time()
+        checks = None
+        if self.all_boxes:
+            with self.span('preflight'):
+                checks = self.preflight(self.all_boxes, use_recorded=not self.preflight_enabled)
+
+        results = []
+        for (project, branch), boxes in self.group_boxes(self.all_boxes).items():
+            with work_dir_lock(os.path.join(self.work_dir, branch)):
+                results.extend(self.upgrade_group(project, branch, boxes, checks))
+        wall_clock_time = time.time() - start
+
+        preflight = {'CHECKED': len(checks) if checks is not None else 0,
+                     'REACHABLE': sum(1 for reachable, version in (checks or {}).values() if reachable),
+                     'SKIPPED_UNREACHABLE': sum(1 for r in results if r['SKIPPED'] == UNREACHABLE),
+                     'SKIPPED_UP_TO_DATE': sum(1 for r in results if r['SKIPPED'] == UP_TO_DATE),
+                     'UPGRADED': sum(1 for r in results if r['SKIPPED'] is None)}
+
+        print('#'*60)
+        print('Upgrade summary:')
+        for result in results:
+            print('{} {} ({}) -> {} in {:.0f}s'.format(result['IP'], result['PROJECT'], result['BRANCH'],
+                                                      self.result_status(result), result['DURATION']))
+        print('Upgraded {}/{} boxes in {:.0f}s'.format(sum(1 for r in results if r['SUCCEED'] and not r['SKIPPED']),
+                                                     preflight['UPGRADED'], wall_clock_time))
+        print('Reachable {}/{} boxes, skipped {} up to date and {} unreachable'.format(
+            preflight['REACHABLE'], preflight['CHECKED'], preflight['SKIPPED_UP_TO_DATE'],
+            preflight['SKIPPED_UNREACHABLE']))
+        print('#'*60)
+
+        if self.notify_mode == DIGEST:
+            with self.span('notify'):
+                self.notify_digest(results, wall_clock_time)
+
+        return {'RESULTS': results, 'WALL_CLOCK_TIME': wall_clock_time, 'PREFLIGHT': preflight,
+                'SSH_CONNECTIONS': ssh_pool.pool.stats(), 'NOTIFICATIONS': self.notifier.stats(),
+                'STAGING': self.staging_store.stats()}
 
     def upgrade_box_with_local_sbuild(self, upgrade_params: Dict[str, str]):
         self.upgrade_type = 'local'
         self.upgrade_box(upgrade_params)
 
+    def upgrade_box_with_rc(self, upgrade_params: Dict[str, str]):
+        self.upgrade_type = 'rc'
+        self.upgrade_box(dict(upgrade_params, BRANCH=upgrade_params.get('BRANCH', '')))
+
     @staticmethod
     def helper():
         epilog=textwrap.dedent('''\
@@ -326,6 +828,7 @@ def main():
         upgrader.upgrade_box_with_local_sbuild(upgrade_params)
     else:
         assert(False)
+    upgrader.notifier.flush()
 
 if __name__ == "__main__":
     main()
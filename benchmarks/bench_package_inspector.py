@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+
+"""
+Micro-benchmark of upgrade package inspection.
+
+Compares shell pipelines previously used by Builder.build and Upgrader.build
+(tar -ztf | grep md5$, then tar -O -zxf | head | awk) with package_inspector
+on a synthetic upgrade package.
+"""
+
+import argparse
+import io
+import os
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from package_inspector import extract_files, inspect_package
+
+
+def add_file(archive: tarfile.TarFile, name: str, data: bytes):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = int(time.time())
+    archive.addfile(info, io.BytesIO(data))
+
+
+def make_package(path: str, size_mb: int, files: int, md5_position: str):
+    """Create synthetic upgrade package with random payload and md5 file."""
+
+    md5_data = b'0123456789abcdef0123456789abcdef  payload.bin\n'
+    chunk = size_mb * 1024 * 1024 // files
+    with tarfile.open(path, 'w:gz', compresslevel=1) as archive:
+        if md5_position == 'start':
+            add_file(archive, 'upgrade/version.md5', md5_data)
+        for i in range(files):
+            add_file(archive, 'upgrade/payload_{:03d}.bin'.format(i), os.urandom(chunk))
+        add_file(archive, 'upgrade/BOOTIMAGE.bin', os.urandom(1024 * 1024))
+        add_file(archive, 'upgrade/LOGO.bin', os.urandom(64 * 1024))
+        if md5_position == 'end':
+            add_file(archive, 'upgrade/version.md5', md5_data)
+
+
+def inspect_with_subprocess(upgrade_package: str) -> str:
+    cmd = 'tar -ztf {} | grep "md5$"'.format(upgrade_package)
+    ps = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, shell=True)
+    upgrade_file = str(ps.communicate()[0], "utf-8").rstrip("\n")
+
+    cmd = "tar -O -zxf {} {} | head -n 1 | awk '{{print $1}}'".format(upgrade_package, upgrade_file)
+    ps = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, shell=True)
+    return str(ps.communicate()[0], "utf-8").rstrip("\n")
+
+
+def measure(name: str, function, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    print('{:<28} best {:7.3f}s  median {:7.3f}s  -> {}'.format(name, timings[0], timings[len(timings) // 2], result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark upgrade package inspection.')
+    parser.add_argument('--size-mb', type=int, default=200)
+    parser.add_argument('--files', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--md5-position', choices=['start', 'end'], default='end')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        package = os.path.join(tmp_dir, 'project-upgrade-CURRENT.tgz')
+        print('Generating {} MB package, md5 at {} ...'.format(args.size_mb, args.md5_position))
+        make_package(package, args.size_mb, args.files, args.md5_position)
+
+        measure('subprocess tar pipelines', lambda: inspect_with_subprocess(package), args.repeat)
+        measure('inspect_package', lambda: inspect_package(package).version_md5_hash, args.repeat)
+        measure('extract_files BOOTIMAGE, LOGO',
+                lambda: sorted(extract_files(package, ['*BOOTIMAGE*', '*LOGO*'], tmp_dir)), args.repeat)
+
+
+if __name__ == '__main__':
+    main()
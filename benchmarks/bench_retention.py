@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+
+"""
+Benchmark of nightly build retention.
+
+Compares per-entry listdir/stat/walk scanning with sequential rm -rf calls
+(the approach of the old Builder.remove_oldest_packages) with RetentionSweeper
+on a synthetic tree of build directories.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from retention import RetentionSweeper
+
+
+def make_tree(root: str, builds: int, files: int, file_size: int):
+    """Create build directories with mtimes spread over the last builds days."""
+
+    now = time.time()
+    payload = b'x' * file_size
+    for i in range(builds):
+        build_dir = os.path.join(root, 'build_{:05d}'.format(i))
+        for variant in ('Debug', 'Secure'):
+            variant_dir = os.path.join(build_dir, variant, 'USBRecovery')
+            os.makedirs(variant_dir)
+            for j in range(files):
+                with open(os.path.join(variant_dir, 'file_{}.bin'.format(j)), 'wb') as f:
+                    f.write(payload)
+        mtime = now - (builds - i) * 24 * 3600
+        os.utime(build_dir, (mtime, mtime))
+
+
+def naive_sweep(root: str, max_age_days: float, dry_run: bool) -> int:
+    """Old approach: stat every entry separately, measure size with os.walk, delete one by one."""
+
+    current_time = time.time()
+    reclaimable = 0
+    for d in os.listdir(root):
+        dir_path = os.path.join(root, d)
+        if not os.path.isdir(dir_path):
+            continue
+        if (current_time - os.stat(dir_path).st_mtime) // (24 * 3600) >= max_age_days:
+            for walk_root, dirs, files in os.walk(dir_path):
+                reclaimable += sum(os.path.getsize(os.path.join(walk_root, name)) for name in files)
+            if not dry_run:
+                os.system("rm -rf {}".format(dir_path))
+    return reclaimable
+
+
+def measure(name: str, function):
+    start = time.perf_counter()
+    result = function()
+    print('{:<36} {:8.3f}s  -> {}'.format(name, time.perf_counter() - start, result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark nightly build retention.')
+    parser.add_argument('--builds', type=int, default=2000)
+    parser.add_argument('--files', type=int, default=5)
+    parser.add_argument('--file-size', type=int, default=4096)
+    parser.add_argument('--max-age-days', type=float, default=7)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        naive_root = os.path.join(tmp_dir, 'naive')
+        sweeper_root = os.path.join(tmp_dir, 'sweeper')
+        print('Generating {} build directories ...'.format(args.builds))
+        make_tree(naive_root, args.builds, args.files, args.file_size)
+        shutil.copytree(naive_root, sweeper_root)
+        for entry in os.scandir(naive_root):
+            stat = entry.stat()
+            os.utime(os.path.join(sweeper_root, entry.name), (stat.st_atime, stat.st_mtime))
+
+        measure('naive dry run (age)', lambda: naive_sweep(naive_root, args.max_age_days, True))
+        measure('sweeper dry run (age)',
+                lambda: RetentionSweeper(sweeper_root, args.max_age_days, dry_run=True).sweep()['RECLAIMABLE_BYTES'])
+        measure('sweeper dry run (age + quota)',
+                lambda: RetentionSweeper(sweeper_root, args.max_age_days, 0.001,
+                                         dry_run=True).sweep()['RECLAIMABLE_BYTES'])
+        measure('naive delete (age)', lambda: naive_sweep(naive_root, args.max_age_days, False))
+        measure('sweeper delete (age)',
+                lambda: RetentionSweeper(sweeper_root, args.max_age_days).sweep()['RECLAIMABLE_BYTES'])
+
+
+if __name__ == '__main__':
+    main()
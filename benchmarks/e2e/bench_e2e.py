@@ -0,0 +1,320 @@
+#!/usr/bin/python3
+
+"""
+End-to-end benchmark of Upgrader and Builder.
+
+Everything the pipeline talks to is replaced by local stand-ins: nosilo and
+pysilo executables from bin/, in-process ssh servers for the lab server
+(127.0.0.1) and STBs (127.0.0.2 ...), SMTP sink and fake Jira. Upgrader
+upgrades 1, 10 and 100 boxes (see --boxes) and Builder builds one nightly
+project; throughput, latency percentiles, phase breakdown and peak memory
+are reported.
+
+Example:
+python3 benchmarks/e2e/bench_e2e.py --boxes 1 10 --build-seconds 2 --json results.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+E2E_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, E2E_DIR)
+sys.path.insert(0, os.path.join(E2E_DIR, '..', '..'))
+
+import paramiko
+from fake_services import FakeJira, SMTPSink
+from fake_ssh import FakeBox, FakeLabServer
+
+PROJECT = 'qb-bench-debug'
+SECURE_PROJECT = 'qb-bench-secure'
+BRANCH = '4627'
+UPGRADE_BASE_URL = 'http://127.0.0.1/upgrade/auto_upgrade'
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(fraction * (len(values) - 1)))))
+    return values[index]
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    return {'P50': percentile(values, 0.5), 'P90': percentile(values, 0.9), 'P99': percentile(values, 0.99),
+            'MAX': max(values, default=0.0)}
+
+
+def peak_rss_mb() -> Dict[str, float]:
+    """Peak resident memory of the benchmark process and of its (waited) children."""
+
+    return {'SELF': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'CHILDREN': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024}
+
+
+def read_spans(spans_file: str, since: float) -> Dict[str, Dict[str, float]]:
+    """Aggregate spans written after since by phase."""
+
+    durations = defaultdict(list)
+    if os.path.exists(spans_file):
+        with open(spans_file) as f:
+            for line in f:
+                span = json.loads(line)
+                if span['start'] >= since:
+                    durations[span['phase']].append(span['duration'])
+    return {phase: dict(summarize(values), COUNT=len(values), TOTAL=sum(values))
+            for phase, values in sorted(durations.items())}
+
+
+class Lab:
+    """Temporary directory tree, fake executables and servers shared by all runs."""
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.root = tempfile.mkdtemp(prefix='upgrader-e2e-')
+        self.home = os.path.join(self.root, 'home')
+        self.upgrade_base_dir = os.path.join(self.root, 'www', 'auto_upgrade')
+        self.spans_file = os.path.join(self.root, 'spans.jsonl')
+        for path in (self.home, self.upgrade_base_dir, os.path.join(self.root, 'lab', 'sbuilds')):
+            os.makedirs(path)
+
+        os.environ['HOME'] = self.home
+        os.environ['PATH'] = '{}{}{}'.format(os.path.join(E2E_DIR, 'bin'), os.pathsep, os.environ['PATH'])
+        os.environ.update({'FAKE_PULL_SECONDS': str(args.pull_seconds),
+                           'FAKE_BUILD_SECONDS': str(args.build_seconds),
+                           'FAKE_SBUILD_FILES': str(args.sbuild_files),
+                           'FAKE_SBUILD_FILE_KB': str(args.sbuild_file_kb),
+                           'FAKE_PACKAGE_MB': str(args.package_mb)})
+
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.client_key_path = os.path.join(self.home, '.ssh', 'id_rsa_bench')
+        os.makedirs(os.path.dirname(self.client_key_path))
+        paramiko.RSAKey.generate(2048).write_private_key_file(self.client_key_path)
+
+        self.lab_server = FakeLabServer('127.0.0.1', args.lab_port, self.host_key)
+        self.lab_server.start()
+        self.boxes: List[FakeBox] = []
+        self.smtp = SMTPSink()
+        self.smtp.start()
+        self.jira = FakeJira(tasks=args.jira_tasks, comments=args.jira_comments)
+        self.jira.start()
+        self.known_hosts = ['127.0.0.1']
+
+        from instrumentation import metrics
+        metrics.configure({'SPANS_FILE': self.spans_file})
+
+    def write_known_hosts(self):
+        with open(os.path.join(self.home, '.ssh', 'known_hosts'), 'w') as f:
+            for host in self.known_hosts:
+                port = self.args.lab_port if host == '127.0.0.1' else self.args.box_port
+                f.write('[{}]:{} {} {}\n'.format(host, port, self.host_key.get_name(), self.host_key.get_base64()))
+
+    def ensure_boxes(self, count: int) -> List[FakeBox]:
+        while len(self.boxes) < count:
+            index = len(self.boxes) + 2
+            address = '127.0.{}.{}'.format(index // 250, index % 250 + 1)
+            box = FakeBox(address, self.args.box_port, self.host_key, {UPGRADE_BASE_URL: self.upgrade_base_dir},
+                          self.args.upgrade_seconds, self.args.shutdown_seconds, self.args.boot_seconds,
+                          self.args.activation_seconds)
+            box.start()
+            self.boxes.append(box)
+            self.known_hosts.append(address)
+        self.write_known_hosts()
+        return self.boxes[:count]
+
+    def upgrade_config(self, boxes: List[FakeBox]) -> Dict:
+        return {'WORK_DIR': os.path.join(self.root, 'work'),
+                'REMOTE_LOCATION': os.path.join(self.root, 'lab', 'sbuilds'),
+                'SERVER': '127.0.0.1',
+                'SERVER_PORT': self.args.lab_port,
+                'USERNAME': 'cubiware',
+                'LAB_KEY_PATH': self.client_key_path,
+                'UPGRADE_BASE_DIR': self.upgrade_base_dir,
+                'UPGRADE_BASE_URL': UPGRADE_BASE_URL,
+                'TO_MAIL_ADDRESS': 'lab@example.com',
+                'FROM_MAIL_ADDRESS': 'bench@example.com',
+                'SMTP_HOST': '127.0.0.1',
+                'SMTP_PORT': self.smtp.server_address[1],
+                'NOTIFY_MODE': self.args.notify_mode,
+                'MAX_PARALLEL_UPGRADES': self.args.max_parallel_upgrades,
+                'UPGRADE_TIMEOUT': 60,
+                'REBOOT_TIMEOUT': 30,
+                'BOOT_TIMEOUT': 60,
+                'ACTIVATION_TIMEOUT': 60,
+                'BOX_SSH_PORT': self.args.box_port,
+                'BUILD_MODE': self.args.build_mode,
+                'FLEET_STATE_FILE': os.path.join(self.root, 'fleet_state.json'),
+                'PREFLIGHT': not self.args.no_preflight,
+                'PREFLIGHT_TIMEOUT': 2,
+                'BOXES_LIST': [{'PROJECT': PROJECT, 'BRANCH': BRANCH, 'IP': box.address,
+                                'KEY_PATH': self.client_key_path} for box in boxes] +
+                              [{'PROJECT': PROJECT, 'BRANCH': BRANCH, 'IP': '127.1.0.{}'.format(i + 1),
+                                'KEY_PATH': self.client_key_path} for i in range(self.args.unreachable_boxes)]}
+
+    def nightly_config(self) -> Dict:
+        return {'DEBUG_PROJECT': PROJECT,
+                'SECURE_PROJECT': SECURE_PROJECT,
+                'WORK_DIR': os.path.join(self.root, 'nightly'),
+                'BRANCH': BRANCH,
+                'GENERATE_USB_RECOVERY': True,
+                'DEBUG_LOGO_FILENAME': 'debug_logo.bin',
+                'DEBUG_BOOTIMAGE_FILENAME': 'debug_bootimage.bin',
+                'SECURE_LOGO_FILENAME': 'secure_logo.bin',
+                'SECURE_BOOTIMAGE_FILENAME': 'secure_bootimage.bin',
+                'REMOTE_LOCATION': os.path.join(self.root, 'nightly_remote'),
+                'REMOVE_FILES_AFTER_DAYS': '7',
+                'PARALLEL_BUILDS': self.args.parallel_builds,
+                'BUILD_MODE': self.args.build_mode}
+
+    def jira_config(self) -> Dict:
+        return {'SERVER_ADDRESS': self.jira.base_url, 'USER': 'bench', 'PASSWORD': 'bench',
+                'CHANGELOG_TAG': self.jira.changelog, 'PROJECT_TAG': self.jira.project}
+
+    def close(self):
+        for box in self.boxes:
+            box.stop()
+        self.lab_server.stop()
+        self.smtp.shutdown()
+        self.jira.shutdown()
+        if not self.args.keep:
+            shutil.rmtree(self.root, ignore_errors=True)
+
+
+def run_upgrade(lab: Lab, count: int) -> Dict:
+    from UpgraderInstance import Upgrader
+
+    boxes = lab.ensure_boxes(count)
+    messages = lab.smtp.messages
+    start = time.time()
+    upgrader = Upgrader(lab.upgrade_config(boxes))
+    report = upgrader.upgrade_all_boxes()
+    upgrader.notifier.flush(30)
+    wall_clock_time = time.time() - start
+
+    results = report['RESULTS']
+    durations = [result['DURATION'] for result in results if not result['SKIPPED']]
+    succeeded = sum(1 for result in results if result['SUCCEED'])
+    return {'BOXES': count,
+            'SUCCEEDED': succeeded,
+            'WALL_CLOCK_TIME': wall_clock_time,
+            'THROUGHPUT_BOXES_PER_MIN': 60 * succeeded / wall_clock_time,
+            'BOX_LATENCY': summarize(durations),
+            'PHASES': read_spans(lab.spans_file, start),
+            'MAILS': lab.smtp.messages - messages,
+            'PREFLIGHT': report['PREFLIGHT'],
+            'SSH_CONNECTIONS': report['SSH_CONNECTIONS'],
+            'STAGING': report['STAGING'],
+            'PEAK_RSS_MB': peak_rss_mb()}
+
+
+def run_nightly(lab: Lab) -> Dict:
+    from nightly_build import Builder
+
+    requests = sum(lab.jira.requests.values())
+    lab.jira.add_comment('Changeset bench: {}'.format(' '.join(sorted(lab.jira.issues)[:5])))
+    start = time.time()
+    try:
+        Builder(lab.nightly_config(), lab.jira_config()).build_nightly_projects()
+    except SystemExit as error:
+        if error.code:
+            raise
+    wall_clock_time = time.time() - start
+    return {'WALL_CLOCK_TIME': wall_clock_time,
+            'PHASES': read_spans(lab.spans_file, start),
+            'JIRA_REQUESTS': sum(lab.jira.requests.values()) - requests,
+            'PEAK_RSS_MB': peak_rss_mb()}
+
+
+def print_report(name: str, report: Dict):
+    print('=' * 72)
+    print(name)
+    for key, value in report.items():
+        if key == 'PHASES':
+            print('  PHASES:')
+            for phase, stats in value.items():
+                print('    {:<16} n={:<4} total={:8.2f}s p50={:7.2f}s p90={:7.2f}s max={:7.2f}s'.format(
+                    phase, stats['COUNT'], stats['TOTAL'], stats['P50'], stats['P90'], stats['MAX']))
+        elif isinstance(value, float):
+            print('  {}: {:.2f}'.format(key, value))
+        else:
+            print('  {}: {}'.format(key, value))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end benchmark of Upgrader and Builder.')
+    parser.add_argument('--boxes', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--skip-nightly', action='store_true')
+    parser.add_argument('--concurrent', action='store_true',
+                        help='run nightly build in parallel with upgrades, phases of both are reported together')
+    parser.add_argument('--build-mode', choices=['clean', 'incremental'], default='clean')
+    parser.add_argument('--unreachable-boxes', type=int, default=0,
+                        help='also list this many boxes which do not answer on ssh')
+    parser.add_argument('--no-preflight', action='store_true',
+                        help='plan upgrades from recorded fleet state, check only boxes without fresh state')
+    parser.add_argument('--notify-mode', choices=['per_box', 'digest'], default='per_box')
+    parser.add_argument('--parallel-builds', action='store_true')
+    parser.add_argument('--max-parallel-upgrades', type=int, default=16)
+    parser.add_argument('--lab-port', type=int, default=2221)
+    parser.add_argument('--box-port', type=int, default=2222)
+    parser.add_argument('--pull-seconds', type=float, default=1.0)
+    parser.add_argument('--build-seconds', type=float, default=5.0)
+    parser.add_argument('--sbuild-files', type=int, default=50)
+    parser.add_argument('--sbuild-file-kb', type=int, default=256)
+    parser.add_argument('--package-mb', type=float, default=8)
+    parser.add_argument('--upgrade-seconds', type=float, default=2.0)
+    parser.add_argument('--shutdown-seconds', type=float, default=0.5)
+    parser.add_argument('--boot-seconds', type=float, default=3.0)
+    parser.add_argument('--activation-seconds', type=float, default=1.0)
+    parser.add_argument('--jira-tasks', type=int, default=50)
+    parser.add_argument('--jira-comments', type=int, default=10)
+    parser.add_argument('--tracemalloc', action='store_true', help='also report peak Python heap (slower)')
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--keep', action='store_true', help='keep temporary directory')
+    args = parser.parse_args()
+
+    logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+    if args.tracemalloc:
+        tracemalloc.start()
+    lab = Lab(args)
+    print('Lab in {}'.format(lab.root))
+    results = {'UPGRADE': [], 'NIGHTLY': None}
+    executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        nightly = None
+        if args.concurrent and not args.skip_nightly:
+            nightly = executor.submit(run_nightly, lab)
+        for count in args.boxes:
+            report = run_upgrade(lab, count)
+            if args.tracemalloc:
+                report['PEAK_HEAP_MB'] = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+                tracemalloc.reset_peak()
+            results['UPGRADE'].append(report)
+        if not args.skip_nightly:
+            results['NIGHTLY'] = nightly.result() if nightly is not None else run_nightly(lab)
+            if args.tracemalloc:
+                results['NIGHTLY']['PEAK_HEAP_MB'] = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+    finally:
+        executor.shutdown()
+        lab.close()
+
+    for report in results['UPGRADE']:
+        print_report('Upgrade of {} box(es)'.format(report['BOXES']), report)
+    if results['NIGHTLY'] is not None:
+        print_report('Nightly build', results['NIGHTLY'])
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+#!/usr/bin/python3
+
+"""
+Local stand-ins of SMTP server and Jira REST API used by the end-to-end benchmark.
+"""
+
+import json
+import re
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+from urllib.parse import parse_qs, urlparse
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    """Minimal SMTP dialogue, accepted messages are counted by the server."""
+
+    def reply(self, line: str):
+        self.wfile.write('{}\r\n'.format(line).encode('ascii'))
+
+    def handle(self):
+        self.reply('220 sink ESMTP')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = str(line, 'utf-8', 'replace').strip().upper()
+            if command.startswith('EHLO') or command.startswith('HELO'):
+                self.reply('250 sink')
+            elif command == 'DATA':
+                self.reply('354 end with <CRLF>.<CRLF>')
+                size = 0
+                for data in iter(self.rfile.readline, b''):
+                    if data in (b'.\r\n', b'.\n'):
+                        break
+                    size += len(data)
+                self.server.record(size)
+                self.reply('250 queued')
+            elif command == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    """SMTP server which accepts and drops all messages."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address: str = '127.0.0.1', port: int = 0):
+        super().__init__((address, port), SMTPSinkHandler)
+        self.lock = threading.Lock()
+        self.messages = 0
+        self.bytes = 0
+
+    def record(self, size: int):
+        with self.lock:
+            self.messages += 1
+            self.bytes += size
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+class FakeJiraHandler(BaseHTTPRequestHandler):
+    """Subset of Jira REST API v2 used by JiraInstance."""
+
+    def send_json(self, data, status: int = 200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def do_GET(self):
+        jira = self.server
+        url = urlparse(self.path)
+        params = {name: values[0] for name, values in parse_qs(url.query).items()}
+        path = url.path.split('/rest/api/2/', 1)[-1]
+        jira.count('GET {}'.format(path.split('/')[0]))
+
+        if path == 'serverInfo':
+            self.send_json({'baseUrl': jira.base_url, 'version': '8.20.0', 'versionNumbers': [8, 20, 0],
+                            'deploymentType': 'Server'})
+        elif path == 'field':
+            self.send_json([{'id': 'fixVersions', 'name': 'Fix Version/s', 'custom': False}])
+        elif re.match(r'issue/[^/]+/comment$', path):
+            start_at = int(params.get('startAt', 0))
+            max_results = int(params.get('maxResults', 50))
+            comments = jira.comments[start_at:start_at + max_results]
+            self.send_json({'startAt': start_at, 'maxResults': max_results, 'total': len(jira.comments),
+                            'comments': comments})
+        elif path == 'search':
+            keys = re.findall(r'[A-Z][A-Z0-9]*-\d+', params.get('jql', ''))
+            start_at = int(params.get('startAt', 0))
+            issues = [jira.issue_json(key) for key in keys if key in jira.issues]
+            self.send_json({'startAt': start_at, 'maxResults': len(issues), 'total': len(issues),
+                            'issues': issues[start_at:]})
+        elif path.startswith('project/'):
+            key = path.split('/')[1]
+            self.send_json({'id': '10000', 'key': key, 'name': key, 'self': jira.api_url(path)})
+        elif path.startswith('issue/'):
+            key = path.split('/')[1]
+            if key not in jira.issues:
+                self.send_json({'errorMessages': ['Issue does not exist']}, 404)
+            else:
+                self.send_json(jira.issue_json(key))
+        else:
+            self.send_json({'errorMessages': ['Not implemented: {}'.format(path)]}, 404)
+
+    def do_POST(self):
+        jira = self.server
+        path = urlparse(self.path).path.split('/rest/api/2/', 1)[-1]
+        jira.count('POST {}'.format(path.split('/')[0]))
+        data = self.read_json()
+        if path == 'version':
+            with jira.lock:
+                jira.versions.append(data['name'])
+                version_id = len(jira.versions)
+            self.send_json(dict(data, id=str(version_id), self=jira.api_url('version/{}'.format(version_id))), 201)
+        else:
+            self.send_json({'errorMessages': ['Not implemented: {}'.format(path)]}, 404)
+
+    def do_PUT(self):
+        jira = self.server
+        path = urlparse(self.path).path.split('/rest/api/2/', 1)[-1]
+        jira.count('PUT {}'.format(path.split('/')[0]))
+        data = self.read_json()
+        key = path.split('/')[1] if path.startswith('issue/') else None
+        if key not in jira.issues:
+            self.send_json({'errorMessages': ['Issue does not exist']}, 404)
+            return
+        with jira.lock:
+            for operation in data.get('update', {}).get('fixVersions', []):
+                if 'add' in operation:
+                    jira.issues[key].append(operation['add']['name'])
+        self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeJira(ThreadingHTTPServer):
+    """
+    Jira with one changelog issue and tasks referenced from its comments.
+
+    Args:
+    project (str): key of the tasks project
+    changelog (str): key of the changelog issue
+    tasks (int): number of tasks referenced from the changelog
+    comments (int): number of changelog comments
+    """
+
+    daemon_threads = True
+
+    def __init__(self, project: str = 'CUB12', changelog: str = 'CUBCI-1', tasks: int = 50, comments: int = 10,
+                 address: str = '127.0.0.1', port: int = 0):
+        super().__init__((address, port), FakeJiraHandler)
+        self.base_url = 'http://{}:{}'.format(*self.server_address[:2])
+        self.project = project
+        self.changelog = changelog
+        self.lock = threading.Lock()
+        self.requests: Dict[str, int] = {}
+        self.versions: List[str] = []
+        self.issues: Dict[str, List[str]] = {'{}-{}'.format(project, i + 1): [] for i in range(tasks)}
+        keys = sorted(self.issues)
+        self.comments = []
+        for i in range(comments):
+            body = 'Changeset {}: {}'.format(i, ' '.join(keys[i::comments]))
+            self.add_comment(body)
+
+    def add_comment(self, body: str):
+        comment_id = len(self.comments) + 1
+        self.comments.append({'id': str(comment_id), 'body': body,
+                              'created': '2026-01-01T00:{:02d}:{:02d}.000+0000'.format(comment_id // 60 % 60,
+                                                                                       comment_id % 60)})
+
+    def api_url(self, path: str) -> str:
+        return '{}/rest/api/2/{}'.format(self.base_url, path)
+
+    def issue_json(self, key: str) -> Dict:
+        with self.lock:
+            versions = list(self.issues[key])
+        return {'id': key.split('-')[1], 'key': key, 'self': self.api_url('issue/{}'.format(key)),
+                'fields': {'fixVersions': [{'name': name, 'id': str(i)} for i, name in enumerate(versions)]}}
+
+    def count(self, request: str):
+        with self.lock:
+            self.requests[request] = self.requests.get(request, 0) + 1
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
@@ -0,0 +1,322 @@
+#!/usr/bin/python3
+
+"""
+In-process ssh servers used by the end-to-end benchmark.
+
+FakeLabServer runs exec requests in local shell and serves SFTP of the local
+filesystem, so SbuildTransfer works unchanged against a temporary directory.
+FakeBox emulates STB: upgrade command, reboot (ssh goes down and comes back)
+and setnv output with version read from the staged upgrade package.
+"""
+
+import os
+import socket
+import stat
+import subprocess
+import threading
+import time
+import uuid
+from typing import Callable, Dict, List
+
+import paramiko
+
+
+class LocalSFTPHandle(paramiko.SFTPHandle):
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+
+
+class LocalSFTPServer(paramiko.SFTPServerInterface):
+    """SFTP of the local filesystem, paths are used as they are."""
+
+    def list_folder(self, path):
+        try:
+            attributes = []
+            for name in os.listdir(path):
+                attr = paramiko.SFTPAttributes.from_stat(os.lstat(os.path.join(path, name)))
+                attr.filename = name
+                attributes.append(attr)
+            return attributes
+        except OSError as error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(path))
+        except OSError as error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+
+    def lstat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.lstat(path))
+        except OSError as error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(path, flags, 0o666)
+        except OSError as error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        handle = LocalSFTPHandle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError as error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        try:
+            os.rename(oldpath, newpath)
+        except OSError as error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+        return paramiko.SFTP_OK
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(path)
+        except OSError as error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+        return paramiko.SFTP_OK
+
+    def rmdir(self, path):
+        try:
+            os.rmdir(path)
+        except OSError as error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+        return paramiko.SFTP_OK
+
+    def chattr(self, path, attr):
+        try:
+            if attr.st_mode is not None:
+                os.chmod(path, stat.S_IMODE(attr.st_mode))
+        except OSError as error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+        return paramiko.SFTP_OK
+
+
+class ExecServerInterface(paramiko.ServerInterface):
+    """Accepts any public key and passes exec requests to the owning server."""
+
+    def __init__(self, owner: 'FakeSSHServer'):
+        self.owner = owner
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED_OPEN_REQUEST
+
+    def check_channel_exec_request(self, channel, command):
+        command = str(command, 'utf-8')
+        threading.Thread(target=self.owner.run_exec, args=(channel, command), daemon=True).start()
+        return True
+
+
+class FakeSSHServer:
+    """Ssh server listening on (address, port) in background threads."""
+
+    sftp: bool = False
+
+    def __init__(self, address: str, port: int, host_key: paramiko.PKey):
+        self.address = address
+        self.port = port
+        self.host_key = host_key
+        self.listener: socket.socket = None
+        self.transports: List[paramiko.Transport] = []
+        self.lock = threading.Lock()
+        self.commands = 0
+
+    def start(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((self.address, self.port))
+        listener.listen(64)
+        self.listener = listener
+        threading.Thread(target=self.accept_loop, args=(listener,), daemon=True).start()
+
+    def stop(self):
+        """Stop listening and drop all connections, like powered off box."""
+
+        with self.lock:
+            listener, self.listener = self.listener, None
+            transports, self.transports = self.transports, []
+        if listener is not None:
+            try:
+                listener.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            listener.close()
+        for transport in transports:
+            transport.close()
+
+    def accept_loop(self, listener: socket.socket):
+        while True:
+            try:
+                sock, peer = listener.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(sock)
+            transport.add_server_key(self.host_key)
+            if self.sftp:
+                transport.set_subsystem_handler('sftp', paramiko.SFTPServer, LocalSFTPServer)
+            with self.lock:
+                if self.listener is not listener:
+                    transport.close()
+                    return
+                self.transports = [t for t in self.transports if t.is_active()] + [transport]
+            threading.Thread(target=self.serve, args=(transport,), daemon=True).start()
+
+    def serve(self, transport: paramiko.Transport):
+        try:
+            transport.start_server(server=ExecServerInterface(self))
+        except (paramiko.SSHException, EOFError, OSError):
+            transport.close()
+
+    def run_exec(self, channel: paramiko.Channel, command: str):
+        with self.lock:
+            self.commands += 1
+        try:
+            status = self.execute(channel, command)
+        except Exception as error:
+            channel.sendall_stderr('{}\n'.format(error).encode('utf-8'))
+            status = 1
+        # Channel is left for the client to close, closing it here could overtake
+        # the reply to the exec request and make exec_command fail.
+        try:
+            channel.send_exit_status(status)
+            channel.shutdown_write()
+        except (OSError, EOFError):
+            pass
+
+    def execute(self, channel: paramiko.Channel, command: str) -> int:
+        raise NotImplementedError
+
+
+class FakeLabServer(FakeSSHServer):
+    """Lab server running commands in local shell."""
+
+    sftp = True
+
+    def execute(self, channel: paramiko.Channel, command: str) -> int:
+        process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+
+        def feed_stdin():
+            try:
+                while True:
+                    data = channel.recv(1024 * 1024)
+                    if not data:
+                        break
+                    process.stdin.write(data)
+            except (OSError, EOFError):
+                pass
+            finally:
+                try:
+                    process.stdin.close()
+                except OSError:
+                    pass
+
+        def forward(stream, send: Callable[[bytes], None]):
+            for data in iter(lambda: stream.read1(64 * 1024), b''):
+                send(data)
+
+        threads = [threading.Thread(target=feed_stdin, daemon=True),
+                   threading.Thread(target=forward, args=(process.stderr, channel.sendall_stderr), daemon=True)]
+        for thread in threads:
+            thread.start()
+        forward(process.stdout, channel.sendall)
+        status = process.wait()
+        threads[1].join()
+        return status
+
+
+class FakeBox(FakeSSHServer):
+    """
+    STB emulation.
+
+    Args of timing (seconds): upgrade_delay - run time of upgrade command,
+    shutdown_delay - time between reboot command and ssh going down,
+    boot_delay - time without ssh, activation_delay - time until setnv reports version.
+    """
+
+    def __init__(self, address: str, port: int, host_key: paramiko.PKey, upgrade_dirs: Dict[str, str],
+                 upgrade_delay: float, shutdown_delay: float, boot_delay: float, activation_delay: float):
+        super().__init__(address, port, host_key)
+        self.upgrade_dirs = upgrade_dirs
+        self.upgrade_delay = upgrade_delay
+        self.shutdown_delay = shutdown_delay
+        self.boot_delay = boot_delay
+        self.activation_delay = activation_delay
+        self.version = 'factory'
+        self.pending_version: str = None
+        self.booted_at = time.time()
+        self.boot_id = str(uuid.uuid4())
+        self.reboots = 0
+
+    def read_staged_version(self, url: str) -> str:
+        """Read version of the package served at url from local upgrade directory."""
+
+        base_url, project = url.rstrip('/').rsplit('/', 1)
+        directory = os.path.join(self.upgrade_dirs[base_url], project)
+        for root, dirs, files in os.walk(directory):
+            for name in files:
+                if name.endswith('md5'):
+                    with open(os.path.join(root, name)) as f:
+                        return f.readline().split()[0]
+        raise RuntimeError('No upgrade package at {}'.format(url))
+
+    def reboot(self):
+        time.sleep(self.shutdown_delay)
+        self.stop()
+        self.reboots += 1
+        time.sleep(self.boot_delay)
+        if self.pending_version is not None:
+            self.version, self.pending_version = self.pending_version, None
+        self.booted_at = time.time()
+        self.boot_id = str(uuid.uuid4())
+        self.start()
+
+    def execute(self, channel: paramiko.Channel, command: str) -> int:
+        if command.startswith('upgrade '):
+            url = command.split('--upgrade-server', 1)[1].split()[0]
+            time.sleep(self.upgrade_delay)
+            self.pending_version = self.read_staged_version(url)
+            channel.sendall('Upgrade to {} done\n'.format(self.pending_version).encode('utf-8'))
+            return 0
+        if command.startswith('pidof '):
+            return 1
+        if command == 'cat /proc/sys/kernel/random/boot_id':
+            channel.sendall('{}\n'.format(self.boot_id).encode('utf-8'))
+            return 0
+        if command == '/sbin/reboot':
+            threading.Thread(target=self.reboot, daemon=True).start()
+            return 0
+        if 'setnv' in command:
+            if time.time() - self.booted_at < self.activation_delay:
+                return 1
+            if 'cut' in command:
+                channel.sendall('{}\n'.format(self.version).encode('utf-8'))
+            else:
+                channel.sendall('SV_VERSION={}\nSV_SERIAL={}\n'.format(self.version, self.address).encode('utf-8'))
+            return 0
+        channel.sendall_stderr('sh: {}: not found\n'.format(command.split()[0]).encode('utf-8'))
+        return 127
@@ -0,0 +1,158 @@
+#!/usr/bin/python3
+
+#
+# TiVo Poland Sp. z o.o. Software License Version 1.0
+#
+# Copyright (C) 2008-2019 TiVo Poland Sp. z o.o. All rights reserved.
+#
+# Any rights which are not expressly granted in this License are entirely and
+# exclusively reserved to and by TiVo Poland Sp. z o.o. You may not rent, lease,
+# modify, translate, reverse engineer, decompile, disassemble, or create
+# derivative works based on this Software. You may not make access to this
+# Software available to others in connection with a service bureau,
+# application service provider, or similar business, or make any other use of
+# this Software without express written permission from TiVo Poland Sp. z o.o.
+#
+# Any User wishing to make use of this Software must contact
+# TiVo Poland Sp. z o.o. to arrange an appropriate license. Use of the Software
+# includes, but is not limited to:
+# (1) integrating or incorporating all or part of the code into a product for
+#     sale or license by, or on behalf of, User to third parties;
+# (2) distribution of the binary or source code to third parties for use with
+#     a commercial product sold or licensed by, or on behalf of, User.
+#
+
+"""
+Helpers which wait until STB reaches given state instead of sleeping for a fixed time.
+Every wait is bounded by a deadline and polls with exponential backoff and jitter.
+"""
+
+import random
+import socket
+import time
+from collections import deque
+from typing import Callable, Deque, Iterator
+
+
+class ReadinessTimeout(Exception):
+    """Raised when box does not reach expected state before deadline."""
+
+
+def backoff_delays(initial_delay: float = 1.0, max_delay: float = 15.0,
+                   factor: float = 2.0, jitter: float = 0.25) -> Iterator[float]:
+    """
+    Generate delays growing exponentially up to max_delay.
+
+    Args:
+    initial_delay (float): first delay in seconds
+    max_delay (float): upper bound of a single delay
+    factor (float): growth factor between consecutive delays
+    jitter (float): relative random spread applied to every delay
+    """
+
+    delay = initial_delay
+    while True:
+        yield delay * random.uniform(1.0 - jitter, 1.0 + jitter)
+        delay = min(delay * factor, max_delay)
+
+
+def wait_until(predicate: Callable[[], bool], timeout: float, description: str,
+               initial_delay: float = 1.0, max_delay: float = 15.0) -> float:
+    """
+    Poll predicate until it returns True.
+
+    Args:
+    predicate (callable): condition to check, exceptions are treated as False
+    timeout (float): overall deadline in seconds
+    description (str): name of awaited state used in error message
+    initial_delay (float): first polling delay
+    max_delay (float): maximal polling delay
+
+    Returns:
+    float: time in seconds spent on waiting
+    """
+
+    start = time.time()
+    deadline = start + timeout
+    for delay in backoff_delays(initial_delay, max_delay):
+        try:
+            if predicate():
+                return time.time() - start
+        except Exception:
+            pass
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise ReadinessTimeout('Timeout after {:.0f}s waiting for {}'.format(timeout, description))
+        time.sleep(min(delay, remaining))
+
+
+def is_ssh_ready(ip: str, port: int = 22, timeout: float = 3.0) -> bool:
+    """
+    Check if ssh daemon on the box accepts connections and sends its banner.
+
+    Args:
+    ip (str): address of the box
+    port (int): ssh port
+    timeout (float): timeout of single probe
+    """
+
+    try:
+        with socket.create_connection((ip, port), timeout=timeout) as sock:
+            sock.settimeout(timeout)
+            return sock.recv(4).startswith(b'SSH-')
+    except OSError:
+        return False
+
+
+def wait_for_disconnect(transport, timeout: float, description: str) -> float:
+    """
+    Wait until box closes ssh connection, e.g. after reboot command.
+
+    Closed connection is a positive sign of shutdown, unlike probing ssh port
+    which can miss a short reboot.
+
+    Args:
+    transport (paramiko.Transport): connection on which reboot was requested
+    timeout (float): overall deadline in seconds
+    description (str): name of awaited state used in error message
+    """
+
+    return wait_until(lambda: not transport.is_active(), timeout, description, initial_delay=0.2, max_delay=1.0)
+
+
+def wait_for_ssh_up(ip: str, timeout: float, port: int = 22) -> float:
+    """Wait until ssh daemon on the box is up again."""
+
+    return wait_until(lambda: is_ssh_ready(ip, port), timeout, 'ssh on {}'.format(ip))
+
+
+def drain(channel, output: Deque[str]):
+    """Read pending stdout and stderr of the channel, so full window does not stall the remote command."""
+
+    for ready, receive in ((channel.recv_ready, channel.recv), (channel.recv_stderr_ready, channel.recv_stderr)):
+        while ready():
+            output.extend(str(receive(32 * 1024), 'utf-8', 'replace').splitlines())
+
+
+def wait_for_command_exit(channel, timeout: float, description: str, output: Deque[str] = None) -> float:
+    """
+    Wait until command started with exec_command finishes, its output is read meanwhile.
+
+    Args:
+    channel (paramiko.Channel): channel of the started command
+    timeout (float): overall deadline in seconds
+    description (str): name of the command used in error message
+    output (deque): receives output lines of the command, discarded if not given
+    """
+
+    output = deque(maxlen=0) if output is None else output
+
+    def finished() -> bool:
+        drain(channel, output)
+        if not channel.exit_status_ready():
+            return False
+        drain(channel, output)
+        return True
+
+    return wait_until(finished, timeout, description, initial_delay=1.0, max_delay=5.0)
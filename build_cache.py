@@ -0,0 +1,191 @@
+#!/usr/bin/python3
+
+#
+# TiVo Poland Sp. z o.o. Software License Version 1.0
+#
+# Copyright (C) 2008-2019 TiVo Poland Sp. z o.o. All rights reserved.
+#
+# Any rights which are not expressly granted in this License are entirely and
+# exclusively reserved to and by TiVo Poland Sp. z o.o. You may not rent, lease,
+# modify, translate, reverse engineer, decompile, disassemble, or create
+# derivative works based on this Software. You may not make access to this
+# Software available to others in connection with a service bureau,
+# application service provider, or similar business, or make any other use of
+# this Software without express written permission from TiVo Poland Sp. z o.o.
+#
+# Any User wishing to make use of this Software must contact
+# TiVo Poland Sp. z o.o. to arrange an appropriate license. Use of the Software
+# includes, but is not limited to:
+# (1) integrating or incorporating all or part of the code into a product for
+#     sale or license by, or on behalf of, User to third parties;
+# (2) distribution of the binary or source code to third parties for use with
+#     a commercial product sold or licensed by, or on behalf of, User.
+#
+
+"""
+Persistent cache of built sbuild directories.
+Entries are keyed by project, source revisions and build flags and evicted in LRU order.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from typing import Dict
+from file_ops import clone_file
+
+
+def copy_tree(src: str, dst: str, hardlink: bool = True):
+    """Copy directory tree using hardlinks where possible, otherwise reflinks or in-kernel copies.
+
+    Hardlinks must not be used for trees which are later modified in place, e.g. by incremental builds.
+    """
+
+    shutil.copytree(src, dst, symlinks=True, copy_function=lambda src_file, dst_file: clone_file(src_file, dst_file,
+                                                                                                hardlink))
+
+
+def tree_size(path: str) -> int:
+    """Return size in bytes of all regular files in the directory tree."""
+
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            file_path = os.path.join(root, name)
+            if not os.path.islink(file_path):
+                size += os.path.getsize(file_path)
+    return size
+
+
+class BuildCache:
+    """Class which is response for storing and restoring built sbuild directories."""
+
+    INDEX_FILE = 'index.json'
+
+    def __init__(self, cache_dir: str, max_size_gb: float):
+        """Constructor of BuildCache class.
+
+        Args:
+        cache_dir (str): directory in which entries are stored
+        max_size_gb (float): maximal size of all entries, oldest used entries are removed above it
+        """
+
+        self.cache_dir: str = cache_dir
+        self.max_size: int = int(max_size_gb * 1024 ** 3)
+        self.index_path: str = os.path.join(cache_dir, self.INDEX_FILE)
+        self.lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(project: str, revisions: str, build_flags: str) -> str:
+        """
+        Make cache key.
+
+        Args:
+        project (str): built project
+        revisions (str): branch tip revision or revisions of all nosilo repositories
+        build_flags (str): flags passed to pysilo
+        """
+
+        data = '\n'.join([project, revisions.strip(), build_flags.strip()])
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    def load_index(self) -> Dict[str, Dict]:
+        if not os.path.exists(self.index_path):
+            return {}
+        with open(self.index_path) as f:
+            return json.load(f)
+
+    def save_index(self, index: Dict[str, Dict]):
+        tmp_path = '{}.tmp'.format(self.index_path)
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f, indent=2)
+        os.replace(tmp_path, self.index_path)
+
+    def lookup(self, key: str) -> Dict:
+        """
+        Find cache entry and mark it as recently used.
+
+        Returns:
+        dict: entry with PATH and VERSION_MD5_HASH or None on miss
+        """
+
+        with self.lock:
+            index = self.load_index()
+            entry = index.get(key)
+            if entry is None:
+                return None
+            if not os.path.isdir(entry['PATH']):
+                del index[key]
+                self.save_index(index)
+                return None
+            entry['LAST_USED'] = time.time()
+            self.save_index(index)
+            return dict(entry)
+
+    def restore(self, key: str, destination: str, hardlink: bool = True) -> str:
+        """
+        Restore cached sbuild directory.
+
+        Args:
+        key (str): cache key
+        destination (str): path of sbuild directory which will be created
+        hardlink (bool): link files instead of copying them
+
+        Returns:
+        str: version hash of the restored build or None on miss
+        """
+
+        entry = self.lookup(key)
+        if entry is None:
+            return None
+        if os.path.exists(destination):
+            shutil.rmtree(destination)
+        copy_tree(entry['PATH'], destination, hardlink)
+        return entry['VERSION_MD5_HASH']
+
+    def store(self, key: str, project: str, sbuild_dir: str, version_md5_hash: str, hardlink: bool = True):
+        """
+        Store built sbuild directory.
+
+        Args:
+        key (str): cache key
+        project (str): built project
+        sbuild_dir (str): directory produced by pysilo
+        version_md5_hash (str): version hash of the build
+        hardlink (bool): link files instead of copying them
+        """
+
+        entry_path = os.path.join(self.cache_dir, key)
+        tmp_path = '{}.tmp'.format(entry_path)
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        copy_tree(sbuild_dir, tmp_path, hardlink)
+
+        with self.lock:
+            if os.path.exists(entry_path):
+                shutil.rmtree(entry_path)
+            os.rename(tmp_path, entry_path)
+
+            index = self.load_index()
+            index[key] = {'PROJECT': project,
+                          'PATH': entry_path,
+                          'VERSION_MD5_HASH': version_md5_hash,
+                          'SIZE': tree_size(entry_path),
+                          'LAST_USED': time.time()}
+            self.evict(index)
+            self.save_index(index)
+
+    def evict(self, index: Dict[str, Dict]):
+        """Remove least recently used entries until cache fits in its size limit."""
+
+        total_size = sum(entry['SIZE'] for entry in index.values())
+        for key, entry in sorted(index.items(), key=lambda item: item[1]['LAST_USED']):
+            if total_size <= self.max_size:
+                break
+            print("Evicting {} build {} from cache".format(entry['PROJECT'], entry['VERSION_MD5_HASH']))
+            shutil.rmtree(entry['PATH'], ignore_errors=True)
+            total_size -= entry['SIZE']
+            del index[key]
@@ -0,0 +1,206 @@
+#!/usr/bin/python3
+
+#
+# TiVo Poland Sp. z o.o. Software License Version 1.0
+#
+# Copyright (C) 2008-2019 TiVo Poland Sp. z o.o. All rights reserved.
+#
+# Any rights which are not expressly granted in this License are entirely and
+# exclusively reserved to and by TiVo Poland Sp. z o.o. You may not rent, lease,
+# modify, translate, reverse engineer, decompile, disassemble, or create
+# derivative works based on this Software. You may not make access to this
+# Software available to others in connection with a service bureau,
+# application service provider, or similar business, or make any other use of
+# this Software without express written permission from TiVo Poland Sp. z o.o.
+#
+# Any User wishing to make use of this Software must contact
+# TiVo Poland Sp. z o.o. to arrange an appropriate license. Use of the Software
+# includes, but is not limited to:
+# (1) integrating or incorporating all or part of the code into a product for
+#     sale or license by, or on behalf of, User to third parties;
+# (2) distribution of the binary or source code to third parties for use with
+#     a commercial product sold or licensed by, or on behalf of, User.
+#
+
+
+"""
+Running shell commands with streamed output.
+
+stdout and stderr are read line by line while the command runs, passed to
+subscribers and kept in a bounded buffer. When a line matches one of fatal
+patterns the whole process group is terminated without waiting for the
+command to finish, and the last lines are reported in CommandError.
+"""
+
+import asyncio
+import os
+import re
+import signal
+import subprocess
+import threading
+from collections import deque
+from typing import Callable, Deque, Dict, List, Pattern
+
+Subscriber = Callable[[str, str], None]
+
+DEFAULT_FATAL_PATTERNS = [r'^make(\[\d+\])?: \*\*\* .*Error \d+',
+                          r'No space left on device',
+                          r'\bfatal error:']
+
+
+class CommandError(subprocess.CalledProcessError):
+    """Failed command together with the last lines of its output."""
+
+    def __init__(self, returncode: int, cmd: str, tail: List[str], fatal_line: str = None):
+        super().__init__(returncode, cmd, output='\n'.join(tail))
+        self.tail = tail
+        self.fatal_line = fatal_line
+
+    def __str__(self):
+        if self.fatal_line is not None:
+            return "Command '{}' aborted after fatal error: {}".format(self.cmd, self.fatal_line)
+        return super().__str__()
+
+
+class CommandRunner:
+    """Class which is response for running commands and streaming their output."""
+
+    def __init__(self, fatal_patterns: List[str] = None, tail_lines: int = 200, kill_grace: float = 10,
+                 echo: bool = True):
+        """Constructor of CommandRunner class.
+
+        Args:
+        fatal_patterns (list): regular expressions of lines after which command is aborted
+        tail_lines (int): number of last output lines kept for failure reports
+        kill_grace (float): seconds between SIGTERM and SIGKILL of aborted command
+        echo (bool): print output lines
+        """
+
+        patterns = DEFAULT_FATAL_PATTERNS if fatal_patterns is None else fatal_patterns
+        self.fatal_patterns: List[Pattern] = [re.compile(pattern) for pattern in patterns]
+        self.tail_lines = tail_lines
+        self.kill_grace = kill_grace
+        self.echo = echo
+        self.subscribers: List[Subscriber] = []
+        self.running: Dict[asyncio.subprocess.Process, asyncio.AbstractEventLoop] = {}
+        self.running_lock = threading.Lock()
+        self.abort_reason = None
+
+    def subscribe(self, subscriber: Subscriber):
+        """Call subscriber(stream, line) for every output line, stream is 'stdout' or 'stderr'."""
+
+        if subscriber is not None:
+            self.subscribers.append(subscriber)
+
+    def unsubscribe(self, subscriber: Subscriber):
+        self.subscribers.remove(subscriber)
+
+    def is_fatal(self, line: str) -> bool:
+        return any(pattern.search(line) for pattern in self.fatal_patterns)
+
+    def terminate(self, process: asyncio.subprocess.Process):
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    async def kill_after_grace(self, process: asyncio.subprocess.Process):
+        try:
+            await asyncio.wait_for(process.wait(), self.kill_grace)
+        except asyncio.TimeoutError:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    def abort(self, reason: str):
+        """
+        Terminate commands running in all threads and refuse to start new ones.
+
+        Used when one of parallel builds failed and the others would be wasted.
+
+        Args:
+        reason (str): reason reported in CommandError of aborted commands
+        """
+
+        with self.running_lock:
+            self.abort_reason = reason
+            running = list(self.running.items())
+        for process, loop in running:
+            self.terminate(process)
+            loop.call_soon_threadsafe(asyncio.ensure_future, self.kill_after_grace(process))
+
+    async def run_async(self, command: str, cwd: str = None, env: dict = None) -> List[str]:
+        """
+        Run shell command in its own process group.
+
+        Args:
+        command (str): command which will be called
+        cwd (str): directory in which command will be called, current directory if not given
+        env (dict): environment of the command, inherited if not given
+
+        Returns:
+        list: last output lines
+
+        Raises:
+        CommandError: command failed or was aborted after fatal error
+        """
+
+        tail: Deque[str] = deque(maxlen=self.tail_lines)
+        fatal_lines: List[str] = []
+        if self.abort_reason is not None:
+            raise CommandError(-signal.SIGTERM, command, [], self.abort_reason)
+        process = await asyncio.create_subprocess_shell(command, stdout=asyncio.subprocess.PIPE,
+                                                        stderr=asyncio.subprocess.PIPE, cwd=cwd, env=env,
+                                                        start_new_session=True)
+        with self.running_lock:
+            self.running[process] = asyncio.get_running_loop()
+            if self.abort_reason is not None:
+                self.terminate(process)
+
+        def emit(stream_name: str, data: bytes):
+            line = str(data, 'utf-8', 'replace').rstrip('\r\n')
+            tail.append(line)
+            if self.echo:
+                print(line, flush=True)
+            for subscriber in list(self.subscribers):
+                subscriber(stream_name, line)
+            if not fatal_lines and self.is_fatal(line):
+                fatal_lines.append(line)
+                print("Fatal error detected, aborting '{}'".format(command))
+                self.terminate(process)
+                asyncio.ensure_future(self.kill_after_grace(process))
+
+        async def pump(stream: asyncio.StreamReader, stream_name: str):
+            pending = b''
+            while True:
+                chunk = await stream.read(64 * 1024)
+                if not chunk:
+                    break
+                lines = (pending + chunk).split(b'\n')
+                pending = lines.pop()
+                for line in lines:
+                    emit(stream_name, line)
+            if pending:
+                emit(stream_name, pending)
+
+        try:
+            await asyncio.gather(pump(process.stdout, 'stdout'), pump(process.stderr, 'stderr'))
+            returncode = await process.wait()
+        except BaseException:
+            self.terminate(process)
+            raise
+        finally:
+            with self.running_lock:
+                del self.running[process]
+
+        if self.abort_reason is not None and not fatal_lines and returncode != 0:
+            fatal_lines.append(self.abort_reason)
+        if fatal_lines or returncode != 0:
+            raise CommandError(returncode, command, list(tail), fatal_lines[0] if fatal_lines else None)
+        return list(tail)
+
+    def run(self, command: str, cwd: str = None, env: dict = None) -> List[str]:
+        """Blocking version of run_async, must not be called from a running event loop."""
+
+        return asyncio.run(self.run_async(command, cwd, env))
@@ -0,0 +1,180 @@
+#!/usr/bin/python3
+
+#
+# TiVo Poland Sp. z o.o. Software License Version 1.0
+#
+# Copyright (C) 2008-2019 TiVo Poland Sp. z o.o. All rights reserved.
+#
+# Any rights which are not expressly granted in this License are entirely and
+# exclusively reserved to and by TiVo Poland Sp. z o.o. You may not rent, lease,
+# modify, translate, reverse engineer, decompile, disassemble, or create
+# derivative works based on this Software. You may not make access to this
+# Software available to others in connection with a service bureau,
+# application service provider, or similar business, or make any other use of
+# this Software without express written permission from TiVo Poland Sp. z o.o.
+#
+# Any User wishing to make use of this Software must contact
+# TiVo Poland Sp. z o.o. to arrange an appropriate license. Use of the Software
+# includes, but is not limited to:
+# (1) integrating or incorporating all or part of the code into a product for
+#     sale or license by, or on behalf of, User to third parties;
+# (2) distribution of the binary or source code to third parties for use with
+#     a commercial product sold or licensed by, or on behalf of, User.
+#
+
+
+"""
+Parallel copy of directory trees to network mounted locations.
+
+Tree is copied to a temporary sibling directory which is renamed to its final
+name only after all files were written, synced and verified, so readers never
+see a partial copy. MD5 of every file is computed while it is copied and stored
+in a manifest compatible with 'md5sum -c'.
+"""
+
+import hashlib
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Tuple
+
+MANIFEST = 'MD5SUMS'
+
+
+class CopyVerificationError(OSError):
+    """Copied file differs from its source."""
+
+
+class CopyReport(NamedTuple):
+    """Result of copy_tree."""
+
+    destination: str
+    files: int
+    bytes: int
+    duration: float
+
+    @property
+    def mb_per_s(self) -> float:
+        return self.bytes / 1024 ** 2 / max(self.duration, 1e-9)
+
+
+def hash_file(path: str, buffer_size: int) -> str:
+    md5 = hashlib.md5()
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as f:
+        for count in iter(lambda: f.readinto(buffer), 0):
+            md5.update(view[:count])
+    return md5.hexdigest()
+
+
+class CopyEngine:
+    """Class which is response for verified parallel copying of directory trees."""
+
+    def __init__(self, workers: int = 4, buffer_size: int = 8 * 1024 ** 2, verify: bool = True):
+        """Constructor of CopyEngine class.
+
+        Args:
+        workers (int): number of files copied at the same time
+        buffer_size (int): size of read and write buffer of each worker
+        verify (bool): read copied files back and compare their MD5 with the source
+        """
+
+        self.workers = max(1, workers)
+        self.buffer_size = buffer_size
+        self.verify = verify
+
+    def copy_file(self, src: str, dst: str) -> str:
+        """
+        Copy single file, data is read once and hashed on the way.
+        With verify the copy is read back from storage, not from the page cache.
+
+        Returns:
+        str: MD5 of the file
+        """
+
+        md5 = hashlib.md5()
+        buffer = bytearray(self.buffer_size)
+        view = memoryview(buffer)
+        with open(src, 'rb', buffering=0) as source, open(dst, 'wb', buffering=0) as target:
+            for count in iter(lambda: source.readinto(buffer), 0):
+                md5.update(view[:count])
+                written = 0
+                while written < count:
+                    written += target.write(view[written:count])
+            os.fsync(target.fileno())
+            if self.verify and hasattr(os, 'posix_fadvise'):
+                # Written pages are clean after fsync, dropping them makes verification read the storage.
+                os.posix_fadvise(target.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        shutil.copystat(src, dst)
+
+        checksum = md5.hexdigest()
+        if self.verify and hash_file(dst, self.buffer_size) != checksum:
+            raise CopyVerificationError('Copy {} of {} differs from source'.format(dst, src))
+        return checksum
+
+    @staticmethod
+    def list_tree(src: str) -> Tuple[List[str], List[str], List[str]]:
+        """Return relative paths of directories, regular files and symlinks of the tree."""
+
+        dirs, files, links = [], [], []
+        for root, dir_names, file_names in os.walk(src):
+            relative_root = os.path.relpath(root, src)
+            for name in dir_names:
+                path = os.path.normpath(os.path.join(relative_root, name))
+                (links if os.path.islink(os.path.join(root, name)) else dirs).append(path)
+            for name in file_names:
+                path = os.path.normpath(os.path.join(relative_root, name))
+                (links if os.path.islink(os.path.join(root, name)) else files).append(path)
+        return dirs, files, links
+
+    def copy_tree(self, src: str, dst: str) -> CopyReport:
+        """
+        Copy directory tree, existing dst is replaced as a whole.
+
+        Args:
+        src (str): source directory
+        dst (str): target directory, its parent is created if needed
+
+        Returns:
+        CopyReport: number of files and bytes, duration of the copy
+        """
+
+        start = time.time()
+        parent, name = os.path.split(os.path.abspath(dst))
+        os.makedirs(parent, exist_ok=True)
+        partial = os.path.join(parent, '.{}.partial-{}'.format(name, os.getpid()))
+        shutil.rmtree(partial, ignore_errors=True)
+
+        dirs, files, links = self.list_tree(src)
+        try:
+            os.makedirs(partial)
+            for path in dirs:
+                os.makedirs(os.path.join(partial, path), exist_ok=True)
+            for path in links:
+                os.symlink(os.readlink(os.path.join(src, path)), os.path.join(partial, path))
+
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                checksums: Dict[str, str] = dict(zip(files, executor.map(
+                    lambda path: self.copy_file(os.path.join(src, path), os.path.join(partial, path)), files)))
+
+            with open(os.path.join(partial, MANIFEST), 'w') as f:
+                for path in sorted(checksums):
+                    f.write('{}  {}\n'.format(checksums[path], path))
+                f.flush()
+                os.fsync(f.fileno())
+
+            if os.path.lexists(dst):
+                previous = os.path.join(parent, '.{}.previous-{}'.format(name, os.getpid()))
+                os.rename(dst, previous)
+                os.rename(partial, dst)
+                shutil.rmtree(previous, ignore_errors=True)
+            else:
+                os.rename(partial, dst)
+        except BaseException:
+            shutil.rmtree(partial, ignore_errors=True)
+            raise
+
+        size = sum(os.path.getsize(os.path.join(dst, path)) for path in files)
+        return CopyReport(dst, len(files), size, time.time() - start)
@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+
+#
+# TiVo Poland Sp. z o.o. Software License Version 1.0
+#
+# Copyright (C) 2008-2019 TiVo Poland Sp. z o.o. All rights reserved.
+#
+# Any rights which are not expressly granted in this License are entirely and
+# exclusively reserved to and by TiVo Poland Sp. z o.o. You may not rent, lease,
+# modify, translate, reverse engineer, decompile, disassemble, or create
+# derivative works based on this Software. You may not make access to this
+# Software available to others in connection with a service bureau,
+# application service provider, or similar business, or make any other use of
+# this Software without express written permission from TiVo Poland Sp. z o.o.
+#
+# Any User wishing to make use of this Software must contact
+# TiVo Poland Sp. z o.o. to arrange an appropriate license. Use of the Software
+# includes, but is not limited to:
+# (1) integrating or incorporating all or part of the code into a product for
+#     sale or license by, or on behalf of, User to third parties;
+# (2) distribution of the binary or source code to third parties for use with
+#     a commercial product sold or licensed by, or on behalf of, User.
+#
+
+
+"""
+Per-job execution context.
+
+Jobs run in threads of one process, so they must not change process-wide
+state such as current directory or environment. Every command and path of
+a job is resolved against its ExecutionContext instead, and jobs using the
+same work directory are serialised with work_dir_lock.
+"""
+
+import glob
+import os
+import threading
+from contextlib import contextmanager
+from typing import Dict, List
+
+
+class ExecutionContext:
+    """Class which is response for keeping work directory and environment of a single job."""
+
+    def __init__(self, work_dir: str = None, env: Dict[str, str] = None):
+        """Constructor of ExecutionContext class.
+
+        Args:
+        work_dir (str): directory in which commands are run and relative paths are resolved,
+                        current directory of the process if not given
+        env (dict): variables added to environment of the process
+        """
+
+        self.work_dir = os.path.abspath(work_dir or os.getcwd())
+        self.env: Dict[str, str] = dict(env or {})
+
+    def path(self, *parts: str) -> str:
+        """Return absolute path of parts relative to work directory."""
+
+        return os.path.join(self.work_dir, *parts)
+
+    def glob(self, pattern: str) -> List[str]:
+        """Return sorted absolute paths matching pattern relative to work directory."""
+
+        return sorted(glob.glob(self.path(pattern)))
+
+    def set_env(self, name: str, value: str):
+        self.env[name] = value
+
+    def environ(self) -> Dict[str, str]:
+        """Return environment for subprocesses of the job."""
+
+        return dict(os.environ, **self.env)
+
+    def child(self, work_dir: str) -> 'ExecutionContext':
+        """Return context with the same environment and work directory resolved against this one."""
+
+        return ExecutionContext(self.path(work_dir), self.env)
+
+
+work_dir_locks: Dict[str, threading.RLock] = {}
+work_dir_locks_lock = threading.Lock()
+
+
+@contextmanager
+def work_dir_lock(work_dir: str):
+    """
+    Hold lock of work directory, e.g. branch sources, for the duration of the block.
+
+    Lock is reentrant, so nested phases of the same job may take it again.
+    """
+
+    key = os.path.realpath(work_dir)
+    with work_dir_locks_lock:
+        lock = work_dir_locks.setdefault(key, threading.RLock())
+    if not lock.acquire(blocking=False):
+        print("Waiting for work directory {} used by another job ...".format(work_dir))
+        lock.acquire()
+    try:
+        yield
+    finally:
+        lock.release()
@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+
+#
+# TiVo Poland Sp. z o.o. Software License Version 1.0
+#
+# Copyright (C) 2008-2019 TiVo Poland Sp. z o.o. All rights reserved.
+#
+# Any rights which are not expressly granted in this License are entirely and
+# exclusively reserved to and by TiVo Poland Sp. z o.o. You may not rent, lease,
+# modify, translate, reverse engineer, decompile, disassemble, or create
+# derivative works based on this Software. You may not make access to this
+# Software available to others in connection with a service bureau,
+# application service provider, or similar business, or make any other use of
+# this Software without express written permission from TiVo Poland Sp. z o.o.
+#
+# Any User wishing to make use of this Software must contact
+# TiVo Poland Sp. z o.o. to arrange an appropriate license. Use of the Software
+# includes, but is not limited to:
+# (1) integrating or incorporating all or part of the code into a product for
+#     sale or license by, or on behalf of, User to third parties;
+# (2) distribution of the binary or source code to third parties for use with
+#     a commercial product sold or licensed by, or on behalf of, User.
+#
+
+
+"""
+Cheap file duplication.
+
+Files are hardlinked when both names may share one inode, otherwise reflinked
+(copy-on-write clone on btrfs/xfs) and copied in kernel with copy_file_range
+when the filesystem does not support cloning.
+"""
+
+import errno
+import fcntl
+import os
+import shutil
+
+HARDLINK = 'hardlink'
+REFLINK = 'reflink'
+COPY_FILE_RANGE = 'copy_file_range'
+COPY = 'copy'
+
+FICLONE = 0x40049409
+
+UNSUPPORTED_ERRNOS = (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS, errno.EPERM,
+                      errno.EBADF)
+
+
+def reflink(src_fd: int, dst_fd: int):
+    fcntl.ioctl(dst_fd, FICLONE, src_fd)
+
+
+def copy_range(src_fd: int, dst_fd: int):
+    size = os.fstat(src_fd).st_size
+    copied = 0
+    while copied < size:
+        count = os.copy_file_range(src_fd, dst_fd, size - copied)
+        if count == 0:
+            # Some filesystems report no data instead of an error, copy is repeated with plain reads.
+            raise OSError(errno.EINVAL, 'copy_file_range stopped after {} of {} bytes'.format(copied, size))
+        copied += count
+
+
+def clone_file(src: str, dst: str, hardlink: bool = True) -> str:
+    """
+    Duplicate file in the cheapest available way, existing dst is replaced.
+
+    Args:
+    src (str): source file
+    dst (str): target file
+    hardlink (bool): allow hardlinks, must be False when either file is later modified in place
+
+    Returns:
+    str: used method, one of HARDLINK, REFLINK, COPY_FILE_RANGE, COPY
+    """
+
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    if hardlink:
+        try:
+            os.link(src, dst)
+            return HARDLINK
+        except OSError:
+            pass
+
+    with open(src, 'rb') as source, open(dst, 'wb') as target:
+        for method, function in ((REFLINK, reflink), (COPY_FILE_RANGE, copy_range)):
+            if method == COPY_FILE_RANGE and not hasattr(os, 'copy_file_range'):
+                continue
+            try:
+                function(source.fileno(), target.fileno())
+                break
+            except OSError as error:
+                if error.errno not in UNSUPPORTED_ERRNOS:
+                    raise
+                source.seek(0)
+                target.seek(0)
+                target.truncate()
+        else:
+            method = COPY
+            shutil.copyfileobj(source, target, 1024 * 1024)
+    shutil.copystat(src, dst)
+    return method
@@ -0,0 +1,124 @@
+#!/usr/bin/python3
+
+#
+# TiVo Poland Sp. z o.o. Software License Version 1.0
+#
+# Copyright (C) 2008-2019 TiVo Poland Sp. z o.o. All rights reserved.
+#
+# Any rights which are not expressly granted in this License are entirely and
+# exclusively reserved to and by TiVo Poland Sp. z o.o. You may not rent, lease,
+# modify, translate, reverse engineer, decompile, disassemble, or create
+# derivative works based on this Software. You may not make access to this
+# Software available to others in connection with a service bureau,
+# application service provider, or similar business, or make any other use of
+# this Software without express written permission from TiVo Poland Sp. z o.o.
+#
+# Any User wishing to make use of this Software must contact
+# TiVo Poland Sp. z o.o. to arrange an appropriate license. Use of the Software
+# includes, but is not limited to:
+# (1) integrating or incorporating all or part of the code into a product for
+#     sale or license by, or on behalf of, User to third parties;
+# (2) distribution of the binary or source code to third parties for use with
+#     a commercial product sold or licensed by, or on behalf of, User.
+#
+
+
+"""
+Persistent state of boxes from BOXES_LIST.
+
+For every box the last known SV_VERSION is stored, together with time
+of the check and its result, so upgrade runs can skip boxes which already
+run the built software or are not reachable.
+"""
+
+import json
+import os
+import threading
+import time
+from typing import Dict
+
+REACHABLE = 'reachable'
+UNREACHABLE = 'unreachable'
+UPGRADED = 'upgraded'
+FAILED = 'failed'
+UP_TO_DATE = 'up_to_date'
+
+
+class FleetState:
+    """Class which is response for keeping last known state of every box in a JSON file."""
+
+    def __init__(self, state_file: str):
+        """Constructor of FleetState class.
+
+        Args:
+        state_file (str): JSON file with state of boxes, created when missing
+        """
+
+        self.state_file = os.path.expanduser(state_file)
+        self.lock = threading.Lock()
+        self.boxes: Dict[str, Dict] = self.load()
+
+    def load(self) -> Dict[str, Dict]:
+        if not os.path.exists(self.state_file):
+            return {}
+        try:
+            with open(self.state_file) as f:
+                return json.load(f)
+        except ValueError:
+            print('Ignoring corrupted fleet state {}'.format(self.state_file))
+            return {}
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.state_file) or '.', exist_ok=True)
+        tmp_path = '{}.tmp'.format(self.state_file)
+        with open(tmp_path, 'w') as f:
+            json.dump(self.boxes, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.state_file)
+
+    def get(self, ip: str) -> Dict:
+        """Return last known state of the box, empty if it was never checked."""
+
+        with self.lock:
+            return dict(self.boxes.get(ip, {}))
+
+    def record(self, ip: str, result: str, version: str = None, **fields):
+        """
+        Store result of check or upgrade of the box.
+
+        Args:
+        ip (str): address of the box
+        result (str): one of REACHABLE, UNREACHABLE, UPGRADED, FAILED
+        version (str): SV_VERSION read from the box, last known version is kept if not given
+        fields: additional data, e.g. PROJECT and BRANCH
+        """
+
+        with self.lock:
+            state = self.boxes.setdefault(ip, {})
+            state.update(fields, RESULT=result, CHECKED_AT=time.time())
+            if version:
+                state['VERSION'] = version
+            self.save()
+
+
+fleet_states: Dict[str, FleetState] = {}
+fleet_states_lock = threading.Lock()
+
+
+def get_fleet_state(config: dict) -> FleetState:
+    """
+    Return fleet state shared by all jobs of the process.
+
+    Args:
+    config (dict): UPGRADE entry, FLEET_STATE_FILE selects the state file
+
+    Returns:
+    FleetState: state stored in the configured file
+    """
+
+    state_file = os.path.expanduser(config.get('FLEET_STATE_FILE', '~/.upgrader/fleet_state.json'))
+    with fleet_states_lock:
+        fleet_state = fleet_states.get(state_file)
+        if fleet_state is None:
+            fleet_state = FleetState(state_file)
+            fleet_states[state_file] = fleet_state
+        return fleet_state
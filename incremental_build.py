@@ -0,0 +1,139 @@
+#!/usr/bin/python3
+
+#
+# TiVo Poland Sp. z o.o. Software License Version 1.0
+#
+# Copyright (C) 2008-2019 TiVo Poland Sp. z o.o. All rights reserved.
+#
+# Any rights which are not expressly granted in this License are entirely and
+# exclusively reserved to and by TiVo Poland Sp. z o.o. You may not rent, lease,
+# modify, translate, reverse engineer, decompile, disassemble, or create
+# derivative works based on this Software. You may not make access to this
+# Software available to others in connection with a service bureau,
+# application service provider, or similar business, or make any other use of
+# this Software without express written permission from TiVo Poland Sp. z o.o.
+#
+# Any User wishing to make use of this Software must contact
+# TiVo Poland Sp. z o.o. to arrange an appropriate license. Use of the Software
+# includes, but is not limited to:
+# (1) integrating or incorporating all or part of the code into a product for
+#     sale or license by, or on behalf of, User to third parties;
+# (2) distribution of the binary or source code to third parties for use with
+#     a commercial product sold or licensed by, or on behalf of, User.
+#
+
+"""
+Decision whether project in warm nosilo tree can be built incrementally.
+
+State of the last build (revisions of all repositories, build flags, result)
+is kept in the work tree. Clean build is needed when there is no successful
+previous build, flags or repositories changed, or changed files match
+one of clean build patterns (build system files).
+"""
+
+import fnmatch
+import json
+import os
+import subprocess
+from typing import Dict, List, Tuple
+
+CLEAN = 'clean'
+INCREMENTAL = 'incremental'
+BUILD_MODES = (CLEAN, INCREMENTAL)
+
+STATE_FILE = '.build_state.json'
+DEFAULT_CLEAN_BUILD_PATTERNS = ['Makefile*', '*.mk', '*.cmake', 'CMakeLists.txt', 'configure*', '*.ac', '*.am',
+                                '*.in', '*defconfig*', '*.config', '*.silo', '*.nosilo', '*.pc']
+
+
+def find_repositories(work_tree: str, max_depth: int = 2) -> List[str]:
+    """Return relative paths of Mercurial repositories in nosilo tree."""
+
+    repositories = []
+    for root, dirs, files in os.walk(work_tree):
+        depth = os.path.relpath(root, work_tree).count(os.sep) + (0 if root == work_tree else 1)
+        if '.hg' in dirs:
+            repositories.append(os.path.relpath(root, work_tree))
+            dirs[:] = []
+        elif depth >= max_depth:
+            dirs[:] = []
+        else:
+            dirs[:] = [d for d in dirs if not d.startswith('.') and not d.startswith('sbuild-')]
+    return sorted(repositories)
+
+
+def hg_output(repository: str, *args) -> str:
+    return str(subprocess.check_output(['hg', '-R', repository] + list(args)), 'utf-8').strip()
+
+
+def get_revisions(work_tree: str) -> Dict[str, str]:
+    """Return current revision of every repository in nosilo tree."""
+
+    return {repository: hg_output(os.path.join(work_tree, repository), 'id', '-i')
+            for repository in find_repositories(work_tree)}
+
+
+def changed_files(work_tree: str, repository: str, revision: str) -> List[str]:
+    """Return tracked files changed in repository working copy since revision, build products are skipped."""
+
+    output = hg_output(os.path.join(work_tree, repository), 'status', '-mard', '-n', '--rev', revision.rstrip('+'))
+    return output.splitlines()
+
+
+def load_state(work_tree: str) -> Dict[str, Dict]:
+    path = os.path.join(work_tree, STATE_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def record_build(work_tree: str, project: str, build_flags: str, revisions: Dict[str, str], succeeded: bool):
+    """Store state of finished build of project."""
+
+    state = load_state(work_tree)
+    state[project] = {'FLAGS': build_flags, 'REVISIONS': revisions, 'SUCCEEDED': succeeded}
+    path = os.path.join(work_tree, STATE_FILE)
+    with open('{}.tmp'.format(path), 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace('{}.tmp'.format(path), path)
+
+
+def needs_clean_build(work_tree: str, project: str, build_flags: str, revisions: Dict[str, str],
+                      patterns: List[str] = None) -> Tuple[bool, str]:
+    """
+    Check if project has to be built from scratch.
+
+    Args:
+    work_tree (str): nosilo tree
+    project (str): built project
+    build_flags (str): flags passed to pysilo
+    revisions (dict): current revisions of repositories
+    patterns (list): file name patterns which force clean build
+
+    Returns:
+    tuple: flag and reason of the decision
+    """
+
+    patterns = DEFAULT_CLEAN_BUILD_PATTERNS if patterns is None else patterns
+    previous = load_state(work_tree).get(project)
+    if previous is None:
+        return True, 'no previous build'
+    if not previous['SUCCEEDED']:
+        return True, 'previous build failed'
+    if previous['FLAGS'] != build_flags:
+        return True, 'build flags changed'
+    if set(previous['REVISIONS']) != set(revisions):
+        return True, 'repositories changed'
+
+    for repository, revision in revisions.items():
+        if previous['REVISIONS'][repository] == revision:
+            continue
+        try:
+            files = changed_files(work_tree, repository, previous['REVISIONS'][repository])
+        except subprocess.CalledProcessError:
+            return True, 'cannot compare {} with {}'.format(repository, previous['REVISIONS'][repository])
+        for path in files:
+            if any(fnmatch.fnmatch(os.path.basename(path), pattern) for pattern in patterns):
+                return True, '{} changed'.format(os.path.join(repository, path))
+    return False, 'only sources changed'
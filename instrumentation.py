@@ -0,0 +1,179 @@
+#!/usr/bin/python3
+
+#
+# TiVo Poland Sp. z o.o. Software License Version 1.0
+#
+# Copyright (C) 2008-2019 TiVo Poland Sp. z o.o. All rights reserved.
+#
+# Any rights which are not expressly granted in this License are entirely and
+# exclusively reserved to and by TiVo Poland Sp. z o.o. You may not rent, lease,
+# modify, translate, reverse engineer, decompile, disassemble, or create
+# derivative works based on this Software. You may not make access to this
+# Software available to others in connection with a service bureau,
+# application service provider, or similar business, or make any other use of
+# this Software without express written permission from TiVo Poland Sp. z o.o.
+#
+# Any User wishing to make use of this Software must contact
+# TiVo Poland Sp. z o.o. to arrange an appropriate license. Use of the Software
+# includes, but is not limited to:
+# (1) integrating or incorporating all or part of the code into a product for
+#     sale or license by, or on behalf of, User to third parties;
+# (2) distribution of the binary or source code to third parties for use with
+#     a commercial product sold or licensed by, or on behalf of, User.
+#
+
+
+"""
+Timing of upgrade and build phases.
+
+Every phase is wrapped in a span, finished spans are appended to JSONL file
+and aggregated into histograms exported in Prometheus text format.
+"""
+
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+
+DEFAULT_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200)
+HISTOGRAM_LABELS = ('phase', 'job_type', 'project', 'outcome')
+
+
+class Histogram:
+    """Cumulative histogram of durations in seconds."""
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Metrics:
+    """Class which is response for recording spans and exporting their histograms."""
+
+    def __init__(self, spans_file: str = None):
+        """Constructor of Metrics class.
+
+        Args:
+        spans_file (str): JSONL file to which finished spans are appended, spans are not written if not given
+        """
+
+        self.spans_file = spans_file
+        self.lock = threading.Lock()
+        self.histograms: Dict[Tuple[str, ...], Histogram] = OrderedDict()
+
+    def configure(self, config: dict):
+        """Apply INSTRUMENTATION section of conf.json."""
+
+        spans_file = config.get('SPANS_FILE')
+        with self.lock:
+            self.spans_file = os.path.expanduser(spans_file) if spans_file else None
+        if self.spans_file is not None:
+            os.makedirs(os.path.dirname(self.spans_file), exist_ok=True)
+
+    def record(self, phase: str, duration: float, outcome: str = 'ok', **labels):
+        """
+        Record finished phase.
+
+        Args:
+        phase (str): name of the phase
+        duration (float): duration in seconds
+        outcome (str): 'ok' or 'error'
+        labels: job_id, job_type, project, branch, ip and other context of the phase
+        """
+
+        span = OrderedDict([('phase', phase), ('start', time.time() - duration), ('duration', duration),
+                            ('outcome', outcome)])
+        span.update((name, value) for name, value in labels.items() if value is not None)
+        key = tuple(str(span.get(name, '')) for name in HISTOGRAM_LABELS)
+        with self.lock:
+            self.histograms.setdefault(key, Histogram()).observe(duration)
+            if self.spans_file is not None:
+                with open(self.spans_file, 'a') as f:
+                    f.write(json.dumps(span) + '\n')
+
+    @contextmanager
+    def span(self, phase: str, **labels):
+        """
+        Measure block of code as phase, outcome is 'error' when the block raises
+        (successful exit() of the scripts is not an error).
+
+        Args:
+        phase (str): name of the phase
+        labels: job_id, job_type, project, branch, ip and other context of the phase
+        """
+
+        start = time.time()
+        try:
+            yield
+        except SystemExit as error:
+            self.record(phase, time.time() - start, 'ok' if not error.code else 'error', **labels)
+            raise
+        except BaseException as error:
+            self.record(phase, time.time() - start, 'error', error=type(error).__name__, **labels)
+            raise
+        self.record(phase, time.time() - start, **labels)
+
+    def render(self) -> str:
+        """Return histograms in Prometheus text exposition format."""
+
+        def format_labels(key: Tuple[str, ...], extra: List[Tuple[str, str]] = ()) -> str:
+            pairs = list(zip(HISTOGRAM_LABELS, key)) + list(extra)
+            return ','.join('{}="{}"'.format(name, value.replace('\\', '\\\\').replace('"', '\\"'))
+                            for name, value in pairs)
+
+        lines = ['# HELP upgrader_phase_duration_seconds Duration of upgrade and build phases.',
+                 '# TYPE upgrader_phase_duration_seconds histogram']
+        with self.lock:
+            for key, histogram in self.histograms.items():
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    lines.append('upgrader_phase_duration_seconds_bucket{{{}}} {}'.format(
+                        format_labels(key, [('le', str(bound))]), count))
+                lines.append('upgrader_phase_duration_seconds_bucket{{{}}} {}'.format(
+                    format_labels(key, [('le', '+Inf')]), histogram.count))
+                lines.append('upgrader_phase_duration_seconds_sum{{{}}} {}'.format(format_labels(key), histogram.sum))
+                lines.append('upgrader_phase_duration_seconds_count{{{}}} {}'.format(format_labels(key),
+                                                                                     histogram.count))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serves histograms of the shared Metrics instance at /metrics."""
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(address: str, port: int) -> ThreadingHTTPServer:
+    """Start serving /metrics in a background thread."""
+
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    print('Serving metrics at http://{}:{}/metrics'.format(*server.server_address[:2]))
+    return server
@@ -0,0 +1,441 @@
+#!/usr/bin/python3
+
+#
+# TiVo Poland Sp. z o.o. Software License Version 1.0
+#
+# Copyright (C) 2008-2019 TiVo Poland Sp. z o.o. All rights reserved.
+#
+# Any rights which are not expressly granted in this License are entirely and
+# exclusively reserved to and by TiVo Poland Sp. z o.o. You may not rent, lease,
+# modify, translate, reverse engineer, decompile, disassemble, or create
+# derivative works based on this Software. You may not make access to this
+# Software available to others in connection with a service bureau,
+# application service provider, or similar business, or make any other use of
+# this Software without express written permission from TiVo Poland Sp. z o.o.
+#
+# Any User wishing to make use of this Software must contact
+# TiVo Poland Sp. z o.o. to arrange an appropriate license. Use of the Software
+# includes, but is not limited to:
+# (1) integrating or incorporating all or part of the code into a product for
+#     sale or license by, or on behalf of, User to third parties;
+# (2) distribution of the binary or source code to third parties for use with
+#     a commercial product sold or licensed by, or on behalf of, User.
+#
+
+"""
+Scheduler of upgrade and build jobs run by RPC server.
+Jobs wait in priority queue and are started when CPU slots, disk space
+and their work directories are available.
+"""
+
+import itertools
+import shutil
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import Future
+from typing import Callable, Deque, Dict, List
+from instrumentation import metrics
+
+
+current = threading.local()
+
+
+def report_progress(progress: str):
+    """Set progress of the job running in current thread, does nothing outside of jobs."""
+
+    job = getattr(current, 'job', None)
+    if job is not None:
+        job.progress = progress
+
+
+def output_subscriber() -> Callable[[str, str], None]:
+    """
+    Return subscriber of CommandRunner appending output to the job running in current thread.
+
+    Job is bound when subscriber is created, so it can be passed to commands run in worker threads.
+    Returns None outside of jobs.
+    """
+
+    job = getattr(current, 'job', None)
+    if job is None:
+        return None
+    return lambda stream, line: job.add_output(line)
+
+
+def current_job_labels() -> Dict[str, str]:
+    """Return id and type of the job running in current thread, empty outside of jobs."""
+
+    job = getattr(current, 'job', None)
+    if job is None:
+        return {}
+    return {'job_id': job.job_id, 'job_type': job.job_type}
+
+
+class Job:
+    """Single job queued in JobScheduler."""
+
+    job_id: str
+    job_type: str
+    priority: int
+    cpu_slots: int
+    disk_gb: float
+    work_dirs: List[str]
+    dedupe_key: tuple
+    progress: str
+    output: Deque[str]
+    output_lines: int
+    submitted_at: float
+    started_at: float
+    finished_at: float
+    future: Future
+
+    OUTPUT_LINES_KEPT = 1000
+
+    def __init__(self, job_id: str, job_type: str, function: Callable, args: tuple, priority: int,
+                 cpu_slots: int, disk_gb: float, work_dirs: List[str]):
+        self.job_id = job_id
+        self.job_type = job_type
+        self.function = function
+        self.args = args
+        self.priority = priority
+        self.cpu_slots = cpu_slots
+        self.disk_gb = disk_gb
+        self.work_dirs = work_dirs
+        self.dedupe_key = None
+        self.progress = None
+        self.output = deque(maxlen=self.OUTPUT_LINES_KEPT)
+        self.output_lines = 0
+        self.output_lock = threading.Lock()
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.future = Future()
+
+    @property
+    def wait_time(self) -> float:
+        return (self.started_at or time.time()) - self.submitted_at
+
+    def run(self):
+        self.future.set_running_or_notify_cancel()
+        current.job = self
+        try:
+            result = self.function(*self.args)
+        except SystemExit as error:
+            # successful exit() of the scripts (e.g. no new changesets) completes the job,
+            # failed one is stored as ordinary exception, so it does not stop the thread waiting for the job
+            self.finished_at = time.time()
+            if error.code:
+                self.future.set_exception(RuntimeError('exit code {}'.format(error.code)))
+            else:
+                self.future.set_result(None)
+        except BaseException as error:
+            self.finished_at = time.time()
+            self.future.set_exception(error)
+        else:
+            self.finished_at = time.time()
+            self.future.set_result(result)
+        finally:
+            current.job = None
+
+    def add_output(self, line: str):
+        with self.output_lock:
+            self.output.append(line)
+            self.output_lines += 1
+
+    def get_output(self, since: int = 0) -> Dict:
+        """
+        Return output lines of job commands starting from line number since.
+
+        Lines dropped from the buffer are skipped, NEXT is the number to pass in the next call.
+        """
+
+        with self.output_lock:
+            first = self.output_lines - len(self.output)
+            lines = list(self.output)[max(since - first, 0):]
+            return {'JOB_ID': self.job_id,
+                    'STATE': self.state,
+                    'SKIPPED': max(first - since, 0),
+                    'LINES': lines,
+                    'NEXT': self.output_lines}
+
+    @property
+    def state(self) -> str:
+        if self.future.done():
+            return 'failed' if self.future.exception() is not None else 'done'
+        return 'running' if self.started_at is not None else 'queued'
+
+    def status(self) -> Dict:
+        """Return job state and progress."""
+
+        status = {'JOB_ID': self.job_id,
+                  'TYPE': self.job_type,
+                  'STATE': self.state,
+                  'PROGRESS': self.progress,
+                  'SUBMITTED_AT': self.submitted_at,
+                  'STARTED_AT': self.started_at,
+                  'FINISHED_AT': self.finished_at,
+                  'WAIT_TIME': self.wait_time}
+        if self.future.done():
+            error = self.future.exception()
+            status['ERROR'] = None if error is None else '{}: {}'.format(type(error).__name__, error)
+        return status
+
+    def result(self) -> Dict:
+        """Return job status extended with result of finished job."""
+
+        status = self.status()
+        if self.future.done() and self.future.exception() is None:
+            status['RESULT'] = self.future.result()
+        return status
+
+
+class JobScheduler:
+    """
+    Class which is response for running jobs in order of priority,
+    sharing resources fairly between job types.
+    """
+
+    DEFAULT_PRIORITIES = {'upgradeBox': 0, 'upgradeBoxWithRC': 0, 'upgradeAllBoxes': 1, 'buildNightlySoft': 2}
+    DEFAULT_CPU_SLOTS = {'buildNightlySoft': 2}
+    RECHECK_INTERVAL = 10
+    FINISHED_JOBS_KEPT = 200
+    DEFAULT_RESULT_TTL = 300
+    DEFAULT_AGING_SECONDS = 300
+    DEFAULT_RESERVE_AFTER_SECONDS = 600
+    WAIT_TIME_SAMPLES = 1000
+
+    def __init__(self, scheduler_config: dict):
+        """Constructor of JobScheduler class.
+
+        Args:
+        scheduler_config (dict): Data taken from conf.json containing scheduler limits.
+        """
+
+        self.cpu_slots: int = int(scheduler_config.get('CPU_SLOTS', 1))
+        self.min_free_disk_gb: float = float(scheduler_config.get('MIN_FREE_DISK_GB', 0))
+        self.disk_path: str = scheduler_config.get('DISK_PATH', '/')
+        self.max_jobs_per_work_dir: int = int(scheduler_config.get('MAX_JOBS_PER_WORK_DIR', 1))
+        self.priorities: Dict[str, int] = dict(self.DEFAULT_PRIORITIES, **scheduler_config.get('PRIORITIES', {}))
+        self.job_cpu_slots: Dict[str, int] = dict(self.DEFAULT_CPU_SLOTS, **scheduler_config.get('JOB_CPU_SLOTS', {}))
+        self.result_ttl: float = float(scheduler_config.get('RESULT_TTL', self.DEFAULT_RESULT_TTL))
+        self.aging_seconds: float = float(scheduler_config.get('AGING_SECONDS', self.DEFAULT_AGING_SECONDS))
+        self.reserve_after_seconds: float = float(scheduler_config.get('RESERVE_AFTER_SECONDS',
+                                                                       self.DEFAULT_RESERVE_AFTER_SECONDS))
+
+        self.condition = threading.Condition()
+        self.ids = itertools.count(1)
+        self.jobs: Dict[str, Job] = {}
+        self.deduplicated: Dict[tuple, Job] = {}
+        self.requests: Dict[str, int] = defaultdict(int)
+        self.inflight_hits: Dict[str, int] = defaultdict(int)
+        self.cached_hits: Dict[str, int] = defaultdict(int)
+        self.pending: List[Job] = []
+        self.running: List[Job] = []
+        self.used_slots: int = 0
+        self.reserved_disk_gb: float = 0
+        self.work_dir_jobs: Dict[str, int] = defaultdict(int)
+        self.served: Dict[str, int] = defaultdict(int)
+        self.wait_times: Dict[str, Deque[float]] = defaultdict(lambda: deque(maxlen=self.WAIT_TIME_SAMPLES))
+        self.started_at: float = time.time()
+        self.busy_slot_seconds: float = 0
+        self.last_update: float = self.started_at
+
+        self.dispatcher = threading.Thread(target=self.dispatch, name='JobScheduler', daemon=True)
+        self.dispatcher.start()
+
+    def submit(self, job_type: str, function: Callable, *args, work_dirs: List[str] = None,
+               disk_gb: float = 0, dedupe_key: tuple = None) -> Job:
+        """
+        Queue job.
+
+        Request with dedupe_key equal to the key of queued or running job is attached to that job.
+        Successful result of finished job is reused for RESULT_TTL seconds.
+
+        Args:
+        job_type (str): type of job, used for priority and fair sharing
+        function (callable): function called in worker thread with args
+        work_dirs (list): work directories used by the job
+        disk_gb (float): disk space needed by the job
+        dedupe_key (tuple): identity of requested work, requests are never coalesced if not given
+
+        Returns:
+        Job: queued job, its future is resolved with function result
+        """
+
+        with self.condition:
+            self.requests[job_type] += 1
+            if dedupe_key is not None:
+                job = self.find_duplicate(dedupe_key)
+                if job is not None:
+                    self.jobs[job.job_id] = job
+                    print("Request {} attached to job {} ({})".format(dedupe_key, job.job_id, job.state))
+                    return job
+
+            cpu_slots = min(self.job_cpu_slots.get(job_type, 1), self.cpu_slots)
+            job = Job(str(next(self.ids)), job_type, function, args, self.priorities.get(job_type, 1),
+                      cpu_slots, disk_gb, work_dirs or [])
+            job.dedupe_key = dedupe_key
+            self.jobs[job.job_id] = job
+            if dedupe_key is not None:
+                self.deduplicated[dedupe_key] = job
+            self.pending.append(job)
+            self.condition.notify_all()
+        print("Queued job {} ({}), queue depth {}".format(job.job_id, job_type, len(self.pending)))
+        return job
+
+    def find_duplicate(self, dedupe_key: tuple) -> Job:
+        """Return in-flight job or recently succeeded job with the same key, counting the hit."""
+
+        job = self.deduplicated.get(dedupe_key)
+        if job is None:
+            return None
+
+        if not job.future.done():
+            self.inflight_hits[job.job_type] += 1
+            return job
+        if job.state == 'done' and time.time() - job.finished_at <= self.result_ttl:
+            self.cached_hits[job.job_type] += 1
+            return job
+
+        del self.deduplicated[dedupe_key]
+        return None
+
+    def get_job(self, job_id: str) -> Job:
+        """Return job with given id, raise KeyError for unknown or forgotten jobs."""
+
+        with self.condition:
+            if job_id not in self.jobs:
+                raise KeyError('Unknown job {}'.format(job_id))
+            return self.jobs[job_id]
+
+    def forget_finished_jobs(self):
+        finished = [job for job in self.jobs.values() if job.finished_at is not None]
+        finished.sort(key=lambda job: job.finished_at)
+        for job in finished[:max(len(finished) - self.FINISHED_JOBS_KEPT, 0)]:
+            del self.jobs[job.job_id]
+
+        now = time.time()
+        for dedupe_key, job in list(self.deduplicated.items()):
+            if job.finished_at is not None and (job.state != 'done' or now - job.finished_at > self.result_ttl):
+                del self.deduplicated[dedupe_key]
+
+    def free_disk_gb(self) -> float:
+        return shutil.disk_usage(self.disk_path).free / 1024 ** 3 - self.reserved_disk_gb
+
+    def is_admissible(self, job: Job, free_disk_gb: float) -> bool:
+        if self.used_slots + job.cpu_slots > self.cpu_slots:
+            return False
+        if free_disk_gb - job.disk_gb < self.min_free_disk_gb:
+            return False
+        return all(self.work_dir_jobs[work_dir] < self.max_jobs_per_work_dir for work_dir in job.work_dirs)
+
+    def effective_priority(self, job: Job) -> int:
+        """Priority of job raised by one level for every AGING_SECONDS spent in queue."""
+
+        if self.aging_seconds <= 0:
+            return job.priority
+        return job.priority - int(job.wait_time // self.aging_seconds)
+
+    def next_job(self) -> Job:
+        """
+        Select job which can be started now.
+
+        Jobs are ordered by priority raised with time spent in queue, then job types which
+        were served less often go first, then jobs are taken in submission order.
+        Job which cannot be started after waiting RESERVE_AFTER_SECONDS is not bypassed
+        by jobs behind it, so slots freed by finishing jobs are reserved for it
+        (e.g. nightly build needing more slots than single upgrades).
+        """
+
+        if not self.pending:
+            return None
+        free_disk_gb = self.free_disk_gb()
+        order = sorted(self.pending, key=lambda job: (self.effective_priority(job), self.served[job.job_type],
+                                                      job.submitted_at))
+        for job in order:
+            if self.is_admissible(job, free_disk_gb):
+                return job
+            if job.wait_time >= self.reserve_after_seconds:
+                return None
+        return None
+
+    def try_next_job(self) -> Job:
+        """Select job like next_job, failure of the check (e.g. unmounted DISK_PATH) admits no job."""
+
+        try:
+            return self.next_job()
+        except Exception as error:
+            print("Checking queued jobs failed, retrying in {}s: {}".format(self.RECHECK_INTERVAL, error))
+            return None
+
+    def update_utilisation(self):
+        now = time.time()
+        self.busy_slot_seconds += self.used_slots * (now - self.last_update)
+        self.last_update = now
+
+    def dispatch(self):
+        while True:
+            with self.condition:
+                job = self.try_next_job()
+                while job is None:
+                    self.condition.wait(self.RECHECK_INTERVAL)
+                    job = self.try_next_job()
+
+                self.update_utilisation()
+                self.pending.remove(job)
+                self.running.append(job)
+                self.used_slots += job.cpu_slots
+                self.reserved_disk_gb += job.disk_gb
+                for work_dir in job.work_dirs:
+                    self.work_dir_jobs[work_dir] += 1
+                self.served[job.job_type] += 1
+                job.started_at = time.time()
+                self.wait_times[job.job_type].append(job.wait_time)
+
+            print("Starting job {} ({}) after {:.0f}s in queue".format(job.job_id, job.job_type, job.wait_time))
+            metrics.record('queue_wait', job.wait_time, job_id=job.job_id, job_type=job.job_type)
+            threading.Thread(target=self.execute, args=(job,), name='Job-{}'.format(job.job_id), daemon=True).start()
+
+    def execute(self, job: Job):
+        try:
+            job.run()
+        finally:
+            with self.condition:
+                self.update_utilisation()
+                self.running.remove(job)
+                self.used_slots -= job.cpu_slots
+                self.reserved_disk_gb -= job.disk_gb
+                for work_dir in job.work_dirs:
+                    self.work_dir_jobs[work_dir] -= 1
+                self.forget_finished_jobs()
+                self.condition.notify_all()
+            print("Finished job {} ({}) with state {} in {:.0f}s".format(job.job_id, job.job_type, job.state,
+                                                                       job.finished_at - job.started_at))
+            metrics.record('job', job.finished_at - job.started_at, 'error' if job.state == 'failed' else 'ok',
+                           job_id=job.job_id, job_type=job.job_type)
+
+    def stats(self) -> Dict:
+        """Return queue depth, wait times and slot utilisation."""
+
+        with self.condition:
+            self.update_utilisation()
+            elapsed = max(self.last_update - self.started_at, 1e-9)
+            return {'QUEUE_DEPTH': len(self.pending),
+                    'QUEUED_BY_TYPE': {job_type: sum(1 for job in self.pending if job.job_type == job_type)
+                                       for job_type in set(job.job_type for job in self.pending)},
+                    'RUNNING': len(self.running),
+                    'USED_SLOTS': self.used_slots,
+                    'TOTAL_SLOTS': self.cpu_slots,
+                    'SLOT_UTILISATION': self.busy_slot_seconds / (self.cpu_slots * elapsed),
+                    'FREE_DISK_GB': self.free_disk_gb(),
+                    'WAIT_TIME': {job_type: {'COUNT': len(times),
+                                             'AVG': sum(times) / len(times),
+                                             'MAX': max(times)}
+                                  for job_type, times in self.wait_times.items()},
+                    'OLDEST_QUEUED_WAIT': max((job.wait_time for job in self.pending), default=0.0),
+                    'DEDUPE': {job_type: {'REQUESTS': requests,
+                                          'INFLIGHT_HITS': self.inflight_hits[job_type],
+                                          'CACHED_HITS': self.cached_hits[job_type],
+                                          'HIT_RATE': (self.inflight_hits[job_type] + self.cached_hits[job_type]) / requests}
+                               for job_type, requests in self.requests.items()}}
@@ -30,10 +30,23 @@ so it is possible to easy copy/remove files.
 
 import os
 import json
-import glob
+import shutil
 import subprocess
+import tempfile
 import time
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from typing import Dict, List
 from JiraInstance import JiraInstance
+from package_inspector import extract_files, inspect_package
+from file_ops import clone_file
+from copy_engine import CopyEngine
+from execution_context import ExecutionContext, work_dir_lock
+from retention import RetentionSweeper
+from source_mirror import SourceMirror, get_mirror
+from incremental_build import BUILD_MODES, CLEAN, INCREMENTAL, get_revisions, needs_clean_build, record_build
+from job_scheduler import report_progress, current_job_labels, output_subscriber
+from command_runner import CommandError, CommandRunner
+from instrumentation import metrics
 
 
 class Builder:
@@ -50,8 +63,20 @@ class Builder:
     secure_bootimage_filename: str
     remote_location: str
     remove_files_time_in_days: int
+    remote_quota_gb: float
+    protected_builds: List[str]
+    retention_dry_run: bool
     build_dir: str
+    parallel_builds: bool
+    build_cpu_split: float
+    build_mode: str
+    clean_build_patterns: List[str]
+    source_mirror: SourceMirror
+    command_runner: CommandRunner
+    copy_engine: CopyEngine
+    context: ExecutionContext
     sw_tag: str
+    job_labels: Dict[str, str]
     jira_instance: JiraInstance
 
     def __init__(self, build_config: dict, jira_config: dict):
@@ -73,24 +98,54 @@ class Builder:
         self.secure_bootimage_filename = build_config["SECURE_BOOTIMAGE_FILENAME"]
         self.remote_location = build_config["REMOTE_LOCATION"]
         self.remove_files_time_in_days = int(build_config["REMOVE_FILES_AFTER_DAYS"])
+        self.remote_quota_gb = build_config.get("REMOTE_QUOTA_GB")
+        self.protected_builds = build_config.get("PROTECTED_BUILDS", [])
+        self.retention_dry_run = build_config.get("RETENTION_DRY_RUN", False)
         self.build_dir = os.path.join(self.work_dir, self.branch)
+        self.parallel_builds = build_config.get("PARALLEL_BUILDS", False)
+        self.build_cpu_split = float(build_config.get("BUILD_CPU_SPLIT", 0.5))
+        self.build_mode = build_config.get("BUILD_MODE", CLEAN)
+        if self.build_mode not in BUILD_MODES:
+            raise ValueError("Unknown BUILD_MODE {}, expected one of {}".format(self.build_mode, BUILD_MODES))
+        self.clean_build_patterns = build_config.get("CLEAN_BUILD_PATTERNS")
+        self.source_mirror = get_mirror(build_config)
         self.sw_tag = None
-        self.jira_instance = JiraInstance(jira_config)
-
-    def call_command(self, command: str):
+        self.context = ExecutionContext(self.build_dir)
+        self.job_labels = current_job_labels()
+        self.command_runner = CommandRunner(build_config.get("FATAL_ERROR_PATTERNS"),
+                                            int(build_config.get("OUTPUT_TAIL_LINES", 200)))
+        self.command_runner.subscribe(output_subscriber())
+        self.copy_engine = CopyEngine(int(build_config.get("COPY_WORKERS", 4)),
+                                      int(float(build_config.get("COPY_BUFFER_MB", 8)) * 1024 ** 2),
+                                      build_config.get("COPY_VERIFY", True))
+        self.jira_instance = JiraInstance(jira_config, "{}:{}".format(self.branch, self.debug_project or
+                                                                       self.secure_project))
+
+    def span(self, phase: str, project: str = None):
+        """Measure phase of the nightly build, of the given project if it concerns only one."""
+
+        return metrics.span(phase, project=project, branch=self.branch, **self.job_labels)
+
+    def call_command(self, command: str, cwd: str = None, exit_on_error: bool = True):
         """
-        Call specific command.
+        Call specific command, its output is streamed to the job and aborted after fatal error.
 
         Args:
         command (str): command which will be called
+        cwd (str): directory in which command will be called, build directory if not given
+        exit_on_error (bool): clean and exit when command fails, otherwise CommandError is raised
         """
 
         try:
-            subprocess.check_call(command, shell=True, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as error:
+            self.command_runner.run(command, cwd=cwd or self.context.work_dir, env=self.context.environ())
+        except CommandError as error:
+            print(error)
+            print("Last {} line(s) of output:".format(len(error.tail)))
             print(error.output)
+            if exit_on_error is False:
+                raise
             self.clean()
-            exit(0)
+            exit(1)
 
     def clean(self):
         """
@@ -109,19 +164,56 @@ class Builder:
         print("Preparing working directories ...")
         os.makedirs(self.work_dir, exist_ok=True)
         os.makedirs(self.build_dir, exist_ok=True)
-        os.chdir(self.build_dir)
+        if self.parallel_builds is True:
+            os.makedirs(self.get_work_tree(False), exist_ok=True)
         print("Done")
 
+    def get_work_tree(self, is_debug: bool) -> str:
+        """
+        Get source tree in which variant is built.
+
+        In parallel mode secure software is built in its own tree,
+        so cleaning and tagging of debug tree does not affect it.
+
+        Args:
+        is_debug (bool): flag indicating if software is debug
+        """
+
+        if self.parallel_builds is True and is_debug is False:
+            return "{}-secure".format(self.build_dir)
+        return self.build_dir
+
+    def get_cpu_sets(self) -> List[List[int]]:
+        """Split available CPUs between debug and secure build according to BUILD_CPU_SPLIT."""
+
+        cpus = sorted(os.sched_getaffinity(0))
+        debug_cpus = max(1, min(len(cpus) - 1, round(len(cpus) * self.build_cpu_split)))
+        if len(cpus) < 2:
+            return [cpus, cpus]
+        return [cpus[:debug_cpus], cpus[debug_cpus:]]
+
     def prepare_software_tag(self):
         """Prepare software tag based on current datetime."""
 
         print("Setting SRM_BUILD_ID ...")
-        command = 'date +"%Y_%m_%d"'
-        ps = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, shell=True)
-        self.sw_tag = str(ps.communicate()[0], "utf-8").rstrip("\n")
-        os.system('export SRM_BUILD_ID={}'.format(self.sw_tag))
+        self.sw_tag = time.strftime("%Y_%m_%d")
+        self.context.set_env("SRM_BUILD_ID", self.sw_tag)
         print("Done: SRM_BUILD_ID={}".format(self.sw_tag))
 
+    def pull(self, work_tree: str):
+        """Update sources in work tree, from local mirror if MIRROR_DIR is configured."""
+
+        fetch_command = 'nosilo pull {} -ym'.format(self.branch)
+        if self.source_mirror is None:
+            self.call_command(fetch_command, cwd=work_tree)
+            return
+        try:
+            self.source_mirror.checkout(self.branch, fetch_command, work_tree)
+        except subprocess.CalledProcessError as error:
+            print("Updating {} from mirror failed: {}".format(work_tree, error))
+            self.clean()
+            exit(1)
+
     def prepare(self):
         """Prepare directories, files, software tag."""
 
@@ -132,168 +224,235 @@ class Builder:
 
         self.prepare_directories()
 
-        print("Pulling branch {} to {} ...".format(self.branch, self.build_dir))
-        self.call_command('nosilo pull {} -ym'.format(self.branch))
+        work_trees = [self.build_dir]
+        if self.parallel_builds is True and self.secure_project is not None:
+            work_trees.append(self.get_work_tree(False))
+
+        for work_tree in work_trees:
+            print("Pulling branch {} to {} ...".format(self.branch, work_tree))
+        with ThreadPoolExecutor(max_workers=len(work_trees)) as executor:
+            list(executor.map(self.pull, work_trees))
         print("Pulling done.")
 
         self.prepare_software_tag()
 
-    def prepare_usb_recovery(self, sw_type: str, output_directory_path: str):
+    def prepare_usb_recovery(self, sw_type_dir: str, upgrade_package: str):
         """
         Generate USB Recovery.
 
+        BOOTIMAGE and LOGO are extracted from the package in one pass, files for debug
+        and secure names are hardlinks (or clones) of the single extracted copy.
+
         Args:
-        sw_type (str): software type (Debug, Secure).
-        output_directory_path (str): path to wich usb recovery files will be copied.
+        sw_type_dir (str): software type directory (Debug, Secure).
+        upgrade_package (str): path to upgrade package containing images.
         """
 
-        print("Generating USB recovery for {} software".format(sw_type))
-        usb_recovery_path = os.path.join(sw_type, "USBRecovery")
+        print("Generating USB recovery for {} software".format(os.path.basename(sw_type_dir)))
+        usb_recovery_path = os.path.join(sw_type_dir, "USBRecovery")
         os.makedirs(usb_recovery_path, exist_ok=True)
 
-        package = glob.glob(os.path.join(output_directory_path, "*tgz"))[0]
-        assert len(package) > 0
-        self.call_command("tar -vxf {} --wildcards --no-anchored 'BOOTIMAGE*'".format(package))
-
-        bootimg_file = glob.glob("*BOOTIMAGE*")[0]
-        assert len(bootimg_file) > 0
-
-        if self.debug_bootimage_filename is not None and self.debug_bootimage_filename is not "":
-            os.system("cp {} {}".format(bootimg_file,
-                                        os.path.join(usb_recovery_path,
-                                                     self.debug_bootimage_filename)))
-        if self.secure_bootimage_filename is not None and self.secure_bootimage_filename is not "":
-            os.system("cp {} {}".format(bootimg_file,
-                                        os.path.join(usb_recovery_path,
-                                                     self.secure_bootimage_filename)))
-
-        os.system("tar -vxf {} --wildcards --no-anchored 'LOGO*'".format(package))
-        logo_file = glob.glob("*LOGO*")[0]
-        assert len(logo_file) > 0
-
-        if self.debug_logo_filename is not None and self.debug_logo_filename is not "":
-            os.system("cp {} {}".format(logo_file,
-                                        os.path.join(usb_recovery_path,
-                                                     self.debug_logo_filename)))
-        if self.secure_logo_filename is not None and self.secure_logo_filename is not "":
-            os.system("cp {} {}".format(logo_file,
-                                        os.path.join(usb_recovery_path,
-                                                     self.secure_logo_filename)))
-
-        os.system("rm -rf {}".format(bootimg_file))
-        os.system("rm -rf {}".format(logo_file))
+        images = {"*BOOTIMAGE*": [self.debug_bootimage_filename, self.secure_bootimage_filename],
+                  "*LOGO*": [self.debug_logo_filename, self.secure_logo_filename]}
+        extract_dir = tempfile.mkdtemp(prefix=".extract-", dir=usb_recovery_path)
+        try:
+            extracted = extract_files(upgrade_package, list(images), extract_dir)
+            for pattern, filenames in images.items():
+                assert pattern in extracted, "No {} in {}".format(pattern, upgrade_package)
+                for filename in filenames:
+                    if filename is not None and filename != "":
+                        method = clone_file(extracted[pattern], os.path.join(usb_recovery_path, filename))
+                        print("{} -> {} ({})".format(os.path.basename(extracted[pattern]), filename, method))
+        finally:
+            shutil.rmtree(extract_dir, ignore_errors=True)
         print("Done")
 
     def copy_packages_to_remote_location(self, directory: str):
-        """Copy prepared packages and USB Recovery to remote location."""
+        """
+        Copy prepared packages and USB Recovery to remote location.
+
+        Directory appears in remote location only when all its files are copied and verified,
+        together with MD5SUMS manifest.
+        """
 
         remote_location = os.path.join(self.remote_location, self.sw_tag)
         print("Copying packages to remote location: {}".format(remote_location))
-        os.makedirs(remote_location, exist_ok=True)
-        os.system("cp -r {} {}".format(directory, remote_location))
+        report = self.copy_engine.copy_tree(directory, os.path.join(remote_location, os.path.basename(directory)))
+        print("Copied {} files, {:.1f} MB in {:.1f}s ({:.1f} MB/s)".format(report.files, report.bytes / 1024 ** 2,
+                                                                         report.duration, report.mb_per_s))
 
-    def build(self, project: str, is_debug: bool):
+    def run_pysilo(self, project: str, work_tree: str, build_flags: str, build_env: str):
+        """
+        Run pysilo for project according to BUILD_MODE.
+
+        In incremental mode build products of the previous run are reused, unless files
+        changed since the last successful build require clean build. Failed incremental
+        build is repeated as clean one.
+
+        Args:
+        project (str): project which will be built
+        work_tree (str): source tree in which project is built
+        build_flags (str): build variables which output depends on
+        build_env (str): build variables together with CPU limits, prepended to pysilo
+        """
+
+        command = '{} pysilo {}--project {}'
+        if self.build_mode == CLEAN:
+            self.call_command(command.format(build_env, '--clean ', project), cwd=work_tree)
+            return
+
+        revisions = get_revisions(work_tree)
+        clean_build, reason = needs_clean_build(work_tree, project, build_flags, revisions, self.clean_build_patterns)
+        print("{} build of {}: {}".format("Clean" if clean_build else "Incremental", project, reason))
+        if clean_build is False:
+            try:
+                self.call_command(command.format(build_env, '', project), cwd=work_tree,
+                                  exit_on_error=False)
+                record_build(work_tree, project, build_flags, revisions, True)
+                return
+            except subprocess.CalledProcessError:
+                print("Incremental build of {} failed, falling back to clean build".format(project))
+
+        record_build(work_tree, project, build_flags, revisions, False)
+        self.call_command(command.format(build_env, '--clean ', project), cwd=work_tree)
+        record_build(work_tree, project, build_flags, revisions, True)
+
+    def build(self, project: str, is_debug: bool, cpus: List[int] = None):
         """
         Build single project. Software will be tagged by tag prepared in prepare() method.
         USB Recovery will be created with file names pointed in conf.json.
 
         Args:
+            project (str): project which will be built
             is_debug (bool): flag indicating if building software is debuf
+            cpus (list): CPUs to which build is limited, all CPUs if not given
         """
 
-        print("Build project {}".format(project))
-        if is_debug is True:
-            self.call_command('export SRM_BUILD_ID={} &&  \
-                              SvDebug=yes SvDebugBuild=yes SvKeepStack=yes \
-                              pysilo --project {}'.format(self.sw_tag, project))
-        else:
-            self.call_command('export SRM_BUILD_ID={} \
-                              && pysilo --project {}'.format(self.sw_tag, project))
+        work_tree = self.get_work_tree(is_debug)
+        build_flags = "SvDebug=yes SvDebugBuild=yes SvKeepStack=yes" if is_debug is True else ""
+        build_env = build_flags
+        if cpus is not None and shutil.which("taskset") is not None:
+            build_env += " MAKEFLAGS=-j{} taskset -c {}".format(len(cpus), ",".join(str(cpu) for cpu in cpus))
+
+        print("Build project {} in {}".format(project, work_tree))
+        with self.span("pysilo", project):
+            self.run_pysilo(project, work_tree, build_flags, build_env)
         print("Build done.")
 
-        upgrade_package = glob.glob(os.path.join("sbuild-{}".format(project), "*upgrade*.tgz"))[0]
+        upgrade_package = self.context.child(work_tree).glob(os.path.join("sbuild-{}".format(project),
+                                                                          "*upgrade*.tgz"))[0]
         assert len(upgrade_package) > 0
 
-        cmd = 'tar -ztf {} | grep "md5$"'.format(upgrade_package)
-        ps = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, shell=True)
-        upgrade_file = str(ps.communicate()[0], "utf-8").rstrip("\n")
-        assert len(upgrade_file) > 0
-
-        cmd = "tar -O -zxf {} {} | head -n 1 | awk '{{print $1}}'".format(upgrade_package,
-                                                                          upgrade_file)
-
-        ps = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, shell=True)
-        version_md5_hash = str(ps.communicate()[0], "utf-8").rstrip("\n")
+        version_md5_hash = inspect_package(upgrade_package).version_md5_hash
         assert len(version_md5_hash) > 0
 
-        if is_debug is True:
-            print("Cleaning before tagging ...")
-            self.call_command('nosilo foreach "hg revert --all && hg purge"')
-            print("Done")
+        # Every variant reverts its own work tree, in parallel mode secure tree is not shared with debug one.
+        print("Cleaning {} ...".format(work_tree))
+        if self.build_mode == INCREMENTAL:
+            self.call_command('nosilo foreach "hg revert --all"', cwd=work_tree)
+        else:
+            self.call_command('nosilo foreach "hg revert --all && hg purge"', cwd=work_tree)
+        print("Done")
 
+        if is_debug is True:
             print("Tagging new software ...")
-            self.call_command('nosilo tag {} --name=bluelab_{}_{}'.format(self.branch,
-                                                                          self.sw_tag,
-                                                                          version_md5_hash))
+            with self.span("tag", project):
+                self.call_command('nosilo tag {} --name=bluelab_{}_{}'.format(self.branch,
+                                                                              self.sw_tag,
+                                                                              version_md5_hash),
+                                  cwd=work_tree)
 
-        sw_type_dir = "Debug" if is_debug is True else "Secure"
+        sw_type_dir = self.context.path("Debug" if is_debug is True else "Secure")
         os.makedirs(sw_type_dir, exist_ok=True)
-        tmp_dir = "__temp"
-        os.makedirs(tmp_dir, exist_ok=True)
-        self.call_command("tar zxvf {} -C {}".format(upgrade_package, tmp_dir))
-        self.call_command('cp {} {}'.format(upgrade_package, sw_type_dir))
+        # Package in sbuild can be rewritten in place by the next incremental build, so it is never hardlinked.
+        clone_file(upgrade_package, os.path.join(sw_type_dir, os.path.basename(upgrade_package)), hardlink=False)
 
         if self.generate_usb_recovery is True:
-            self.prepare_usb_recovery(sw_type_dir, tmp_dir)
+            with self.span("usb_recovery", project):
+                self.prepare_usb_recovery(sw_type_dir, upgrade_package)
 
         if self.remote_location is not None and self.remote_location is not "":
-            self.copy_packages_to_remote_location(sw_type_dir)
+            with self.span("copy_remote", project):
+                self.copy_packages_to_remote_location(sw_type_dir)
+
+    def measured_build(self, project: str, is_debug: bool, cpus: List[int] = None):
+        with self.span("build", project):
+            self.build(project, is_debug, cpus)
 
     def remove_oldest_packages(self):
         """
-        Delete oldest than REMOVE_FILES_AFTER_DAYS nightly build packages from remote location.
-        Value REMOVE_FILES_AFTER_DAYS is defined in conf.json.
+        Delete oldest than REMOVE_FILES_AFTER_DAYS nightly build packages from remote location,
+        then the oldest ones until remote location fits in REMOTE_QUOTA_GB.
+        Builds matching PROTECTED_BUILDS patterns and the current build are kept.
+        Values are defined in conf.json.
         """
 
-        current_time = time.time()
-        for d in os.listdir(self.remote_location):
-            dir_path = os.path.join(self.remote_location, d)
-            if not os.path.isdir(dir_path):
-                continue
+        if self.remote_location is None or self.remote_location == "" or not os.path.isdir(self.remote_location):
+            return
 
-            created = os.stat(dir_path).st_ctime
-            if (current_time - created) // (24*3600) >= self.remove_files_time_in_days:
-                os.system("rm -rf {}".format(self.remote_location, d))
+        protected = self.protected_builds + ([self.sw_tag] if self.sw_tag is not None else [])
+        sweeper = RetentionSweeper(self.remote_location, self.remove_files_time_in_days, self.remote_quota_gb,
+                                   protected, dry_run=self.retention_dry_run)
+        return sweeper.sweep()
 
     def build_nightly_projects(self):
         """
         Build single nightly project.
 
         This method aggregates all needed methods to build, tag and do update in Jira tasks.
+        Branch work directory is locked for the whole run, so jobs sharing it are not run at once.
         """
 
-        self.prepare()
-
-        #self.remove_oldest_packages()
-        if self.debug_project is not None:
-            print("Start building debug Nightly Build ...")
-            self.build(self.debug_project, True)
+        with work_dir_lock(self.build_dir):
+            report_progress("prepare")
+            with self.span("prepare"):
+                self.prepare()
+
+            with self.span("retention"):
+                self.remove_oldest_packages()
+            builds = []
+            if self.debug_project is not None:
+                builds.append((self.debug_project, True))
+            else:
+                print("Skipping build debug software")
+            if self.secure_project is not None:
+                builds.append((self.secure_project, False))
+            else:
+                print("Skipping build secure software")
+
+            report_progress("build")
+            if self.parallel_builds is True and len(builds) > 1:
+                print("Start building debug and secure Nightly Build in parallel ...")
+                cpu_sets = self.get_cpu_sets()
+                with ThreadPoolExecutor(max_workers=len(builds)) as executor:
+                    futures = [executor.submit(self.measured_build, project, is_debug, cpu_sets[0 if is_debug else 1])
+                               for project, is_debug in builds]
+                    done, pending = wait(futures, return_when=FIRST_EXCEPTION)
+                    failed = [future for future in done if future.exception() is not None]
+                    if failed:
+                        print("Parallel build failed, aborting the other build ...")
+                        self.command_runner.abort("other parallel build failed")
+                        for future in pending:
+                            future.cancel()
+                    for future in failed + futures:
+                        future.result()
+                print("Done")
+            else:
+                for project, is_debug in builds:
+                    print("Start building {} Nightly Build ...".format("debug" if is_debug else "secure"))
+                    self.measured_build(project, is_debug)
+                    print("Done")
+
+            fixed_version = "CURRENT_{}".format(self.sw_tag)
+            report_progress("jira")
+            print("Updating fixedVersion {} for changelog tasks ...".format(fixed_version))
+            with self.span("jira"):
+                self.jira_instance.add_fixed_version_to_tasks(fixed_version)
+                self.jira_instance.commit_changelog_watermark()
             print("Done")
-        else:
-            print("Skipping build debug software")
-        if self.secure_project is not None:
-            print("Start building secure Nightly Build ...")
-            self.build(self.secure_project, False)
-            print("Done")
-        else:
-            print("Skipping build secure software")
-
-        fixed_version = "CURRENT_{}".format(self.sw_tag)
-        print("Updating fixedVersion {} for changelog tasks ...".format(fixed_version))
-        self.jira_instance.add_fixed_version_to_tasks(fixed_version)
-        print("Done")
 
-        self.clean()
+            with self.span("clean"):
+                self.clean()
 
 def main():
     """
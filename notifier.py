@@ -0,0 +1,198 @@
+#!/usr/bin/python3
+
+#
+# TiVo Poland Sp. z o.o. Software License Version 1.0
+#
+# Copyright (C) 2008-2019 TiVo Poland Sp. z o.o. All rights reserved.
+#
+# Any rights which are not expressly granted in this License are entirely and
+# exclusively reserved to and by TiVo Poland Sp. z o.o. You may not rent, lease,
+# modify, translate, reverse engineer, decompile, disassemble, or create
+# derivative works based on this Software. You may not make access to this
+# Software available to others in connection with a service bureau,
+# application service provider, or similar business, or make any other use of
+# this Software without express written permission from TiVo Poland Sp. z o.o.
+#
+# Any User wishing to make use of this Software must contact
+# TiVo Poland Sp. z o.o. to arrange an appropriate license. Use of the Software
+# includes, but is not limited to:
+# (1) integrating or incorporating all or part of the code into a product for
+#     sale or license by, or on behalf of, User to third parties;
+# (2) distribution of the binary or source code to third parties for use with
+#     a commercial product sold or licensed by, or on behalf of, User.
+#
+
+
+"""
+Email notifications sent in background.
+
+Messages are queued and sent by a single sender thread over one SMTP connection,
+which is reused while messages keep coming and closed after being idle.
+Failed sends are retried with growing delay, without blocking the caller.
+"""
+
+import queue
+import smtplib
+import threading
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from typing import Dict, Tuple
+
+PER_BOX = 'per_box'
+DIGEST = 'digest'
+NOTIFY_MODES = (PER_BOX, DIGEST)
+
+
+class Notifier:
+    """Class which is response for sending queued emails over reused SMTP connection."""
+
+    def __init__(self, smtp_host: str, smtp_port: int, max_retries: int = 3, retry_delay: float = 5,
+                 idle_timeout: float = 30):
+        """Constructor of Notifier class.
+
+        Args:
+        smtp_host (str): address of SMTP server
+        smtp_port (int): port of SMTP server
+        max_retries (int): number of retries of failed message before it is dropped
+        retry_delay (float): delay before first retry, doubled with every next one
+        idle_timeout (float): seconds after which unused connection is closed
+        """
+
+        self.smtp_host = smtp_host
+        self.smtp_port = smtp_port
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.idle_timeout = idle_timeout
+        self.queue: queue.Queue = queue.Queue()
+        self.unfinished = 0
+        self.finished = threading.Condition()
+        self.connection: smtplib.SMTP = None
+        self.lock = threading.Lock()
+        self.counters: Dict[str, int] = {'QUEUED': 0, 'SENT': 0, 'RETRIED': 0, 'DROPPED': 0, 'CONNECTIONS': 0}
+        self.sender = threading.Thread(target=self.send_loop, name='Notifier', daemon=True)
+        self.sender.start()
+
+    def count(self, name: str):
+        with self.lock:
+            self.counters[name] += 1
+
+    def send(self, from_address: str, to_address: str, subject: str, message: str):
+        """Queue plain text email, returns immediately."""
+
+        msg = MIMEMultipart()
+        msg['From'] = from_address
+        msg['To'] = to_address
+        msg['Subject'] = subject
+        msg.attach(MIMEText(message, 'plain'))
+        self.count('QUEUED')
+        with self.finished:
+            self.unfinished += 1
+        self.queue.put((from_address, to_address, msg.as_string(), 0))
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        Wait until all queued messages are sent or dropped.
+
+        Args:
+        timeout (float): maximal waiting time, unlimited if not given
+
+        Returns:
+        bool: True if queue was emptied
+        """
+
+        with self.finished:
+            return self.finished.wait_for(lambda: self.unfinished == 0, timeout)
+
+    def connect(self) -> smtplib.SMTP:
+        if self.connection is not None:
+            try:
+                self.connection.noop()
+                return self.connection
+            except smtplib.SMTPException:
+                self.disconnect()
+        connection = smtplib.SMTP()
+        connection.connect(self.smtp_host, self.smtp_port)
+        self.connection = connection
+        self.count('CONNECTIONS')
+        return connection
+
+    def disconnect(self):
+        connection, self.connection = self.connection, None
+        if connection is None:
+            return
+        try:
+            connection.quit()
+        except (smtplib.SMTPException, OSError):
+            connection.close()
+
+    def done(self):
+        with self.finished:
+            self.unfinished -= 1
+            self.finished.notify_all()
+
+    def deliver(self, from_address: str, to_address: str, msg: str, attempt: int) -> bool:
+        """Send message, schedule its retry on failure. Returns False if message is still pending."""
+
+        try:
+            self.connect().sendmail(from_addr=from_address, to_addrs=to_address, msg=msg)
+            self.count('SENT')
+        except (smtplib.SMTPException, OSError) as error:
+            self.disconnect()
+            if attempt >= self.max_retries:
+                print('Dropping email to {} after {} attempt(s): {}'.format(to_address, attempt + 1, error))
+                self.count('DROPPED')
+                return True
+            delay = self.retry_delay * 2 ** attempt
+            print('Sending email to {} failed, retrying in {:.0f}s: {}'.format(to_address, delay, error))
+            self.count('RETRIED')
+            timer = threading.Timer(delay, self.queue.put, args=((from_address, to_address, msg, attempt + 1),))
+            timer.daemon = True
+            timer.start()
+            return False
+        return True
+
+    def send_loop(self):
+        while True:
+            try:
+                item: Tuple[str, str, str, int] = self.queue.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                self.disconnect()
+                continue
+            try:
+                finished = self.deliver(*item)
+            except Exception as error:
+                print('Unexpected error while sending email: {}'.format(error))
+                finished = True
+            if finished:
+                self.done()
+
+    def stats(self) -> Dict[str, int]:
+        """Return numbers of queued, sent, retried and dropped messages and opened connections."""
+
+        with self.lock:
+            return dict(self.counters, PENDING=self.queue.qsize())
+
+
+notifiers: Dict[Tuple[str, int], Notifier] = {}
+notifiers_lock = threading.Lock()
+
+
+def get_notifier(config: dict) -> Notifier:
+    """
+    Return notifier shared by all jobs of the process.
+
+    Args:
+    config (dict): UPGRADE entry with SMTP_HOST, SMTP_PORT and NOTIFY_* settings
+
+    Returns:
+    Notifier: notifier of the configured SMTP server
+    """
+
+    key = (config.get('SMTP_HOST', 'localhost'), int(config.get('SMTP_PORT', 25)))
+    with notifiers_lock:
+        notifier = notifiers.get(key)
+        if notifier is None:
+            notifier = Notifier(key[0], key[1], int(config.get('NOTIFY_MAX_RETRIES', 3)),
+                                float(config.get('NOTIFY_RETRY_DELAY', 5)))
+            notifiers[key] = notifier
+        return notifier
@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+
+#
+# TiVo Poland Sp. z o.o. Software License Version 1.0
+#
+# Copyright (C) 2008-2019 TiVo Poland Sp. z o.o. All rights reserved.
+#
+# Any rights which are not expressly granted in this License are entirely and
+# exclusively reserved to and by TiVo Poland Sp. z o.o. You may not rent, lease,
+# modify, translate, reverse engineer, decompile, disassemble, or create
+# derivative works based on this Software. You may not make access to this
+# Software available to others in connection with a service bureau,
+# application service provider, or similar business, or make any other use of
+# this Software without express written permission from TiVo Poland Sp. z o.o.
+#
+# Any User wishing to make use of this Software must contact
+# TiVo Poland Sp. z o.o. to arrange an appropriate license. Use of the Software
+# includes, but is not limited to:
+# (1) integrating or incorporating all or part of the code into a product for
+#     sale or license by, or on behalf of, User to third parties;
+# (2) distribution of the binary or source code to third parties for use with
+#     a commercial product sold or licensed by, or on behalf of, User.
+#
+
+"""
+Inspection of upgrade packages (*upgrade*.tgz) produced by pysilo.
+Package is streamed once in-process, without spawning tar.
+"""
+
+import fnmatch
+import os
+import shutil
+import tarfile
+from typing import Dict, List
+
+
+class PackageInfo:
+    """Result of upgrade package inspection."""
+
+    path: str
+    md5_member: str
+    version_md5_hash: str
+
+    def __init__(self, path: str):
+        self.path = path
+        self.md5_member = None
+        self.version_md5_hash = None
+
+
+def read_version_md5_hash(fileobj) -> str:
+    """Return first word of the first line of .md5 file, the same as 'head -n 1 | awk {print $1}'."""
+
+    words = fileobj.readline().decode('utf-8').split()
+    return words[0] if words else ''
+
+
+def inspect_package(path: str) -> PackageInfo:
+    """
+    Inspect upgrade package in single streaming pass, reading stops right after .md5 member.
+
+    Files of the package are extracted with extract_files.
+
+    Args:
+    path (str): path to upgrade package
+
+    Returns:
+    PackageInfo: name of .md5 member and version hash
+    """
+
+    info = PackageInfo(path)
+    with tarfile.open(path, mode='r|gz') as archive:
+        for member in archive:
+            if member.isfile() and member.name.endswith('md5'):
+                info.md5_member = member.name
+                info.version_md5_hash = read_version_md5_hash(archive.extractfile(member))
+                break
+
+    if info.md5_member is None:
+        raise ValueError('No md5 file in package {}'.format(path))
+    return info
+
+
+def extract_matching(archive: tarfile.TarFile, pending: List[str], target_dir: str, extracted: Dict[str, str]):
+    for member in archive:
+        if not pending:
+            return
+        if not member.isfile():
+            continue
+
+        name = os.path.basename(member.name)
+        pattern = next((pattern for pattern in pending if fnmatch.fnmatch(name, pattern)), None)
+        if pattern is not None:
+            path = os.path.join(target_dir, name)
+            with archive.extractfile(member) as source, open(path, 'wb') as target:
+                shutil.copyfileobj(source, target, 1024 * 1024)
+            extracted[pattern] = path
+            pending.remove(pattern)
+        elif member.name.endswith('tgz'):
+            with tarfile.open(fileobj=archive.extractfile(member), mode='r|gz') as nested:
+                extract_matching(nested, pending, target_dir, extracted)
+
+
+def extract_files(path: str, patterns: List[str], target_dir: str) -> Dict[str, str]:
+    """
+    Extract first file matching each pattern, also from nested *tgz packages, in single streaming pass.
+
+    Reading stops as soon as all patterns are found.
+
+    Args:
+    path (str): path to upgrade package
+    patterns (list): shell-style patterns of file names, e.g. '*BOOTIMAGE*'
+    target_dir (str): directory to which files are extracted under their base names
+
+    Returns:
+    dict: path of extracted file by pattern, patterns without match are missing
+    """
+
+    extracted = {}
+    with tarfile.open(path, mode='r|gz') as archive:
+        extract_matching(archive, list(patterns), target_dir, extracted)
+    return extracted
@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+
+#
+# TiVo Poland Sp. z o.o. Software License Version 1.0
+#
+# Copyright (C) 2008-2019 TiVo Poland Sp. z o.o. All rights reserved.
+#
+# Any rights which are not expressly granted in this License are entirely and
+# exclusively reserved to and by TiVo Poland Sp. z o.o. You may not rent, lease,
+# modify, translate, reverse engineer, decompile, disassemble, or create
+# derivative works based on this Software. You may not make access to this
+# Software available to others in connection with a service bureau,
+# application service provider, or similar business, or make any other use of
+# this Software without express written permission from TiVo Poland Sp. z o.o.
+#
+# Any User wishing to make use of this Software must contact
+# TiVo Poland Sp. z o.o. to arrange an appropriate license. Use of the Software
+# includes, but is not limited to:
+# (1) integrating or incorporating all or part of the code into a product for
+#     sale or license by, or on behalf of, User to third parties;
+# (2) distribution of the binary or source code to third parties for use with
+#     a commercial product sold or licensed by, or on behalf of, User.
+#
+
+"""
+Retention of nightly build directories in REMOTE_LOCATION.
+Directories older than given age are removed, then the oldest ones
+until the whole location fits in its quota.
+"""
+
+import fnmatch
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple
+
+
+class BuildDirectory(NamedTuple):
+    """Single build directory found in remote location."""
+
+    name: str
+    path: str
+    mtime: float
+    size: int
+
+
+def directory_size(path: str) -> int:
+    """Return size of all files in directory tree, using stat data cached by scandir."""
+
+    size = 0
+    stack = [path]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    size += entry.stat(follow_symlinks=False).st_size
+    return size
+
+
+class RetentionSweeper:
+    """Class which is response for removing old nightly builds."""
+
+    def __init__(self, root: str, max_age_days: float = None, quota_gb: float = None,
+                 protected: List[str] = None, workers: int = 8, dry_run: bool = False):
+        """Constructor of RetentionSweeper class.
+
+        Args:
+        root (str): directory containing build directories
+        max_age_days (float): builds older than this are removed, no age limit if not given
+        quota_gb (float): maximal size of all builds, no quota if not given
+        protected (list): shell-style patterns of build names which are never removed
+        workers (int): number of directories removed in parallel
+        dry_run (bool): only report what would be removed
+        """
+
+        self.root = root
+        self.max_age_days = max_age_days
+        self.quota_gb = quota_gb
+        self.protected = protected or []
+        self.workers = workers
+        self.dry_run = dry_run
+
+    def is_protected(self, name: str) -> bool:
+        return any(fnmatch.fnmatch(name, pattern) for pattern in self.protected)
+
+    def scan(self) -> List[BuildDirectory]:
+        """List build directories in single scandir pass, oldest first."""
+
+        builds = []
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if not entry.is_dir(follow_symlinks=False):
+                    continue
+                size = directory_size(entry.path) if self.quota_gb is not None else None
+                builds.append(BuildDirectory(entry.name, entry.path, entry.stat(follow_symlinks=False).st_mtime, size))
+        return sorted(builds, key=lambda build: build.mtime)
+
+    def select(self, builds: List[BuildDirectory]) -> List[BuildDirectory]:
+        """Select builds violating age or quota policy, protected builds are skipped."""
+
+        candidates = [build for build in builds if not self.is_protected(build.name)]
+        selected = []
+        if self.max_age_days is not None:
+            oldest_allowed = time.time() - self.max_age_days * 24 * 3600
+            selected = [build for build in candidates if build.mtime < oldest_allowed]
+
+        if self.quota_gb is not None:
+            selected_names = set(build.name for build in selected)
+            total = sum(build.size for build in builds if build.name not in selected_names)
+            quota = self.quota_gb * 1024 ** 3
+            for build in candidates:
+                if total <= quota:
+                    break
+                if build.name not in selected_names:
+                    selected.append(build)
+                    total -= build.size
+        return selected
+
+    def remove(self, build: BuildDirectory) -> str:
+        try:
+            shutil.rmtree(build.path)
+            return None
+        except OSError as error:
+            return '{}: {}'.format(build.name, error)
+
+    def sweep(self) -> Dict:
+        """
+        Apply retention policies.
+
+        Returns:
+        dict: numbers of scanned, selected and removed builds, reclaimed bytes and errors
+        """
+
+        start = time.time()
+        builds = self.scan()
+        selected = self.select(builds)
+        sizes = {build.name: build.size if build.size is not None else directory_size(build.path)
+                 for build in selected}
+
+        removed, errors = [], []
+        if self.dry_run:
+            for build in selected:
+                print("Would remove {}".format(build.path))
+        elif selected:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for build, error in zip(selected, executor.map(self.remove, selected)):
+                    if error is None:
+                        removed.append(build)
+                        print("Removed {}".format(build.path))
+                    else:
+                        errors.append(error)
+                        print("Removing failed: {}".format(error))
+
+        reclaimed = sum(sizes[build.name] for build in (selected if self.dry_run else removed))
+        report = {'SCANNED': len(builds),
+                  'SELECTED': len(selected),
+                  'REMOVED': len(removed),
+                  'RECLAIMABLE_BYTES': reclaimed,
+                  'ERRORS': errors,
+                  'DRY_RUN': self.dry_run,
+                  'DURATION': time.time() - start}
+        if self.dry_run:
+            print("Retention of {}: {} of {} builds, {:.1f} MB reclaimable".format(
+                self.root, len(selected), len(builds), reclaimed / 1024 ** 2))
+        else:
+            print("Retention of {}: removed {} of {} builds, {:.1f} MB reclaimed, {} failed".format(
+                self.root, len(removed), len(builds), reclaimed / 1024 ** 2, len(errors)))
+        return report
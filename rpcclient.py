@@ -10,6 +10,8 @@ import argparse
 
 class RPCClient:
 
+    POLL_TIMEOUT = 10
+
     def __init__(self):
         config_file = os.path.expanduser(os.path.join('~', 'rpcclient.json'))
         with open(config_file) as f:
@@ -24,6 +26,7 @@ class RPCClient:
         mode = RPCClient.getJenkinsVariable("Mode")
         if not mode:
             mode = "All"
+        buildMode = RPCClient.getJenkinsVariable("BuildMode") or None
 
         loop = asyncio.get_event_loop()
         loop.set_debug(1)
@@ -48,8 +51,8 @@ class RPCClient:
                     raise Exception("Please type ReleaseVersion for RELEASE upgrade")
                     sys.exit()
                 print("Upgrade box: {} with project {} release {} ...".format(boxIP, project, releaseVersion))
-                with suppress(asyncio.TimeoutError):
-                    print(loop.run_until_complete(self.server.upgradeBoxWithRC(boxIP, "{}-{}".format(project, releaseVersion))))
+                jobId = loop.run_until_complete(self.server.upgradeBoxWithRC("{}-{}".format(project, releaseVersion), boxIP))
+                self.waitForJobs(loop, [jobId])
 
             else:
                 branch = RPCClient.getJenkinsVariable("Branch")
@@ -57,26 +60,50 @@ class RPCClient:
                     raise Exception("Please type Branch for CURRENT upgrade")
                     sys.exit()
                 print("Upgrade box: {} from branch {} with project {} ...".format(boxIP, branch, project));
-                with suppress(asyncio.TimeoutError):
-                    print(loop.run_until_complete(self.server.upgradeBox(project, boxIP)))
+                jobId = loop.run_until_complete(self.server.upgradeBox(project, branch, boxIP, buildMode))
+                self.waitForJobs(loop, [jobId])
         else:
             print("Upgrading all boxes in Generic Lab ...")
-            with suppress(asyncio.TimeoutError):
-                print(loop.run_until_complete(self.server.upgradeAllBoxes()))
+            jobId = loop.run_until_complete(self.server.upgradeAllBoxes(buildMode))
+            self.waitForJobs(loop, [jobId])
 
         loop.run_until_complete(self.server.close())
     
     def doNightlyBuild(self):
         print("Starting nightly job ...")
         self.server = UniCastClient(interfaces_info=[(self.nightly_build_host, self.server_port)])
+        buildMode = RPCClient.getJenkinsVariable("BuildMode") or None
         loop = asyncio.get_event_loop()
-        with suppress(asyncio.TimeoutError):
-            try:
-                print(loop.run_until_complete(self.server.buildNightlySoft()))
-            except:
-                pass
+        try:
+            jobIds = loop.run_until_complete(self.server.buildNightlySoft(buildMode))
+            self.waitForJobs(loop, jobIds)
+        except:
+            pass
         loop.run_until_complete(self.server.close())
 
+    def waitForJobs(self, loop, jobIds):
+        """Poll server until all jobs are finished, printing their progress and command output."""
+
+        for jobId in jobIds:
+            print("Waiting for job {} ...".format(jobId))
+            progress = None
+            nextLine = 0
+            while True:
+                with suppress(asyncio.TimeoutError):
+                    status = loop.run_until_complete(self.server.waitJob(jobId, self.POLL_TIMEOUT))
+                    output = loop.run_until_complete(self.server.getJobOutput(jobId, nextLine))
+                    if output['SKIPPED']:
+                        print("... {} line(s) skipped ...".format(output['SKIPPED']))
+                    for line in output['LINES']:
+                        print(line)
+                    nextLine = output['NEXT']
+                    if status['PROGRESS'] != progress:
+                        progress = status['PROGRESS']
+                        print("Job {} {}: {}".format(jobId, status['STATE'], progress))
+                    if status['STATE'] in ('done', 'failed'):
+                        print(status.get('RESULT', status.get('ERROR')))
+                        break
+
     @staticmethod
     def getJenkinsVariable(name):
         val = os.getenv(name)
@@ -6,9 +6,16 @@ import asyncio
 import json
 from nightly_build import Builder
 from UpgraderInstance import Upgrader
+from job_scheduler import JobScheduler
+from instrumentation import metrics, serve_metrics
+import ssh_pool
 from asyncrpc.server import UniCastServer
 
 class RPCServer:
+    """
+    Upgrade and build methods only queue a job and return its id.
+    Jobs are followed with getJobStatus, getJobResult, getJobOutput and waitJob.
+    """
 
     def __init__(self):
         prefix = os.path.dirname(os.path.realpath(sys.argv[0]))
@@ -18,34 +25,113 @@ class RPCServer:
             self.nightlyBuilds = data['NIGHTLY_BUILD']
             self.upgrade = data['UPGRADE']
             self.jira = data['JIRA']
+            self.scheduler = JobScheduler(data.get('SCHEDULER', {}))
+            self.instrumentation = data.get('INSTRUMENTATION', {})
+            metrics.configure(self.instrumentation)
 
-    @asyncio.coroutine
-    def upgradeAllBoxes(self):
-        upgrader = Upgrader(self.upgrade)
-        upgrader.upgrade_all_boxes()
+    def upgradeWorkDir(self, branch:str):
+        return os.path.join(self.upgrade['WORK_DIR'], branch)
 
-    @asyncio.coroutine
-    def upgradeBox(self, project:str, branch:int, ip:str):
-        upgrade_params = {'PROJECT': project, 'BRANCH': branch, 'IP': ip}
+    def runUpgradeAllBoxes(self, buildMode:str=None):
+        upgrade = self.upgrade
+        if buildMode:
+            upgrade = dict(upgrade, BOXES_LIST=[dict(box, BUILD_MODE=buildMode) for box in upgrade['BOXES_LIST']])
+        return Upgrader(upgrade).upgrade_all_boxes()
+
+    def runUpgradeBox(self, upgrade_params:dict):
         upgrader = Upgrader(self.upgrade)
         upgrader.upgrade_box(upgrade_params)
+        return {'IP': upgrader.ip, 'VERSION': upgrader.version_md5_hash, 'SUCCEED': upgrader.upgrade_succeed,
+                'PHASES': upgrader.phase_durations.get(upgrader.ip, {})}
+
+    def runUpgradeBoxWithRC(self, upgrade_params:dict):
+        upgrader = Upgrader(self.upgrade)
+        upgrader.upgrade_box_with_rc(upgrade_params)
+        return {'IP': upgrader.ip, 'VERSION': upgrader.version_md5_hash, 'SUCCEED': upgrader.upgrade_succeed}
+
+    def runNightlyBuild(self, nightlyBuild:dict):
+        builder = Builder(nightlyBuild, self.jira)
+        builder.build_nightly_projects()
+        return {'BRANCH': builder.branch, 'SW_TAG': builder.sw_tag}
+
+    @asyncio.coroutine
+    def upgradeAllBoxes(self, buildMode:str=None):
+        workDirs = sorted(set(self.upgradeWorkDir(box['BRANCH']) for box in self.upgrade['BOXES_LIST']))
+        return self.scheduler.submit('upgradeAllBoxes', self.runUpgradeAllBoxes, buildMode, work_dirs=workDirs,
+                                     dedupe_key=('upgradeAllBoxes', buildMode)).job_id
+
+    @asyncio.coroutine
+    def upgradeBox(self, project:str, branch:int, ip:str, buildMode:str=None):
+        upgrade_params = {'PROJECT': project, 'BRANCH': branch, 'IP': ip, 'BUILD_MODE': buildMode}
+        return self.scheduler.submit('upgradeBox', self.runUpgradeBox, upgrade_params,
+                                     work_dirs=[self.upgradeWorkDir(str(branch))],
+                                     dedupe_key=('upgradeBox', project, str(branch), ip, buildMode)).job_id
 
     @asyncio.coroutine
     def upgradeBoxWithRC(self, project:str, ip:str):
         upgrade_params = {'PROJECT': project, 'IP': ip}
-        upgrader = Upgrader(self.upgrade)
-        upgrader.upgrade_box_with_rc(upgrade_params)
+        return self.scheduler.submit('upgradeBoxWithRC', self.runUpgradeBoxWithRC, upgrade_params,
+                                     work_dirs=[self.upgradeWorkDir('RC')],
+                                     dedupe_key=('upgradeBoxWithRC', project, ip)).job_id
+
+    @asyncio.coroutine
+    def buildNightlySoft(self, buildMode:str=None):
+        nightlyBuilds = [dict(nightlyBuild, BUILD_MODE=buildMode) if buildMode else nightlyBuild
+                         for nightlyBuild in self.nightlyBuilds]
+        return [self.scheduler.submit('buildNightlySoft', self.runNightlyBuild, nightlyBuild,
+                                      work_dirs=[os.path.join(nightlyBuild['WORK_DIR'], nightlyBuild['BRANCH'])],
+                                      dedupe_key=('buildNightlySoft', json.dumps(nightlyBuild, sort_keys=True))).job_id
+                for nightlyBuild in nightlyBuilds]
+
+    @asyncio.coroutine
+    def getJobStatus(self, jobId:str):
+        return self.scheduler.get_job(jobId).status()
+
+    @asyncio.coroutine
+    def getJobResult(self, jobId:str):
+        return self.scheduler.get_job(jobId).result()
+
+    @asyncio.coroutine
+    def getJobOutput(self, jobId:str, since:int=0):
+        return self.scheduler.get_job(jobId).get_output(since)
+
+    @asyncio.coroutine
+    def waitJob(self, jobId:str, timeout:float=30):
+        job = self.scheduler.get_job(jobId)
+        if not job.future.done():
+            loop = asyncio.get_event_loop()
+            finished = loop.create_future()
+
+            def set_finished():
+                if not finished.done():
+                    finished.set_result(None)
+
+            job.future.add_done_callback(lambda future: loop.call_soon_threadsafe(set_finished))
+            try:
+                yield from asyncio.wait_for(finished, timeout)
+            except asyncio.TimeoutError:
+                pass
+        return job.result()
+
+    @asyncio.coroutine
+    def getSchedulerStats(self):
+        return self.scheduler.stats()
+
+    @asyncio.coroutine
+    def getConnectionStats(self):
+        return ssh_pool.pool.stats()
 
     @asyncio.coroutine
-    def buildNightlySoft(self):
-        for nightlyBuild in self.nightlyBuilds:
-            builder = Builder(nightlyBuild, self.jira)
-            builder.build_nightly_projects()
+    def getMetrics(self):
+        return metrics.render()
 
 if __name__ == '__main__':
     print('Run rpc server')
+    rpcServer = RPCServer()
+    if rpcServer.instrumentation.get('METRICS_PORT'):
+        serve_metrics('10.136.209.228', int(rpcServer.instrumentation['METRICS_PORT']))
     server = UniCastServer(
-        obj=RPCServer(),
+        obj=rpcServer,
         ip_addrs='10.136.209.228',
         port=9001
     )
@@ -0,0 +1,208 @@
+#!/usr/bin/python3
+
+#
+# TiVo Poland Sp. z o.o. Software License Version 1.0
+#
+# Copyright (C) 2008-2019 TiVo Poland Sp. z o.o. All rights reserved.
+#
+# Any rights which are not expressly granted in this License are entirely and
+# exclusively reserved to and by TiVo Poland Sp. z o.o. You may not rent, lease,
+# modify, translate, reverse engineer, decompile, disassemble, or create
+# derivative works based on this Software. You may not make access to this
+# Software available to others in connection with a service bureau,
+# application service provider, or similar business, or make any other use of
+# this Software without express written permission from TiVo Poland Sp. z o.o.
+#
+# Any User wishing to make use of this Software must contact
+# TiVo Poland Sp. z o.o. to arrange an appropriate license. Use of the Software
+# includes, but is not limited to:
+# (1) integrating or incorporating all or part of the code into a product for
+#     sale or license by, or on behalf of, User to third parties;
+# (2) distribution of the binary or source code to third parties for use with
+#     a commercial product sold or licensed by, or on behalf of, User.
+#
+
+"""
+Transfer of sbuild directories to lab server.
+
+Tar stream is written straight to ssh channel. Files which did not change since
+the previous upload are hard-linked on remote side from the previous hash directory,
+only changed files are sent.
+"""
+
+import hashlib
+import io
+import json
+import os
+import shlex
+import stat
+import tarfile
+import time
+from typing import Dict
+
+MANIFEST_NAME = '.manifest.json'
+REMOTE_MODE = 0o777
+
+
+def file_md5(path: str) -> str:
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def build_manifest(local_dir: str) -> Dict[str, Dict]:
+    """
+    Describe content of directory.
+
+    Returns:
+    dict: relative path -> {'TYPE': 'file'|'link'|'dir', 'SIZE', 'MD5' or 'TARGET'}
+    """
+
+    manifest = {}
+    for root, dirs, files in os.walk(local_dir):
+        for name in dirs + files:
+            path = os.path.join(root, name)
+            relative_path = os.path.relpath(path, local_dir)
+            st = os.lstat(path)
+            if stat.S_ISLNK(st.st_mode):
+                manifest[relative_path] = {'TYPE': 'link', 'TARGET': os.readlink(path)}
+            elif stat.S_ISDIR(st.st_mode):
+                manifest[relative_path] = {'TYPE': 'dir'}
+            elif stat.S_ISREG(st.st_mode):
+                manifest[relative_path] = {'TYPE': 'file', 'SIZE': st.st_size, 'MD5': file_md5(path)}
+    return manifest
+
+
+def run_remote(client, command: str, data: bytes = None):
+    """Run command on remote host, optionally feeding data to its stdin, and check exit status."""
+
+    stdin, stdout, stderr = client.exec_command(command)
+    if data is not None:
+        stdin.write(data)
+    stdin.channel.shutdown_write()
+    status = stdout.channel.recv_exit_status()
+    if status != 0:
+        raise RuntimeError("Remote command '{}' failed with status {}: {}".format(
+            command, status, str(stderr.read(), 'utf-8').strip()))
+
+
+class SbuildTransfer:
+    """Class which is response for sending sbuild directories to remote hash directories."""
+
+    def __init__(self, client, remote_location: str):
+        """Constructor of SbuildTransfer class.
+
+        Args:
+        client (paramiko.SSHClient): connection to lab server
+        remote_location (str): directory containing hash directories
+        """
+
+        self.client = client
+        self.remote_location = remote_location
+        self.sftp = client.open_sftp()
+
+    def read_remote_manifest(self, sbuild_path: str) -> Dict[str, Dict]:
+        try:
+            with self.sftp.open(os.path.join(sbuild_path, MANIFEST_NAME)) as f:
+                return json.loads(str(f.read(), 'utf-8'))
+        except IOError:
+            return None
+
+    def find_previous(self, sbuild_name: str, version_hash: str):
+        """
+        Find newest hash directory containing the same sbuild uploaded with manifest.
+
+        Returns:
+        tuple: path of previous sbuild directory and its manifest, (None, None) if not found
+        """
+
+        entries = [entry for entry in self.sftp.listdir_attr(self.remote_location)
+                   if stat.S_ISDIR(entry.st_mode) and entry.filename != version_hash]
+        for entry in sorted(entries, key=lambda entry: entry.st_mtime, reverse=True):
+            sbuild_path = os.path.join(self.remote_location, entry.filename, sbuild_name)
+            manifest = self.read_remote_manifest(sbuild_path)
+            if manifest is not None:
+                return sbuild_path, manifest
+        return None, None
+
+    @staticmethod
+    def write_tar_stream(channel_file, local_dir: str, manifest: Dict[str, Dict], paths) -> int:
+        """Write tar of selected paths to remote stdin, returns number of sent file bytes."""
+
+        sent = 0
+        with tarfile.open(fileobj=channel_file, mode='w|', bufsize=1024 * 1024) as archive:
+            for relative_path in paths:
+                info = archive.gettarinfo(os.path.join(local_dir, relative_path), arcname=relative_path)
+                info.mode = REMOTE_MODE
+                info.uid = info.gid = 0
+                info.uname = info.gname = ''
+                if info.isreg():
+                    with open(os.path.join(local_dir, relative_path), 'rb') as f:
+                        archive.addfile(info, f)
+                    sent += info.size
+                else:
+                    archive.addfile(info)
+
+            data = json.dumps(manifest, sort_keys=True).encode('utf-8')
+            info = tarfile.TarInfo(MANIFEST_NAME)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            info.mode = REMOTE_MODE
+            archive.addfile(info, io.BytesIO(data))
+        return sent
+
+    def transfer(self, local_dir: str, version_hash: str) -> Dict[str, int]:
+        """
+        Send local sbuild directory to REMOTE_LOCATION/<version_hash>/<sbuild name>.
+
+        Args:
+        local_dir (str): local sbuild directory
+        version_hash (str): name of remote hash directory
+
+        Returns:
+        dict: total, sent and saved bytes
+        """
+
+        sbuild_name = os.path.basename(os.path.normpath(local_dir))
+        base_path = os.path.join(self.remote_location, version_hash)
+        sbuild_path = os.path.join(base_path, sbuild_name)
+
+        manifest = build_manifest(local_dir)
+        total = sum(entry['SIZE'] for entry in manifest.values() if entry['TYPE'] == 'file')
+        if self.read_remote_manifest(sbuild_path) is not None:
+            print("{} already present in {}".format(sbuild_name, base_path))
+            return {'TOTAL_BYTES': total, 'SENT_BYTES': 0, 'SAVED_BYTES': total}
+
+        run_remote(self.client, 'mkdir -p {path} && chmod {mode:o} {path} && rm -rf {sbuild}'.format(
+            path=shlex.quote(base_path), mode=REMOTE_MODE, sbuild=shlex.quote(sbuild_path)))
+
+        previous_path, previous = self.find_previous(sbuild_name, version_hash)
+        if previous is not None:
+            print("Linking unchanged files from {}".format(previous_path))
+            run_remote(self.client, 'cp -al {} {}'.format(shlex.quote(previous_path), shlex.quote(sbuild_path)))
+            stale = [path for path, entry in previous.items() if manifest.get(path) != entry]
+            stale.append(MANIFEST_NAME)
+            run_remote(self.client, 'cd {} && xargs -0 -r rm -rf --'.format(shlex.quote(sbuild_path)),
+                       b'\0'.join(path.encode('utf-8') for path in stale))
+            changed = sorted(path for path, entry in manifest.items() if previous.get(path) != entry)
+        else:
+            changed = sorted(manifest)
+
+        stdin, stdout, stderr = self.client.exec_command('mkdir -p {path} && chmod {mode:o} {path} && cd {path} '
+                                                         '&& tar -xpf -'.format(path=shlex.quote(sbuild_path),
+                                                                                mode=REMOTE_MODE))
+        sent = self.write_tar_stream(stdin, local_dir, manifest, changed)
+        stdin.channel.shutdown_write()
+        status = stdout.channel.recv_exit_status()
+        if status != 0:
+            raise RuntimeError('Remote extraction failed with status {}: {}'.format(
+                status, str(stderr.read(), 'utf-8').strip()))
+
+        stats = {'TOTAL_BYTES': total, 'SENT_BYTES': sent, 'SAVED_BYTES': total - sent}
+        print("Sent {} of {} bytes to {}, saved {} bytes".format(sent, total, sbuild_path, stats['SAVED_BYTES']))
+        return stats
+
+    def close(self):
+        self.sftp.close()
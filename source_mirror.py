@@ -0,0 +1,207 @@
+#!/usr/bin/python3
+
+#
+# TiVo Poland Sp. z o.o. Software License Version 1.0
+#
+# Copyright (C) 2008-2019 TiVo Poland Sp. z o.o. All rights reserved.
+#
+# Any rights which are not expressly granted in this License are entirely and
+# exclusively reserved to and by TiVo Poland Sp. z o.o. You may not rent, lease,
+# modify, translate, reverse engineer, decompile, disassemble, or create
+# derivative works based on this Software. You may not make access to this
+# Software available to others in connection with a service bureau,
+# application service provider, or similar business, or make any other use of
+# this Software without express written permission from TiVo Poland Sp. z o.o.
+#
+# Any User wishing to make use of this Software must contact
+# TiVo Poland Sp. z o.o. to arrange an appropriate license. Use of the Software
+# includes, but is not limited to:
+# (1) integrating or incorporating all or part of the code into a product for
+#     sale or license by, or on behalf of, User to third parties;
+# (2) distribution of the binary or source code to third parties for use with
+#     a commercial product sold or licensed by, or on behalf of, User.
+#
+
+
+"""
+Local mirrors of nosilo source trees shared by all jobs of the process.
+
+Every branch (or release) is fetched from upstream once into MIRROR_DIR and refreshed
+in the background. Jobs get their working trees synchronized from the mirror with
+hardlinked clones (or shared stores) and local pulls, which take seconds instead of
+minutes of pulling from upstream.
+"""
+
+import os
+import shutil
+import subprocess
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+
+from incremental_build import find_repositories, hg_output
+
+CLONE = 'clone'
+SHARE = 'share'
+
+
+class SourceMirror:
+    """Class which is response for keeping mirrors up to date and checking them out to working trees."""
+
+    MAX_WORKERS = 8
+
+    def __init__(self, mirror_dir: str, refresh_interval: float = 300, clone_mode: str = CLONE):
+        """Constructor of SourceMirror class.
+
+        Args:
+        mirror_dir (str): directory containing mirror per branch
+        refresh_interval (float): mirrors older than this are refreshed, also period of background refresh
+        clone_mode (str): 'clone' for hardlinked clones, 'share' for working copies sharing mirror store
+        """
+
+        if clone_mode not in (CLONE, SHARE):
+            raise ValueError("Unknown MIRROR_CLONE_MODE {}".format(clone_mode))
+        self.mirror_dir = mirror_dir
+        self.refresh_interval = refresh_interval
+        self.clone_mode = clone_mode
+        self.lock = threading.Lock()
+        self.mirror_locks: Dict[str, threading.Lock] = defaultdict(threading.Lock)
+        self.fetch_commands: Dict[str, str] = {}
+        self.refreshed_at: Dict[str, float] = {}
+        self.refresher: threading.Thread = None
+        self.stopped = threading.Event()
+        os.makedirs(self.mirror_dir, exist_ok=True)
+
+    def mirror_path(self, name: str) -> str:
+        return os.path.join(self.mirror_dir, name)
+
+    def register(self, name: str, fetch_command: str):
+        """Remember how mirror is fetched, so it can be refreshed in the background."""
+
+        with self.lock:
+            self.fetch_commands[name] = fetch_command
+            if self.refresher is None:
+                self.refresher = threading.Thread(target=self.refresh_loop, name='source-mirror', daemon=True)
+                self.refresher.start()
+
+    def refresh(self, name: str, force: bool = False) -> Dict[str, str]:
+        """
+        Fetch mirror from upstream if it is older than refresh_interval.
+
+        Args:
+        name (str): branch or release name
+        force (bool): fetch regardless of mirror age
+
+        Returns:
+        dict: consistent snapshot of revisions of all repositories in the mirror
+        """
+
+        with self.lock:
+            mirror_lock = self.mirror_locks[name]
+            fetch_command = self.fetch_commands[name]
+        path = self.mirror_path(name)
+        with mirror_lock:
+            if force or time.time() - self.refreshed_at.get(name, 0) >= self.refresh_interval:
+                os.makedirs(path, exist_ok=True)
+                start = time.time()
+                subprocess.check_call(fetch_command, shell=True, cwd=path, stderr=subprocess.STDOUT)
+                self.refreshed_at[name] = time.time()
+                print("Mirror {} refreshed in {:.1f}s".format(name, time.time() - start))
+            return {repository: hg_output(os.path.join(path, repository), 'log', '-r', '.', '-T', '{node}')
+                    for repository in find_repositories(path)}
+
+    def refresh_loop(self):
+        while not self.stopped.wait(self.refresh_interval):
+            with self.lock:
+                names = list(self.fetch_commands)
+            for name in names:
+                try:
+                    self.refresh(name, force=True)
+                except Exception as error:
+                    print("Refreshing mirror {} failed: {}".format(name, error))
+
+    def sync_repository(self, source: str, target: str, node: str):
+        """Create or update working copy of single repository at given revision."""
+
+        if not os.path.isdir(os.path.join(target, '.hg')):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            if self.clone_mode == SHARE:
+                subprocess.check_call(['hg', 'share', '-U', source, target])
+            else:
+                subprocess.check_call(['hg', 'clone', '-U', source, target])
+            try:
+                upstream = hg_output(source, 'paths', 'default')
+            except subprocess.CalledProcessError:
+                upstream = None
+            if upstream:
+                with open(os.path.join(target, '.hg', 'hgrc'), 'w') as f:
+                    f.write('[paths]\ndefault = {}\n'.format(upstream))
+        elif not os.path.exists(os.path.join(target, '.hg', 'sharedpath')):
+            subprocess.check_call(['hg', '-R', target, 'pull', '-q', '-r', node, source])
+        subprocess.check_call(['hg', '-R', target, 'update', '-q', '-C', '-r', node])
+
+    def checkout(self, name: str, fetch_command: str, work_tree: str) -> Dict[str, str]:
+        """
+        Synchronize working tree with the mirror.
+
+        Missing repositories are cloned from the mirror, existing ones pull from it locally,
+        untracked files (e.g. build products) are kept.
+
+        Args:
+        name (str): branch or release name
+        fetch_command (str): nosilo command fetching the mirror from upstream
+        work_tree (str): working tree of the job
+
+        Returns:
+        dict: revisions checked out in the working tree
+        """
+
+        self.register(name, fetch_command)
+        revisions = self.refresh(name)
+        path = self.mirror_path(name)
+
+        start = time.time()
+        os.makedirs(work_tree, exist_ok=True)
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    shutil.copy2(entry.path, os.path.join(work_tree, entry.name))
+        with ThreadPoolExecutor(max_workers=self.MAX_WORKERS) as executor:
+            list(executor.map(lambda item: self.sync_repository(os.path.join(path, item[0]),
+                                                                os.path.join(work_tree, item[0]), item[1]),
+                              revisions.items()))
+        print("Checked out {} repositories of {} to {} in {:.1f}s".format(len(revisions), name, work_tree,
+                                                                          time.time() - start))
+        return revisions
+
+    def stop(self):
+        self.stopped.set()
+
+
+mirrors: Dict[str, SourceMirror] = {}
+mirrors_lock = threading.Lock()
+
+
+def get_mirror(config: dict) -> SourceMirror:
+    """
+    Return mirror shared by all jobs of the process.
+
+    Args:
+    config (dict): UPGRADE or NIGHTLY_BUILD entry, MIRROR_DIR enables mirroring
+
+    Returns:
+    SourceMirror: shared mirror or None if MIRROR_DIR is not configured
+    """
+
+    mirror_dir = config.get('MIRROR_DIR')
+    if not mirror_dir:
+        return None
+    with mirrors_lock:
+        mirror = mirrors.get(mirror_dir)
+        if mirror is None:
+            mirror = SourceMirror(mirror_dir, float(config.get('MIRROR_REFRESH_INTERVAL', 300)),
+                                  config.get('MIRROR_CLONE_MODE', CLONE))
+            mirrors[mirror_dir] = mirror
+        return mirror
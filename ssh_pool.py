@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+
+#
+# TiVo Poland Sp. z o.o. Software License Version 1.0
+#
+# Copyright (C) 2008-2019 TiVo Poland Sp. z o.o. All rights reserved.
+#
+# Any rights which are not expressly granted in this License are entirely and
+# exclusively reserved to and by TiVo Poland Sp. z o.o. You may not rent, lease,
+# modify, translate, reverse engineer, decompile, disassemble, or create
+# derivative works based on this Software. You may not make access to this
+# Software available to others in connection with a service bureau,
+# application service provider, or similar business, or make any other use of
+# this Software without express written permission from TiVo Poland Sp. z o.o.
+#
+# Any User wishing to make use of this Software must contact
+# TiVo Poland Sp. z o.o. to arrange an appropriate license. Use of the Software
+# includes, but is not limited to:
+# (1) integrating or incorporating all or part of the code into a product for
+#     sale or license by, or on behalf of, User to third parties;
+# (2) distribution of the binary or source code to third parties for use with
+#     a commercial product sold or licensed by, or on behalf of, User.
+#
+
+"""
+Pool of ssh connections to lab server and STBs shared by all jobs of the process.
+"""
+
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+
+import paramiko
+
+PoolKey = Tuple[str, int, str, str]
+
+
+class PooledConnection:
+    """Ssh client together with pool bookkeeping."""
+
+    def __init__(self, key: PoolKey, client: paramiko.SSHClient, generation: int):
+        self.key = key
+        self.client = client
+        self.generation = generation
+        self.released_at = time.time()
+
+    def is_healthy(self) -> bool:
+        transport = self.client.get_transport()
+        if transport is None or not transport.is_active() or not transport.is_authenticated():
+            return False
+        try:
+            transport.send_ignore()
+        except Exception:
+            return False
+        return True
+
+    def close(self):
+        try:
+            self.client.close()
+        except Exception:
+            pass
+
+
+class SSHConnectionPool:
+    """Class which is response for reusing ssh connections keyed by (host, port, user, key)."""
+
+    def __init__(self, keepalive: int = 30, idle_timeout: float = 300, connect_timeout: float = 10):
+        """Constructor of SSHConnectionPool class.
+
+        Args:
+        keepalive (int): interval of keepalive packets in seconds
+        idle_timeout (float): idle connections older than this are closed
+        connect_timeout (float): default timeout of tcp connect, ssh banner and authentication of new connection
+        """
+
+        self.keepalive = keepalive
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.lock = threading.Lock()
+        self.idle: Dict[PoolKey, List[PooledConnection]] = defaultdict(list)
+        self.generations: Dict[str, int] = defaultdict(int)
+        self.counters: Dict[str, int] = defaultdict(int)
+
+    def open(self, key: PoolKey, generation: int, timeout: float = None) -> PooledConnection:
+        host, port, username, key_path = key
+        timeout = self.connect_timeout if timeout is None else timeout
+        client = paramiko.SSHClient()
+        client.load_host_keys(os.path.expanduser(os.path.join('~', '.ssh', 'known_hosts')))
+        client.connect(host, port=port, username=username, key_filename=key_path, timeout=timeout,
+                       banner_timeout=timeout, auth_timeout=timeout)
+        client.get_transport().set_keepalive(self.keepalive)
+        return PooledConnection(key, client, generation)
+
+    def evict_idle(self):
+        """Close idle connections not used for longer than idle_timeout. Must be called with lock held."""
+
+        now = time.time()
+        for key, connections in self.idle.items():
+            for connection in [c for c in connections if now - c.released_at > self.idle_timeout]:
+                connections.remove(connection)
+                connection.close()
+                self.counters['EVICTED'] += 1
+
+    def acquire(self, host: str, username: str, key_path: str, port: int = 22,
+                timeout: float = None) -> PooledConnection:
+        key = (host, port, username, key_path)
+        while True:
+            with self.lock:
+                self.evict_idle()
+                generation = self.generations[host]
+                connection = self.idle[key].pop() if self.idle[key] else None
+            if connection is None:
+                break
+            if connection.generation == generation and connection.is_healthy():
+                with self.lock:
+                    self.counters['REUSED'] += 1
+                return connection
+            connection.close()
+            with self.lock:
+                self.counters['DROPPED'] += 1
+
+        connection = self.open(key, generation, timeout)
+        with self.lock:
+            self.counters['OPENED'] += 1
+        return connection
+
+    def release(self, connection: PooledConnection, healthy: bool = True):
+        with self.lock:
+            if healthy and connection.generation == self.generations[connection.key[0]]:
+                connection.released_at = time.time()
+                self.idle[connection.key].append(connection)
+                return
+        connection.close()
+
+    @contextmanager
+    def connection(self, host: str, username: str, key_path: str, port: int = 22, timeout: float = None):
+        """
+        Borrow connection from the pool.
+
+        Connection is returned to the pool when block finishes, or closed when block failed.
+
+        Args:
+        host (str): address of lab server or box
+        username (str): ssh user
+        key_path (str): path to private key
+        port (int): ssh port
+        timeout (float): timeout of opening new connection, connect_timeout of the pool if not given
+        """
+
+        connection = self.acquire(host, username, key_path, port, timeout)
+        try:
+            yield connection.client
+        except BaseException:
+            self.release(connection, healthy=False)
+            raise
+        self.release(connection)
+
+    def invalidate(self, host: str):
+        """Drop all connections to host, e.g. after box reboot. Borrowed ones are closed on release."""
+
+        with self.lock:
+            self.generations[host] += 1
+            for key in [key for key in self.idle if key[0] == host]:
+                for connection in self.idle.pop(key):
+                    connection.close()
+
+    def stats(self) -> Dict[str, int]:
+        """Return counts of opened, reused, dropped, evicted and idle connections."""
+
+        with self.lock:
+            self.evict_idle()
+            stats = {name: self.counters[name] for name in ('OPENED', 'REUSED', 'DROPPED', 'EVICTED')}
+            stats['IDLE'] = sum(len(connections) for connections in self.idle.values())
+            return stats
+
+    def close_all(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for connection in connections:
+                    connection.close()
+            self.idle.clear()
+
+
+pool = SSHConnectionPool()
@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+
+#
+# TiVo Poland Sp. z o.o. Software License Version 1.0
+#
+# Copyright (C) 2008-2019 TiVo Poland Sp. z o.o. All rights reserved.
+#
+# Any rights which are not expressly granted in this License are entirely and
+# exclusively reserved to and by TiVo Poland Sp. z o.o. You may not rent, lease,
+# modify, translate, reverse engineer, decompile, disassemble, or create
+# derivative works based on this Software. You may not make access to this
+# Software available to others in connection with a service bureau,
+# application service provider, or similar business, or make any other use of
+# this Software without express written permission from TiVo Poland Sp. z o.o.
+#
+# Any User wishing to make use of this Software must contact
+# TiVo Poland Sp. z o.o. to arrange an appropriate license. Use of the Software
+# includes, but is not limited to:
+# (1) integrating or incorporating all or part of the code into a product for
+#     sale or license by, or on behalf of, User to third parties;
+# (2) distribution of the binary or source code to third parties for use with
+#     a commercial product sold or licensed by, or on behalf of, User.
+#
+
+
+"""
+Shared staging of upgrade packages served to boxes from UPGRADE_BASE_DIR.
+
+Package is extracted once to UPGRADE_BASE_DIR/<version_md5_hash> and served
+from UPGRADE_BASE_URL/<version_md5_hash>. Upgrades using the staged package
+hold a reference to it, unreferenced packages are removed in LRU order
+when the store grows above its size limit.
+"""
+
+import os
+import re
+import shutil
+import tarfile
+import threading
+import time
+from collections import defaultdict
+from typing import Dict
+from build_cache import tree_size
+
+HASH_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+
+class StagingStore:
+    """Class which is response for extracting upgrade packages once and sharing them between upgrades."""
+
+    def __init__(self, base_dir: str, base_url: str, max_size_gb: float = 20):
+        """Constructor of StagingStore class.
+
+        Args:
+        base_dir (str): directory served by upgrade HTTP server
+        base_url (str): URL of base_dir
+        max_size_gb (float): size above which unreferenced packages are removed
+        """
+
+        self.base_dir = base_dir
+        self.base_url = base_url
+        self.max_size = int(max_size_gb * 1024 ** 3)
+        self.lock = threading.Lock()
+        self.extract_locks: Dict[str, threading.Lock] = defaultdict(threading.Lock)
+        self.references: Dict[str, int] = defaultdict(int)
+        self.counters: Dict[str, int] = {'EXTRACTED': 0, 'REUSED': 0, 'EVICTED': 0}
+
+    def path(self, version_md5_hash: str) -> str:
+        return os.path.join(self.base_dir, version_md5_hash)
+
+    def url(self, version_md5_hash: str) -> str:
+        return os.path.join(self.base_url, version_md5_hash)
+
+    def extract(self, version_md5_hash: str, package_path: str):
+        path = self.path(version_md5_hash)
+        partial = '{}.partial-{}'.format(path, os.getpid())
+        shutil.rmtree(partial, ignore_errors=True)
+        os.makedirs(partial)
+        try:
+            with tarfile.open(package_path, mode='r|*') as archive:
+                if hasattr(tarfile, 'data_filter'):
+                    archive.extractall(partial, filter='fully_trusted')
+                else:
+                    archive.extractall(partial)
+            os.rename(partial, path)
+        except BaseException:
+            shutil.rmtree(partial, ignore_errors=True)
+            raise
+
+    def acquire(self, version_md5_hash: str, package_path: str) -> str:
+        """
+        Stage package unless it is already staged and take reference to it.
+
+        Args:
+        version_md5_hash (str): version hash of the package
+        package_path (str): upgrade package (tgz) extracted when not staged yet
+
+        Returns:
+        str: URL from which boxes are upgraded
+        """
+
+        if not HASH_PATTERN.match(version_md5_hash):
+            raise ValueError('Invalid version hash {}'.format(version_md5_hash))
+
+        with self.lock:
+            self.references[version_md5_hash] += 1
+            extract_lock = self.extract_locks[version_md5_hash]
+        try:
+            with extract_lock:
+                if os.path.isdir(self.path(version_md5_hash)):
+                    print('Package {} already staged'.format(version_md5_hash))
+                    self.count('REUSED')
+                else:
+                    print('Stage {} in {}'.format(os.path.basename(package_path), self.path(version_md5_hash)))
+                    self.extract(version_md5_hash, package_path)
+                    self.count('EXTRACTED')
+                os.utime(self.path(version_md5_hash))
+        except BaseException:
+            self.release(version_md5_hash)
+            raise
+        return self.url(version_md5_hash)
+
+    def release(self, version_md5_hash: str):
+        """Drop reference taken by acquire and remove least recently used unreferenced packages."""
+
+        with self.lock:
+            self.references[version_md5_hash] -= 1
+            if self.references[version_md5_hash] <= 0:
+                del self.references[version_md5_hash]
+                if os.path.isdir(self.path(version_md5_hash)):
+                    os.utime(self.path(version_md5_hash))
+            self.evict()
+
+    def count(self, name: str):
+        with self.lock:
+            self.counters[name] += 1
+
+    def evict(self):
+        """Remove unreferenced packages, least recently used first, until the store fits in its size limit."""
+
+        entries = []
+        if os.path.isdir(self.base_dir):
+            with os.scandir(self.base_dir) as scan:
+                for entry in scan:
+                    if HASH_PATTERN.match(entry.name) and entry.is_dir(follow_symlinks=False):
+                        entries.append((entry.stat().st_mtime, entry.name, tree_size(entry.path)))
+
+        total_size = sum(size for mtime, name, size in entries)
+        for mtime, name, size in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            if self.references.get(name, 0) > 0:
+                continue
+            print('Removing staged package {} unused for {:.0f}s'.format(name, time.time() - mtime))
+            shutil.rmtree(self.path(name), ignore_errors=True)
+            self.counters['EVICTED'] += 1
+            total_size -= size
+
+    def stats(self) -> Dict[str, int]:
+        """Return numbers of extracted, reused and evicted packages and currently referenced ones."""
+
+        with self.lock:
+            return dict(self.counters, REFERENCED=len(self.references))
+
+
+stores: Dict[str, StagingStore] = {}
+stores_lock = threading.Lock()
+
+
+def get_store(config: dict) -> StagingStore:
+    """
+    Return staging store shared by all jobs of the process.
+
+    Args:
+    config (dict): UPGRADE entry with UPGRADE_BASE_DIR, UPGRADE_BASE_URL and STAGING_MAX_SIZE_GB
+
+    Returns:
+    StagingStore: store of the configured UPGRADE_BASE_DIR
+    """
+
+    base_dir = config['UPGRADE_BASE_DIR']
+    with stores_lock:
+        store = stores.get(base_dir)
+        if store is None:
+            store = StagingStore(base_dir, config['UPGRADE_BASE_URL'], float(config.get('STAGING_MAX_SIZE_GB', 20)))
+            stores[base_dir] = store
+        return store